@@ -1,24 +1,162 @@
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
 from datetime import datetime, timedelta, time
 import firebase_admin
-from firebase_admin import credentials, firestore, auth as admin_auth
+from firebase_admin import credentials, firestore, firestore_async, auth as admin_auth
+from google.cloud.firestore import async_transactional
 import os
 import json
 from dotenv import load_dotenv
 import pytz
 import uuid
 import math
+import asyncio
+from collections import deque
+import hashlib
+import numpy as np
+from contextlib import asynccontextmanager
 
 # Import helper functions
-from utils.helpers import get_user_document, calculate_net_earnings, get_all_employees
+from utils.helpers import get_user_document, get_user_profile, calculate_net_earnings, get_all_employees, get_employees_page
+from utils.user_cache import user_cache
+from utils.batch_loader import DocumentLoader, ShiftLoader
+from utils.bulk_writer import BulkWriter, TransactionRunner, retry_transient
+from utils.pagination import paginate, parse_fields, set_next_page_token, NEXT_PAGE_TOKEN_HEADER
+from utils.payroll import compute_payroll, empty_result, period_earnings, month_bounds, lateness, NO_SHOW_GRACE_MINUTES
+from utils import payroll_aggregates
+from utils import no_shows
+from utils import payroll_run
+from utils import payroll_periods
+from utils.payroll_cache import payroll_cache, payroll_version, payroll_etag, bump_payroll_version, bump_payroll_versions
+from utils.csv_export import csv_row, format_minutes, streaming_csv_response
+from utils.token_cache import token_cache, verify_id_token_cached
+from utils.tenant import get_user_from_claims, sync_user_claims, require_claims_tenant, filter_by_tenant
+from utils.live_attendance import live_attendance
+from utils.change_feed import change_feed, sse_message, HEARTBEAT_SECONDS
+from utils.scheduler import deadline_scheduler
+from utils.idempotency import idempotency_store
+from utils.daily_index import daily_index
+from utils.geo_index import store_locator, haversine_pairs
+from utils.counts import count_stores, count_employees, count_pending_leaves, count_open_attendance, MAX_STORES
 
 load_dotenv()
 
+# Live attendance view: also follow CLOCKED_IN attendance with a snapshot listener, so
+# writes made by other replicas are seen. Set LIVE_ATTENDANCE_LISTENER=false on a single
+# replica to rely on the clock-in/out hooks alone.
+LIVE_ATTENDANCE_LISTENER = os.getenv('LIVE_ATTENDANCE_LISTENER', 'true').lower() == 'true'
+
+# Deadline scheduler: fire auto clock-outs and no-show checks in-process (one replica, via a
+# Firestore lease). The cron endpoints keep working as a fallback.
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+
+# Daily shift/store index: also follow today's shifts and all stores with snapshot listeners.
+# Set DAILY_INDEX_LISTENER=false on a single replica to rely on the write endpoints alone.
+DAILY_INDEX_LISTENER = os.getenv('DAILY_INDEX_LISTENER', 'true').lower() == 'true'
+
+def watch_today_changes():
+    """(Re)start change feed listeners on today's attendance and shifts"""
+    today = get_current_time().date()
+    start_of_day = datetime.combine(today, time.min)
+    end_of_day = start_of_day + timedelta(days=1)
+    sync_db = firestore.client()
+    
+    change_feed.stop_watches()
+    change_feed.watch(
+        sync_db.collection('attendance').where(
+            'clockInTime', '>=', start_of_day.isoformat()
+        ).where('clockInTime', '<', end_of_day.isoformat()),
+        'attendance'
+    )
+    change_feed.watch(sync_db.collection('shifts').where('date', '==', today.isoformat()), 'shift')
+
+async def build_daily_index():
+    """Index today's shifts and all stores (and follow their changes)"""
+    today = get_current_time().date().isoformat()
+    await daily_index.build(firebase_db, today)
+    if DAILY_INDEX_LISTENER:
+        sync_db = firestore.client()
+        daily_index.watch(sync_db.collection('shifts').where('date', '==', today), sync_db.collection('stores'))
+
+async def seed_active_sessions():
+    """
+    Create the active_sessions/{uid} lock of every open session that has none
+    
+    Sessions opened before the locks existed would otherwise let their
+    employee clock in a second time. Runs before serving; a lock created by a
+    concurrent clock-in is left alone (create fails with AlreadyExists).
+    """
+    open_records = {}
+    async for doc in firebase_db.collection('attendance').where('status', '==', 'CLOCKED_IN').stream():
+        att_data = doc.to_dict()
+        employee_id = att_data.get('employeeId')
+        latest = open_records.get(employee_id)
+        # An employee with several open records (legacy duplicates) is locked to the latest
+        if employee_id and (latest is None or att_data.get('clockInTime', '') > latest[1].get('clockInTime', '')):
+            open_records[employee_id] = (doc.id, att_data)
+    
+    session_loader = DocumentLoader(firebase_db, 'active_sessions')
+    await session_loader.prime(open_records)
+    writer = BulkWriter(firebase_db)
+    for employee_id, (attendance_id, att_data) in open_records.items():
+        if await session_loader.load(employee_id) is None:
+            writer.create(firebase_db.collection('active_sessions').document(employee_id), {
+                'employeeId': employee_id,
+                'attendanceId': attendance_id,
+                'shiftId': att_data.get('shiftId'),
+                'storeId': att_data.get('storeId'),
+                'tenantId': att_data.get('tenantId'),
+                'clockInTime': att_data.get('clockInTime')
+            }, tag=employee_id)
+    result = await writer.close()
+    if result.written:
+        print(f"✓ Seeded {len(result.written)} active session locks")
+
+async def roll_over_daily():
+    """At local midnight: rebuild the daily index and move the change feed to the new day"""
+    while True:
+        now = get_current_time()
+        next_midnight = TIMEZONE.localize(datetime.combine(now.date() + timedelta(days=1), time.min))
+        await asyncio.sleep((next_midnight - now).total_seconds())
+        try:
+            await build_daily_index()
+        except Exception as e:
+            print(f"✗ Daily index rebuild error: {e}")
+        watch_today_changes()
+        change_feed.publish('day', 'reset', None, {'today': get_current_time().date().isoformat()}, broadcast=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Seed in-memory views before serving requests
+    await build_daily_index()
+    await live_attendance.seed(firebase_db)
+    await seed_active_sessions()
+    if LIVE_ATTENDANCE_LISTENER:
+        live_attendance.start_listener(
+            firestore.client().collection('attendance').where('status', '==', 'CLOCKED_IN')
+        )
+    watch_today_changes()
+    rollover_task = asyncio.create_task(roll_over_daily())
+    # Build this month's payroll aggregates for tenants that have none yet (first deploy)
+    backfill_task = asyncio.create_task(payroll_aggregates.backfill_current_month(firebase_db, get_current_time(), TIMEZONE))
+    scheduler_task = None
+    if SCHEDULER_ENABLED:
+        scheduler_task = asyncio.create_task(deadline_scheduler.run(firebase_db, seed_deadlines))
+    yield
+    if scheduler_task is not None:
+        scheduler_task.cancel()
+        await deadline_scheduler.release_lease(firebase_db)
+    rollover_task.cancel()
+    backfill_task.cancel()
+    change_feed.stop_watches()
+    daily_index.stop_watches()
+    live_attendance.stop_listener()
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 api_router = FastAPI()
 
 # CORS middleware - Production-ready with env-based origins
@@ -31,6 +169,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_PAGE_TOKEN_HEADER, 'ETag'],
 )
 
 # Initialize Firebase Admin - SECURE: Load from environment variable
@@ -53,7 +192,8 @@ try:
             raise Exception("No Firebase credentials found")
     
     firebase_admin.initialize_app(cred)
-    firebase_db = firestore.client()
+    # AsyncClient: Firestore round trips are awaited instead of blocking the event loop
+    firebase_db = firestore_async.client()
     print("✓ Firebase Admin initialized successfully")
 except Exception as e:
     print(f"✗ Firebase initialization error: {e}")
@@ -110,6 +250,23 @@ class ClockOutRequest(BaseModel):
     lat: float
     lng: float
 
+class LocateRequest(BaseModel):
+    lat: float
+    lng: float
+
+class PunchEvent(BaseModel):
+    clientId: str
+    type: str  # CLOCK_IN or CLOCK_OUT
+    timestamp: str
+    lat: float
+    lng: float
+    shiftId: Optional[str] = None
+    attendanceId: Optional[str] = None
+    employeeId: Optional[str] = None
+
+class SyncBatchRequest(BaseModel):
+    events: List[PunchEvent]
+
 class IngredientCreate(BaseModel):
     name: str
     storeId: str
@@ -136,6 +293,20 @@ class PaymentRecord(BaseModel):
     month: int
     year: int
 
+class BulkPaymentRequest(BaseModel):
+    month: int
+    year: int
+
+class PayrollPeriodRequest(BaseModel):
+    month: int
+    year: int
+
+class PayrollRunRequest(BaseModel):
+    year: Optional[int] = None
+    month: Optional[int] = None
+    runId: Optional[str] = None  # Resume this run instead of starting a new one
+    workers: Optional[int] = None
+
 # Authentication dependency
 async def verify_token(request: Request):
     auth_header = request.headers.get('Authorization')
@@ -144,16 +315,47 @@ async def verify_token(request: Request):
     
     token = auth_header.split('Bearer ')[1]
     try:
-        decoded_token = admin_auth.verify_id_token(token)
+        decoded_token = verify_id_token_cached(token)
         return decoded_token
     except Exception as e:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 # Role-based access control
+# Claims-first: role/tenantId/assignedStoreId are read from the token's custom claims.
+# Set AUTH_CLAIMS_FIRST=false to always authorize against the Firestore user document.
+AUTH_CLAIMS_FIRST = os.getenv('AUTH_CLAIMS_FIRST', 'true').lower() == 'true'
+
+async def _claims_user(token: dict) -> Optional[dict]:
+    """Claims-derived user (None for legacy tokens) with profile fields from the cached user document
+    
+    Role, tenant and store always come from the claims; name, email and the
+    other profile fields from the profile, falling back to the token's.
+    """
+    user = get_user_from_claims(token) if AUTH_CLAIMS_FIRST else None
+    if user is None:
+        return None
+    profile = await get_user_profile(token['uid'], firebase_db) or {}
+    return {
+        **profile,
+        **user,
+        'name': profile.get('name', user['name']),
+        'email': profile.get('email', user['email'])
+    }
+
 def require_role(allowed_roles: list):
     async def role_checker(token: dict = Depends(verify_token)):
         uid = token['uid']
         
+        # Normalize allowed roles to uppercase
+        normalized_allowed = [r.upper() for r in allowed_roles]
+        
+        claims_user = await _claims_user(token)
+        if claims_user is not None:
+            if claims_user['role'].upper() not in normalized_allowed and not claims_user['isSuperAdmin']:
+                raise HTTPException(status_code=403, detail=f"Access denied. Required roles: {', '.join(normalized_allowed)}")
+            return claims_user
+        
+        # Legacy tokens without synced claims: load the user document
         # Extract tenantId from token (custom claim)
         tenant_id = token.get('tenantId')
         
@@ -161,12 +363,9 @@ def require_role(allowed_roles: list):
         is_super_admin = token.get('role') == 'superadmin'
         tenant_filter = None if is_super_admin else tenant_id
         
-        user_data = get_user_document(uid, firebase_db, tenant_filter)
+        user_data = await get_user_document(uid, firebase_db, tenant_filter)
         user_role = user_data.get('role', '').upper()
         
-        # Normalize allowed roles to uppercase
-        normalized_allowed = [r.upper() for r in allowed_roles]
-        
         if user_role not in normalized_allowed and not is_super_admin:
             raise HTTPException(status_code=403, detail=f"Access denied. Required roles: {', '.join(normalized_allowed)}")
         
@@ -174,6 +373,19 @@ def require_role(allowed_roles: list):
     
     return role_checker
 
+def _tenant_scope(user: dict) -> Optional[str]:
+    """Tenant filter for an authorized user (None = super admin, no filter)"""
+    return None if user.get('isSuperAdmin') else user.get('tenantId')
+
+async def _resolve_user(token: dict) -> dict:
+    """Caller's role/tenant for endpoints open to every role (claims first, like require_role)"""
+    user = await _claims_user(token)
+    if user is None:
+        is_super_admin = token.get('role') == 'superadmin'
+        user_data = await get_user_document(token['uid'], firebase_db, None if is_super_admin else token.get('tenantId'))
+        user = {**user_data, 'uid': token['uid'], 'tenantId': token.get('tenantId'), 'isSuperAdmin': is_super_admin}
+    return user
+
 # Geofencing helper
 def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     """Calculate distance between two coordinates using Haversine formula (in meters)"""
@@ -199,6 +411,7 @@ async def health_check():
 @api_router.post("/users")
 async def create_user(user_data: UserCreate, current_user: dict = Depends(require_role(['OWNER']))):
     """Create a new user - OWNER only"""
+    require_claims_tenant({'tenantId': current_user.get('tenantId'), 'role': user_data.role})
     try:
         # Create user in Firebase Auth
         user = admin_auth.create_user(
@@ -213,11 +426,18 @@ async def create_user(user_data: UserCreate, current_user: dict = Depends(requir
             'name': user_data.name,
             'role': user_data.role.upper(),
             'assignedStoreId': user_data.assignedStoreId,
+            'tenantId': current_user.get('tenantId'),
             'createdAt': get_current_time().isoformat(),
             'updatedAt': get_current_time().isoformat()
         }
         
-        firebase_db.collection('users').document(user.uid).set(user_doc)
+        await firebase_db.collection('users').document(user.uid).set(user_doc)
+        user_cache.invalidate(user.uid)
+        # The cached payroll views list the tenant's employees
+        await bump_payroll_version(firebase_db, user_doc['tenantId'])
+        
+        # Publish role/tenant/store as custom claims for claims-first authorization
+        sync_user_claims(user.uid, user_doc)
         
         return {"id": user.uid, **user_doc}
     except Exception as e:
@@ -226,6 +446,7 @@ async def create_user(user_data: UserCreate, current_user: dict = Depends(requir
 @api_router.post("/employees")
 async def create_employee(user_data: UserCreate, current_user: dict = Depends(require_role(['OWNER', 'CO']))):
     """Create a new employee - OWNER/CO only (alias for /users)"""
+    require_claims_tenant({'tenantId': current_user.get('tenantId'), 'role': user_data.role})
     try:
         # Create user in Firebase Auth
         user = admin_auth.create_user(
@@ -240,31 +461,52 @@ async def create_employee(user_data: UserCreate, current_user: dict = Depends(re
             'name': user_data.name,
             'role': user_data.role.upper(),
             'assignedStoreId': user_data.assignedStoreId,
+            'tenantId': current_user.get('tenantId'),
             'createdAt': get_current_time().isoformat(),
             'updatedAt': get_current_time().isoformat(),
             'isActive': True
         }
         
-        firebase_db.collection('users').document(user.uid).set(user_doc)
+        await firebase_db.collection('users').document(user.uid).set(user_doc)
+        user_cache.invalidate(user.uid)
+        # The cached payroll views list the tenant's employees
+        await bump_payroll_version(firebase_db, user_doc['tenantId'])
+        
+        # Publish role/tenant/store as custom claims for claims-first authorization
+        sync_user_claims(user.uid, user_doc)
         
         return {"id": user.uid, **user_doc}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.get("/employees")
-async def get_employees(user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER', 'SUPERVISOR', 'EMPLOYEE', 'ACCOUNTANT']))):
-    """Get all employees - filtered by role (all authenticated users can access)"""
+async def get_employees(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER', 'SUPERVISOR', 'EMPLOYEE', 'ACCOUNTANT']))
+):
+    """Get all employees - filtered by role (all authenticated users can access)
+    
+    Paginated with limit/cursor (next cursor in the X-Next-Page-Token header);
+    fields=name,role,... limits the returned fields.
+    """
     user_role = user.get('role', '').upper()
     
     # DEBUG: Log the request
     print(f"[DEBUG] GET /api/employees - User Role: {user_role}, User ID: {user.get('uid')}")
     
-    # Get all employees using helper
-    all_users = get_all_employees(
+    # Get a page of employees using helper
+    all_users, next_cursor = await get_employees_page(
         firebase_db,
         exclude_owner_for_co=True,  # CO can't see OWNER
-        current_user_role=user_role
+        current_user_role=user_role,
+        limit=limit,
+        cursor=cursor,
+        fields=parse_fields(fields, required=['role'])
     )
+    set_next_page_token(response, next_cursor)
     
     employees_list = [{"id": emp.id, **emp.to_dict()} for emp in all_users]
     
@@ -283,11 +525,16 @@ async def get_employees(user: dict = Depends(require_role(['OWNER', 'CO', 'MANAG
     print(f"[DEBUG] No filter applied (OWNER or CO) - returning all {len(employees_list)} employees")
     return employees_list
 
+@api_router.get("/employees/count")
+async def get_employee_count(user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER']))):
+    """Get the tenant's employee count - OWNER/CO/MANAGER only"""
+    return {'count': await count_employees(firebase_db, _tenant_scope(user))}
+
 @api_router.put("/employees/{employee_id}")
 async def update_employee(employee_id: str, employee_data: UserUpdate, user: dict = Depends(require_role(['OWNER', 'CO']))):
     """Update employee - OWNER/CO only"""
     user_ref = firebase_db.collection('users').document(employee_id)
-    user_doc = user_ref.get()
+    user_doc = await user_ref.get()
     
     if not user_doc.exists:
         raise HTTPException(status_code=404, detail="Employee not found")
@@ -298,8 +545,14 @@ async def update_employee(employee_id: str, employee_data: UserUpdate, user: dic
     # Update role in uppercase
     if 'role' in update_data:
         update_data['role'] = update_data['role'].upper()
+    if 'role' in update_data or 'assignedStoreId' in update_data:
+        require_claims_tenant({**user_doc.to_dict(), **update_data})
     
-    user_ref.update(update_data)
+    await user_ref.update(update_data)
+    user_cache.invalidate(employee_id)
+    if update_data.keys() & {'salary', 'name', 'role'}:
+        # Shown in (salary: computed into) the cached payroll views
+        await bump_payroll_version(firebase_db, user_doc.to_dict().get('tenantId'))
     
     # If email changed, update Firebase Auth
     if 'email' in update_data:
@@ -308,8 +561,14 @@ async def update_employee(employee_id: str, employee_data: UserUpdate, user: dic
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Failed to update email: {str(e)}")
     
-    updated_doc = user_ref.get()
-    return {"id": employee_id, **updated_doc.to_dict()}
+    updated_doc = await user_ref.get()
+    updated_data = updated_doc.to_dict()
+    
+    # Keep custom claims in step with role/store changes; sessions holding the old ones are revoked
+    if 'role' in update_data or 'assignedStoreId' in update_data:
+        sync_user_claims(employee_id, updated_data, revoke_sessions=True)
+    
+    return {"id": employee_id, **updated_data}
 
 @api_router.delete("/employees/{employee_id}")
 async def delete_employee(employee_id: str, user: dict = Depends(require_role(['OWNER']))):
@@ -319,7 +578,7 @@ async def delete_employee(employee_id: str, user: dict = Depends(require_role(['
     """
     # Additional check: prevent deleting OWNER accounts
     user_ref = firebase_db.collection('users').document(employee_id)
-    user_doc = user_ref.get()
+    user_doc = await user_ref.get()
     
     if not user_doc.exists:
         raise HTTPException(status_code=404, detail="Employee not found")
@@ -331,11 +590,15 @@ async def delete_employee(employee_id: str, user: dict = Depends(require_role(['
         raise HTTPException(status_code=403, detail="Cannot delete OWNER accounts")
     
     try:
-        # Delete from Firebase Auth
+        # Sign the employee out everywhere, then delete from Firebase Auth
+        token_cache.revoke_uid(employee_id)
         admin_auth.delete_user(employee_id)
         
         # Delete from Firestore
-        user_ref.delete()
+        await user_ref.delete()
+        user_cache.invalidate(employee_id)
+        # Drop them from the cached payroll views
+        await bump_payroll_version(firebase_db, employee_data.get('tenantId'))
         
         return {"message": "Employee deleted successfully"}
     except Exception as e:
@@ -345,7 +608,7 @@ async def delete_employee(employee_id: str, user: dict = Depends(require_role(['
 async def reset_employee_password(employee_id: str, user: dict = Depends(require_role(['OWNER']))):
     """Reset employee password to default - OWNER only"""
     user_ref = firebase_db.collection('users').document(employee_id)
-    user_doc = user_ref.get()
+    user_doc = await user_ref.get()
     
     if not user_doc.exists:
         raise HTTPException(status_code=404, detail="Employee not found")
@@ -370,10 +633,11 @@ async def reset_employee_password(employee_id: str, user: dict = Depends(require
         )
         
         # Log the password reset
-        user_ref.update({
+        await user_ref.update({
             'passwordResetAt': get_current_time().isoformat(),
             'passwordResetBy': user['uid'],
         })
+        user_cache.invalidate(employee_id)
         
         return {
             "message": "Password reset successfully",
@@ -387,25 +651,39 @@ async def reset_employee_password(employee_id: str, user: dict = Depends(require
 # ==================== SHIFT/SCHEDULE ROUTES ====================
 
 @api_router.get("/shifts")
-async def get_shifts(storeId: Optional[str] = None, date: Optional[str] = None, startDate: Optional[str] = None, endDate: Optional[str] = None, token: dict = Depends(verify_token)):
-    """Get shifts with optional filters including date range"""
-    shifts_ref = firebase_db.collection('shifts')
+async def get_shifts(
+    response: Response,
+    storeId: Optional[str] = None,
+    employeeId: Optional[str] = None,
+    date: Optional[str] = None,
+    startDate: Optional[str] = None,
+    endDate: Optional[str] = None,
+    limit: Optional[int] = None,
+    pageToken: Optional[str] = None,
+    token: dict = Depends(verify_token)
+):
+    """Get shifts with optional filters including date range
+    
+    Ordered by date and start time. With limit, the token for the next page is
+    returned in the X-Next-Page-Token header (absent on the last page).
+    """
+    shifts_col = firebase_db.collection('shifts')
+    shifts_ref = shifts_col
     
     if storeId:
         shifts_ref = shifts_ref.where('storeId', '==', storeId)
+    if employeeId:
+        shifts_ref = shifts_ref.where('employeeId', '==', employeeId)
     if date:
         shifts_ref = shifts_ref.where('date', '==', date)
+    else:
+        if startDate:
+            shifts_ref = shifts_ref.where('date', '>=', startDate)
+        if endDate:
+            shifts_ref = shifts_ref.where('date', '<=', endDate)
     
-    shifts = list(shifts_ref.stream())
-    
-    # Filter by date range if provided
-    if startDate and endDate:
-        filtered_shifts = []
-        for shift in shifts:
-            shift_date = shift.to_dict().get('date')
-            if shift_date and startDate <= shift_date <= endDate:
-                filtered_shifts.append({"id": shift.id, **shift.to_dict()})
-        return filtered_shifts
+    shifts, next_page_token = await paginate(shifts_ref, shifts_col, ['date', 'startTime'], limit, pageToken)
+    set_next_page_token(response, next_page_token)
     
     return [{"id": shift.id, **shift.to_dict()} for shift in shifts]
 
@@ -416,16 +694,18 @@ async def create_shift(shift_data: ShiftCreate, user: dict = Depends(require_rol
     Employees can work at multiple stores on the same day, as long as shift times don't overlap.
     """
     # Check for overlapping shifts for the same employee on the same date (any store)
-    existing_shifts_ref = firebase_db.collection('shifts').where('employeeId', '==', shift_data.employeeId).where('date', '==', shift_data.date)
-    existing_shifts = list(existing_shifts_ref.stream())
+    if shift_data.date == daily_index.day:
+        existing_shifts = daily_index.shifts_for_employee(shift_data.employeeId)
+    else:
+        existing_shifts_ref = firebase_db.collection('shifts').where('employeeId', '==', shift_data.employeeId).where('date', '==', shift_data.date)
+        existing_shifts = [doc.to_dict() async for doc in existing_shifts_ref.stream()]
     
     if existing_shifts:
         # Check time overlap - employees can work at multiple stores if times don't overlap
         new_start = datetime.strptime(shift_data.startTime, '%H:%M').time()
         new_end = datetime.strptime(shift_data.endTime, '%H:%M').time()
         
-        for shift in existing_shifts:
-            shift_data_existing = shift.to_dict()
+        for shift_data_existing in existing_shifts:
             existing_start = datetime.strptime(shift_data_existing['startTime'], '%H:%M').time()
             existing_end = datetime.strptime(shift_data_existing['endTime'], '%H:%M').time()
             existing_store_name = shift_data_existing.get('storeName', 'Unknown Store')
@@ -439,32 +719,73 @@ async def create_shift(shift_data: ShiftCreate, user: dict = Depends(require_rol
     
     shift_dict = shift_data.dict()
     shift_dict['id'] = str(uuid.uuid4())
+    shift_dict['tenantId'] = user.get('tenantId')
     shift_dict['createdAt'] = get_current_time().isoformat()
     shift_dict['updatedAt'] = get_current_time().isoformat()
     
     # If supervisor is assigned, get supervisor details
     if shift_dict.get('supervisorId'):
-        supervisor_doc = firebase_db.collection('users').document(shift_dict['supervisorId']).get()
-        if supervisor_doc.exists:
-            shift_dict['supervisorName'] = supervisor_doc.to_dict().get('name', 'Unknown')
+        supervisor_data = await get_user_profile(shift_dict['supervisorId'], firebase_db)
+        if supervisor_data is not None:
+            shift_dict['supervisorName'] = supervisor_data.get('name', 'Unknown')
         else:
             shift_dict['supervisorId'] = None
     
-    firebase_db.collection('shifts').document(shift_dict['id']).set(shift_dict)
+    await firebase_db.collection('shifts').document(shift_dict['id']).set(shift_dict)
+    daily_index.put_shift(shift_dict['id'], shift_dict)
+    
+    # Later days are picked up when the scheduler re-seeds
+    if shift_dict['date'] == get_current_time().date().isoformat():
+        _schedule_no_show(shift_dict['id'], shift_dict)
     return shift_dict
 
 @api_router.delete("/shifts/{shift_id}")
 async def delete_shift(shift_id: str, user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER']))):
     """Delete a shift - OWNER/CO/MANAGER only"""
-    firebase_db.collection('shifts').document(shift_id).delete()
+    shift_ref = firebase_db.collection('shifts').document(shift_id)
+    shift_doc = await shift_ref.get()
+    shift_data = shift_doc.to_dict() if shift_doc.exists else {}
+    if shift_data.get('employeeId') and shift_data.get('date'):
+        # The shift's no-show penalty drops out of its month's aggregate in the same commit
+        def stage(transaction, state):
+            transaction.delete(shift_ref)
+            state['shifts'].pop(shift_id, None)
+        
+        await payroll_aggregates.commit_with_aggregates(
+            firebase_db, shift_data.get('tenantId'), shift_data['employeeId'],
+            [payroll_aggregates.month_key(shift_data['date'])], get_current_time(), TIMEZONE, stage
+        )
+    else:
+        await shift_ref.delete()
+    daily_index.remove_shift(shift_id)
+    deadline_scheduler.cancel('no_show', shift_id)
+    deadline_scheduler.cancel('auto_clock_out', shift_id)
+    if shift_doc.exists:
+        # Scheduled hours and no-show penalties of the shift drop out of payroll
+        await bump_payroll_version(firebase_db, shift_data.get('tenantId'))
     return {"message": "Shift deleted successfully"}
 
 # ==================== ATTENDANCE/CLOCK ROUTES ====================
 
 @api_router.get("/attendance")
-async def get_attendance(storeId: Optional[str] = None, date: Optional[str] = None, startDate: Optional[str] = None, endDate: Optional[str] = None, token: dict = Depends(verify_token)):
-    """Get attendance records with optional filters"""
-    attendance_ref = firebase_db.collection('attendance')
+async def get_attendance(
+    response: Response,
+    storeId: Optional[str] = None,
+    date: Optional[str] = None,
+    startDate: Optional[str] = None,
+    endDate: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    token: dict = Depends(verify_token)
+):
+    """Get attendance records with optional filters, ordered by clock-in time
+    
+    Paginated with limit/cursor (next cursor in the X-Next-Page-Token header);
+    fields= limits the returned fields.
+    """
+    attendance_col = firebase_db.collection('attendance')
+    attendance_ref = attendance_col
     
     if storeId:
         attendance_ref = attendance_ref.where('storeId', '==', storeId)
@@ -480,28 +801,65 @@ async def get_attendance(storeId: Optional[str] = None, date: Optional[str] = No
         end_of_day = start_of_day + timedelta(days=1)
         attendance_ref = attendance_ref.where('clockInTime', '>=', start_of_day.isoformat()).where('clockInTime', '<', end_of_day.isoformat())
     
-    attendance = list(attendance_ref.stream())
+    attendance, next_cursor = await paginate(
+        attendance_ref, attendance_col, ['clockInTime'], limit, cursor, parse_fields(fields)
+    )
+    set_next_page_token(response, next_cursor)
     return [{"id": att.id, **att.to_dict()} for att in attendance]
 
+async def _get_shift_data(shift_id: str) -> Optional[dict]:
+    """Shift from the daily index, falling back to Firestore for other days"""
+    shift_data = daily_index.get_shift(shift_id)
+    if shift_data is None:
+        shift_doc = await firebase_db.collection('shifts').document(shift_id).get()
+        shift_data = shift_doc.to_dict() if shift_doc.exists else None
+    return shift_data
+
+async def _get_store_data(store_id: str) -> Optional[dict]:
+    """Store from the daily index, falling back to Firestore"""
+    store_data = daily_index.get_store(store_id)
+    if store_data is None:
+        store_doc = await firebase_db.collection('stores').document(store_id).get()
+        if store_doc.exists:
+            store_data = store_doc.to_dict()
+            daily_index.put_store(store_id, store_data)
+    return store_data
+
+def _mark_replayed(response: Response, replayed: bool):
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+
 @api_router.post("/attendance/clock-in")
-async def clock_in(request: ClockInRequest, token: dict = Depends(verify_token)):
-    """Clock in with geofencing validation and race condition protection"""
+async def clock_in(
+    request: ClockInRequest,
+    response: Response,
+    token: dict = Depends(verify_token),
+    idempotency_key: Optional[str] = Header(None, alias='Idempotency-Key')
+):
+    """Clock in with geofencing validation and race condition protection
+    
+    Retries sent with the same Idempotency-Key replay the first successful response.
+    """
+    result, replayed = await idempotency_store.run(
+        firebase_db, idempotency_key, f"clock-in:{token['uid']}", {'shiftId': request.shiftId},
+        lambda: _clock_in(request, token)
+    )
+    _mark_replayed(response, replayed)
+    return result
+
+async def _clock_in(request: ClockInRequest, token: dict):
     uid = token['uid']
     
-    # Get shift details
-    shift_doc = firebase_db.collection('shifts').document(request.shiftId).get()
-    if not shift_doc.exists:
+    # Get shift details (today's shifts are served from the daily index)
+    shift_data = await _get_shift_data(request.shiftId)
+    if shift_data is None:
         raise HTTPException(status_code=404, detail="Shift not found")
     
-    shift_data = shift_doc.to_dict()
-    
     # Get store details for geofencing
-    store_doc = firebase_db.collection('stores').document(shift_data['storeId']).get()
-    if not store_doc.exists:
+    store_data = await _get_store_data(shift_data['storeId'])
+    if store_data is None:
         raise HTTPException(status_code=404, detail="Store not found")
     
-    store_data = store_doc.to_dict()
-    
     # Geofencing check
     distance = calculate_distance(
         request.lat, request.lng,
@@ -519,14 +877,15 @@ async def clock_in(request: ClockInRequest, token: dict = Depends(verify_token))
     # This prevents duplicate clock-ins when user taps button rapidly
     transaction = firebase_db.transaction()
     
-    @firestore.transactional
-    def clock_in_transaction(transaction):
+    # One active_sessions/{uid} lock document per open session: a keyed read that the
+    # transaction can lock, unlike a status query
+    session_ref = firebase_db.collection('active_sessions').document(uid)
+    
+    @async_transactional
+    async def clock_in_transaction(transaction):
         # Check if already clocked in within transaction
-        existing_attendance = list(firebase_db.collection('attendance').where(
-            'employeeId', '==', uid
-        ).where('status', '==', 'CLOCKED_IN').stream())
-        
-        if existing_attendance:
+        session_doc = await session_ref.get(transaction=transaction)
+        if session_doc.exists:
             raise HTTPException(status_code=400, detail="Already clocked in")
         
         # Create attendance record
@@ -539,41 +898,62 @@ async def clock_in(request: ClockInRequest, token: dict = Depends(verify_token))
             'shiftId': request.shiftId,
             'storeId': shift_data['storeId'],
             'storeName': shift_data['storeName'],
+            'tenantId': shift_data.get('tenantId', token.get('tenantId')),
             'clockInTime': now.isoformat(),
             'clockInLat': request.lat,
             'clockInLng': request.lng,
             'status': 'CLOCKED_IN',
+            'isSupervisor': shift_data.get('supervisorId') == uid,
             'createdAt': now.isoformat()
         }
         
         # Check if late (more than 15 minutes after shift start)
-        shift_start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-        shift_start_time = TIMEZONE.localize(shift_start_time.replace(tzinfo=None))
+        attendance_dict['isLate'], attendance_dict['lateByMinutes'] = lateness(shift_data, now, TIMEZONE)
         
-        if now > shift_start_time + timedelta(minutes=15):
-            attendance_dict['isLate'] = True
-            attendance_dict['lateByMinutes'] = int((now - shift_start_time).total_seconds() / 60)
-        else:
-            attendance_dict['isLate'] = False
-            attendance_dict['lateByMinutes'] = 0
-        
-        # Create within transaction (atomic operation)
+        # Create record and session lock within transaction (atomic operation)
         attendance_ref = firebase_db.collection('attendance').document(attendance_id)
         transaction.set(attendance_ref, attendance_dict)
+        transaction.set(session_ref, {
+            'employeeId': uid,
+            'attendanceId': attendance_id,
+            'shiftId': request.shiftId,
+            'storeId': shift_data['storeId'],
+            'tenantId': attendance_dict['tenantId'],
+            'clockInTime': attendance_dict['clockInTime']
+        })
         
         return attendance_dict
     
     # Execute transaction
-    result = clock_in_transaction(transaction)
+    result = await clock_in_transaction(transaction)
+    live_attendance.upsert(result['id'], result)
+    deadline_scheduler.cancel('no_show', request.shiftId)
+    _schedule_auto_clock_out(request.shiftId, shift_data)
     return result
 
 @api_router.post("/attendance/clock-out")
-async def clock_out(request: ClockOutRequest, token: dict = Depends(verify_token)):
-    """Clock out with geofencing validation"""
+async def clock_out(
+    request: ClockOutRequest,
+    response: Response,
+    token: dict = Depends(verify_token),
+    idempotency_key: Optional[str] = Header(None, alias='Idempotency-Key')
+):
+    """Clock out with geofencing validation
+    
+    Retries sent with the same Idempotency-Key replay the first successful response.
+    """
+    result, replayed = await idempotency_store.run(
+        firebase_db, idempotency_key, f"clock-out:{token['uid']}", {'attendanceId': request.attendanceId},
+        lambda: _clock_out(request, token)
+    )
+    _mark_replayed(response, replayed)
+    return result
+
+async def _clock_out(request: ClockOutRequest, token: dict):
     uid = token['uid']
     
     # Get attendance record
-    attendance_doc = firebase_db.collection('attendance').document(request.attendanceId).get()
+    attendance_doc = await firebase_db.collection('attendance').document(request.attendanceId).get()
     if not attendance_doc.exists:
         raise HTTPException(status_code=404, detail="Attendance record not found")
     
@@ -586,12 +966,10 @@ async def clock_out(request: ClockOutRequest, token: dict = Depends(verify_token
         raise HTTPException(status_code=400, detail="Already clocked out")
     
     # Get store details for geofencing
-    store_doc = firebase_db.collection('stores').document(attendance_data['storeId']).get()
-    if not store_doc.exists:
+    store_data = await _get_store_data(attendance_data['storeId'])
+    if store_data is None:
         raise HTTPException(status_code=404, detail="Store not found")
     
-    store_data = store_doc.to_dict()
-    
     # Geofencing check
     distance = calculate_distance(
         request.lat, request.lng,
@@ -605,71 +983,558 @@ async def clock_out(request: ClockOutRequest, token: dict = Depends(verify_token
             detail=f"You are {int(distance)}m away from the store. Must be within {store_radius}m to clock out."
         )
     
-    # Update attendance record
+    # Update the attendance record and its month's payroll aggregate in one transaction
     now = get_current_time()
-    firebase_db.collection('attendance').document(request.attendanceId).update({
+    attendance_ref = firebase_db.collection('attendance').document(request.attendanceId)
+    clock_out_fields = {
         'clockOutTime': now.isoformat(),
         'clockOutLat': request.lat,
         'clockOutLng': request.lng,
         'status': 'CLOCKED_OUT',
         'updatedAt': now.isoformat()
-    })
+    }
+    
+    def stage(transaction, state):
+        if state['docs'][attendance_ref.path]['status'] == 'CLOCKED_OUT':
+            raise HTTPException(status_code=400, detail="Already clocked out")
+        transaction.update(attendance_ref, clock_out_fields)
+        transaction.delete(firebase_db.collection('active_sessions').document(uid))
+        if request.attendanceId in state['attendance']:
+            state['attendance'][request.attendanceId].update(clock_out_fields)
+    
+    await payroll_aggregates.commit_with_aggregates(
+        firebase_db, attendance_data.get('tenantId'), uid,
+        [payroll_aggregates.month_key(attendance_data['clockInTime'])],
+        now, TIMEZONE, stage, read_refs=[attendance_ref]
+    )
+    live_attendance.remove(request.attendanceId)
+    if attendance_data.get('shiftId'):
+        deadline_scheduler.cancel('auto_clock_out', attendance_data['shiftId'])
+    await bump_payroll_version(firebase_db, attendance_data.get('tenantId'))
     
-    updated_doc = firebase_db.collection('attendance').document(request.attendanceId).get()
+    updated_doc = await firebase_db.collection('attendance').document(request.attendanceId).get()
     return {"id": request.attendanceId, **updated_doc.to_dict()}
 
+MAX_SYNC_EVENTS = 500           # Punch events accepted per sync request
+MAX_PUNCH_AGE_DAYS = 7          # Older offline punches are rejected
+CLOCK_SKEW_MINUTES = 5          # Tolerated device clock drift into the future
+SYNC_PROXY_ROLES = ['OWNER', 'CO', 'MANAGER', 'SUPERVISOR']  # May upload punches for other employees
+SYNC_COMMIT_CONCURRENCY = 10    # Employee transactions committed at once per sync
+
+def _offline_attendance_id(employee_id: str, client_id: str) -> str:
+    """Deterministic attendance ID for an offline clock-in, so re-uploads are detected"""
+    return "offline_" + hashlib.sha256(f"{employee_id}:{client_id}".encode('utf-8')).hexdigest()[:32]
+
+def _parse_punch_time(value: str) -> datetime:
+    punch_time = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if punch_time.tzinfo is None:
+        punch_time = TIMEZONE.localize(punch_time)
+    return punch_time.astimezone(TIMEZONE)
+
+@api_router.post("/attendance/sync-batch")
+async def sync_punch_batch(batch_request: SyncBatchRequest, token: dict = Depends(verify_token)):
+    """
+    Upload clock-in/clock-out punches queued offline
+    
+    Events are deduplicated by clientId (within the batch and against earlier
+    uploads), ordered by timestamp per employee and checked against their
+    store's geofence in one vectorized pass. Each employee's accepted punches
+    are committed in one transaction with their payroll aggregates; lateness
+    follows the clock-in rules. If the employee's open session changed
+    since it was read (a live punch racing the sync), none of their punches
+    are written and they are rejected for upload again. OWNER/CO/
+    MANAGER/SUPERVISOR may upload punches for other employees of their tenant
+    (a supervisor only for employees of their own store).
+    
+    Returns:
+        {'results': [{clientId, status: accepted|duplicate|rejected, reason, attendanceId,
+        isLate, lateByMinutes}], 'accepted': int}
+    """
+    events = batch_request.events
+    if len(events) > MAX_SYNC_EVENTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SYNC_EVENTS} events per sync")
+    
+    uid = token['uid']
+    user = await _resolve_user(token)
+    tenant_id = _tenant_scope(user)
+    can_proxy = user.get('isSuperAdmin') or (user.get('role') or '').upper() in SYNC_PROXY_ROLES
+    now = get_current_time()
+    
+    results = {}
+    pending = []  # (event, employee ID, punch time)
+    
+    def reject(event, reason):
+        results[event.clientId] = {'clientId': event.clientId, 'status': 'rejected', 'reason': reason}
+    
+    for event in events:
+        if event.clientId in results:
+            continue
+        results[event.clientId] = None
+        employee_id = event.employeeId or uid
+        
+        if employee_id != uid and not can_proxy:
+            reject(event, "Not allowed to upload punches for other employees")
+            continue
+        if event.type not in ('CLOCK_IN', 'CLOCK_OUT'):
+            reject(event, "Unknown punch type")
+            continue
+        if event.type == 'CLOCK_IN' and not event.shiftId:
+            reject(event, "shiftId is required for CLOCK_IN")
+            continue
+        try:
+            punch_time = _parse_punch_time(event.timestamp)
+        except ValueError:
+            reject(event, "Invalid timestamp")
+            continue
+        if punch_time > now + timedelta(minutes=CLOCK_SKEW_MINUTES):
+            reject(event, "Timestamp is in the future")
+            continue
+        if punch_time < now - timedelta(days=MAX_PUNCH_AGE_DAYS):
+            reject(event, f"Punch is older than {MAX_PUNCH_AGE_DAYS} days")
+            continue
+        
+        pending.append((event, employee_id, punch_time))
+    
+    # Proxied punches (any type) must target an employee of the caller's tenant, and of a supervisor's store
+    proxied = {employee_id for _, employee_id, _ in pending if employee_id != uid}
+    if proxied and not user.get('isSuperAdmin'):
+        employee_loader = DocumentLoader(firebase_db, 'users')
+        await employee_loader.prime(proxied)
+        is_supervisor = (user.get('role') or '').upper() == 'SUPERVISOR'
+        allowed = set()
+        for employee_id in proxied:
+            employee_data = await employee_loader.load(employee_id)
+            if employee_data is None or not user.get('tenantId') or employee_data.get('tenantId') != user.get('tenantId'):
+                continue
+            if is_supervisor and employee_data.get('assignedStoreId') != user.get('assignedStoreId'):
+                continue
+            allowed.add(employee_id)
+        for event, employee_id, _ in pending:
+            if employee_id != uid and employee_id not in allowed:
+                reject(event, "Employee not found")
+        pending = [item for item in pending if item[1] == uid or item[1] in allowed]
+    
+    # Load shifts, open sessions and every attendance record the batch can touch, in batched reads
+    shift_loader = ShiftLoader(firebase_db)
+    shifts = {}
+    for event, _, _ in pending:
+        if event.shiftId and event.shiftId not in shifts:
+            shifts[event.shiftId] = daily_index.get_shift(event.shiftId)
+    await shift_loader.prime(shift_id for shift_id, shift_data in shifts.items() if shift_data is None)
+    for shift_id in shifts:
+        if shifts[shift_id] is None:
+            shifts[shift_id] = await shift_loader.load(shift_id)
+    
+    session_loader = DocumentLoader(firebase_db, 'active_sessions')
+    await session_loader.prime(employee_id for _, employee_id, _ in pending)
+    
+    attendance_loader = DocumentLoader(firebase_db, 'attendance')
+    attendance_ids = set()
+    for event, employee_id, _ in pending:
+        if event.type == 'CLOCK_IN':
+            attendance_ids.add(_offline_attendance_id(employee_id, event.clientId))
+        elif event.attendanceId:
+            attendance_ids.add(event.attendanceId)
+        session = await session_loader.load(employee_id)
+        if session is not None:
+            attendance_ids.add(session.get('attendanceId'))
+    await attendance_loader.prime(attendance_ids)
+    
+    # Order per employee; a clock-in sorts before a clock-out with the same timestamp
+    by_employee = {}
+    for item in sorted(pending, key=lambda item: (item[2], item[0].type != 'CLOCK_IN')):
+        by_employee.setdefault(item[1], []).append(item)
+    
+    # Store each punch is checked against: the shift's for clock-ins, the open session's for clock-outs
+    punch_stores = {}
+    for employee_id, items in by_employee.items():
+        session = await session_loader.load(employee_id)
+        session_record = await attendance_loader.load(session.get('attendanceId')) if session else None
+        last_store_id = session_record.get('storeId') if session_record else None
+        for event, _, _ in items:
+            if event.type == 'CLOCK_IN':
+                shift_data = shifts.get(event.shiftId)
+                last_store_id = shift_data.get('storeId') if shift_data else None
+                punch_stores[event.clientId] = last_store_id
+            elif event.attendanceId:
+                explicit_record = await attendance_loader.load(event.attendanceId)
+                punch_stores[event.clientId] = explicit_record.get('storeId') if explicit_record else None
+            else:
+                punch_stores[event.clientId] = last_store_id
+    
+    stores = {}
+    for store_id in set(punch_stores.values()):
+        if store_id:
+            stores[store_id] = await _get_store_data(store_id)
+    
+    # Vectorized geofence check over every punch with a known store
+    checked = [
+        (event.clientId, event.lat, event.lng, stores[punch_stores[event.clientId]])
+        for event, _, _ in pending
+        if stores.get(punch_stores.get(event.clientId)) is not None
+    ]
+    distances = {}
+    if checked:
+        measured = haversine_pairs(
+            np.array([lat for _, lat, _, _ in checked], dtype=float),
+            np.array([lng for _, _, lng, _ in checked], dtype=float),
+            np.array([store_data['lat'] for _, _, _, store_data in checked], dtype=float),
+            np.array([store_data['lng'] for _, _, _, store_data in checked], dtype=float)
+        )
+        distances = {client_id: float(distance) for (client_id, _, _, _), distance in zip(checked, measured)}
+    
+    def geofence_error(event, action):
+        store_data = stores.get(punch_stores.get(event.clientId))
+        if store_data is None:
+            return "Store not found"
+        store_radius = store_data.get('radius', 10)
+        if distances[event.clientId] > store_radius:
+            return f"You were {int(distances[event.clientId])}m away from the store. Must be within {store_radius}m to {action}."
+        return None
+    
+    # Replay each employee's punches against their session state
+    writes = {}  # employee ID -> {(collection, doc ID) -> (op, data)}; later writes to a document replace or extend earlier ones
+    planned_sessions = {}  # employee ID -> open session's attendance ID the replay started from (None = no session)
+    opened = []
+    closed = []
+    
+    for employee_id, items in by_employee.items():
+        employee_writes = writes.setdefault(employee_id, {})
+        session = await session_loader.load(employee_id)
+        planned_sessions[employee_id] = session.get('attendanceId') if session else None
+        open_record = None
+        if session is not None:
+            session_data = await attendance_loader.load(session.get('attendanceId'))
+            if session_data is not None and session_data.get('status') == 'CLOCKED_IN':
+                open_record = {'id': session['attendanceId'], 'data': session_data}
+        last_record = None
+        
+        for event, _, punch_time in items:
+            if event.type == 'CLOCK_IN':
+                attendance_id = _offline_attendance_id(employee_id, event.clientId)
+                existing = await attendance_loader.load(attendance_id)
+                if existing is not None:
+                    results[event.clientId] = {'clientId': event.clientId, 'status': 'duplicate', 'attendanceId': attendance_id}
+                    last_record = {'id': attendance_id, 'data': existing}
+                    if existing.get('status') == 'CLOCKED_IN':
+                        open_record = last_record
+                    continue
+                
+                shift_data = shifts.get(event.shiftId)
+                if shift_data is None or (tenant_id is not None and shift_data.get('tenantId') != tenant_id):
+                    reject(event, "Shift not found")
+                    continue
+                if shift_data.get('employeeId') != employee_id:
+                    reject(event, "Shift belongs to another employee")
+                    continue
+                error = geofence_error(event, 'clock in')
+                if error:
+                    reject(event, error)
+                    continue
+                if open_record is not None:
+                    reject(event, "Already clocked in")
+                    continue
+                
+                is_late, late_by_minutes = lateness(shift_data, punch_time, TIMEZONE)
+                attendance_dict = {
+                    'id': attendance_id,
+                    'employeeId': employee_id,
+                    'employeeName': shift_data['employeeName'],
+                    'shiftId': event.shiftId,
+                    'storeId': shift_data['storeId'],
+                    'storeName': shift_data['storeName'],
+                    'tenantId': shift_data.get('tenantId', user.get('tenantId')),
+                    'clockInTime': punch_time.isoformat(),
+                    'clockInLat': event.lat,
+                    'clockInLng': event.lng,
+                    'status': 'CLOCKED_IN',
+                    'isSupervisor': shift_data.get('supervisorId') == employee_id,
+                    'isLate': is_late,
+                    'lateByMinutes': late_by_minutes,
+                    'offline': True,
+                    'clientId': event.clientId,
+                    'syncedAt': now.isoformat(),
+                    'createdAt': now.isoformat()
+                }
+                employee_writes[('attendance', attendance_id)] = ('set', attendance_dict)
+                employee_writes[('active_sessions', employee_id)] = ('set', {
+                    'employeeId': employee_id,
+                    'attendanceId': attendance_id,
+                    'shiftId': event.shiftId,
+                    'storeId': shift_data['storeId'],
+                    'tenantId': attendance_dict['tenantId'],
+                    'clockInTime': attendance_dict['clockInTime']
+                })
+                open_record = last_record = {'id': attendance_id, 'data': attendance_dict}
+                opened.append(open_record)
+                results[event.clientId] = {
+                    'clientId': event.clientId, 'status': 'accepted', 'attendanceId': attendance_id,
+                    'isLate': is_late, 'lateByMinutes': late_by_minutes
+                }
+            else:
+                target = open_record
+                if event.attendanceId and (target is None or target['id'] != event.attendanceId):
+                    explicit_record = await attendance_loader.load(event.attendanceId)
+                    if explicit_record is not None and explicit_record.get('clockOutClientId') == event.clientId:
+                        results[event.clientId] = {'clientId': event.clientId, 'status': 'duplicate', 'attendanceId': event.attendanceId}
+                    else:
+                        reject(event, "Attendance record is not the open session")
+                    continue
+                if target is None:
+                    if last_record is not None and last_record['data'].get('clockOutClientId') == event.clientId:
+                        results[event.clientId] = {'clientId': event.clientId, 'status': 'duplicate', 'attendanceId': last_record['id']}
+                    else:
+                        reject(event, "No open session to clock out")
+                    continue
+                error = geofence_error(event, 'clock out')
+                if error:
+                    reject(event, error)
+                    continue
+                if punch_time.isoformat() < target['data']['clockInTime']:
+                    reject(event, "Clock-out is before clock-in")
+                    continue
+                
+                clock_out_fields = {
+                    'clockOutTime': punch_time.isoformat(),
+                    'clockOutLat': event.lat,
+                    'clockOutLng': event.lng,
+                    'status': 'CLOCKED_OUT',
+                    'clockOutClientId': event.clientId,
+                    'updatedAt': now.isoformat()
+                }
+                closed.append((target['id'], dict(target['data']), punch_time.isoformat()))
+                if employee_writes.get(('attendance', target['id']), (None,))[0] == 'set':
+                    target['data'].update(clock_out_fields)
+                else:
+                    employee_writes[('attendance', target['id'])] = ('update', clock_out_fields)
+                employee_writes[('active_sessions', employee_id)] = ('delete', None)
+                open_record = None
+                results[event.clientId] = {'clientId': event.clientId, 'status': 'accepted', 'attendanceId': target['id']}
+    
+    # Commit each employee's punches together with their payroll aggregates in one transaction
+    closed_records = {attendance_id: att_data for attendance_id, att_data, _ in closed}
+    known_shifts = {shift_id: shift_data for shift_id, shift_data in shifts.items() if shift_data is not None}
+    semaphore = asyncio.Semaphore(SYNC_COMMIT_CONCURRENCY)
+    conflicted = set()  # Employees whose session changed (live punch, concurrent sync) since it was read
+    
+    async def commit_employee(employee_id, employee_writes):
+        records = [
+            data if op == 'set' else closed_records[doc_id]
+            for (collection, doc_id), (op, data) in employee_writes.items() if collection == 'attendance'
+        ]
+        session_ref = firebase_db.collection('active_sessions').document(employee_id)
+        
+        def stage(transaction, state):
+            # The replay assumed this session; a different one means its punches would
+            # clobber a live clock-in/out, so nothing is written
+            session = state['docs'][session_ref.path]
+            if (session.get('attendanceId') if session else None) != planned_sessions[employee_id]:
+                return False
+            for (collection, doc_id), (op, data) in employee_writes.items():
+                ref = firebase_db.collection(collection).document(doc_id)
+                if op == 'set':
+                    transaction.set(ref, data)
+                elif op == 'update':
+                    transaction.update(ref, data)
+                else:
+                    transaction.delete(ref)
+                if collection != 'attendance':
+                    continue
+                if op == 'set':
+                    state['attendance'][doc_id] = dict(data)
+                elif doc_id in state['attendance']:
+                    state['attendance'][doc_id].update(data)
+            # Shifts of new late records may be outside the months read
+            for shift_id, shift_data in known_shifts.items():
+                state['extra_shifts'].setdefault(shift_id, shift_data)
+            return True
+        
+        async with semaphore:
+            committed, _ = await payroll_aggregates.commit_with_aggregates(
+                firebase_db, records[0].get('tenantId'), employee_id,
+                [payroll_aggregates.month_key(record['clockInTime']) for record in records],
+                now, TIMEZONE, stage, read_refs=[session_ref]
+            )
+        if not committed:
+            conflicted.add(employee_id)
+    
+    await asyncio.gather(*(
+        commit_employee(employee_id, employee_writes)
+        for employee_id, employee_writes in writes.items() if employee_writes
+    ))
+    
+    # Punches of conflicted employees were not written; the client uploads them again
+    if conflicted:
+        for event, employee_id, _ in pending:
+            if employee_id in conflicted and results[event.clientId]['status'] == 'accepted':
+                reject(event, "Session changed while syncing, upload again")
+        opened = [record for record in opened if record['data']['employeeId'] not in conflicted]
+        closed = [item for item in closed if item[1].get('employeeId') not in conflicted]
+    
+    # Keep in-memory views and deadlines in step
+    for record in opened:
+        if record['data']['status'] == 'CLOCKED_IN':
+            live_attendance.upsert(record['id'], record['data'])
+            deadline_scheduler.cancel('no_show', record['data']['shiftId'])
+            _schedule_auto_clock_out(record['data']['shiftId'], shifts[record['data']['shiftId']])
+    for attendance_id, att_data, _ in closed:
+        live_attendance.remove(attendance_id)
+        if att_data.get('shiftId'):
+            deadline_scheduler.cancel('auto_clock_out', att_data['shiftId'])
+    if closed:
+        await bump_payroll_versions(firebase_db, (att_data.get('tenantId') for _, att_data, _ in closed))
+    
+    ordered_results = [results[client_id] for client_id in dict.fromkeys(event.clientId for event in events)]
+    return {
+        'results': ordered_results,
+        'accepted': sum(1 for result in ordered_results if result['status'] == 'accepted')
+    }
+
+@api_router.post("/attendance/locate")
+async def locate_store(request: LocateRequest, token: dict = Depends(verify_token)):
+    """
+    Find the store whose geofence contains a coordinate
+    
+    Searches every store of the caller's tenant (all tenants for super admins).
+    When no geofence contains the point, the nearest store is returned with
+    withinGeofence = false.
+    """
+    tenant_id = _tenant_scope(await _resolve_user(token))
+    match = store_locator.locate(
+        tenant_id, request.lat, request.lng,
+        daily_index.stores_version, daily_index.stores
+    )
+    if match is None:
+        raise HTTPException(status_code=404, detail="No stores found")
+    return match
+
+@api_router.get("/attendance/count")
+async def get_open_attendance_count(user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER', 'SUPERVISOR']))):
+    """Get the number of open (clocked-in) attendance records in the tenant"""
+    return {'count': await count_open_attendance(firebase_db, _tenant_scope(user))}
+
 @api_router.get("/attendance/currently-working-by-store")
 async def get_currently_working_by_store(token: dict = Depends(verify_token)):
-    """Get employees currently working, grouped by store"""
-    # Get all active attendance records
-    active_attendance = list(firebase_db.collection('attendance').where(
-        'status', '==', 'CLOCKED_IN'
-    ).stream())
-    
-    # Group by store
-    stores_map = {}
-    for att in active_attendance:
-        att_data = att.to_dict()
-        store_id = att_data.get('storeId')
-        
-        if store_id not in stores_map:
-            stores_map[store_id] = {
-                'storeId': store_id,
-                'storeName': att_data.get('storeName', 'Unknown Store'),
-                'employees': [],
-                'employeeCount': 0
-            }
-        
-        # Check if employee is a supervisor on this shift
-        shift_id = att_data.get('shiftId')
-        is_supervisor = False
-        if shift_id:
-            shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-            if shift_doc.exists:
-                shift_data = shift_doc.to_dict()
-                if shift_data.get('supervisorId') == att_data.get('employeeId'):
-                    is_supervisor = True
-        
-        stores_map[store_id]['employees'].append({
-            'id': att_data.get('employeeId'),
-            'employeeName': att_data.get('employeeName'),
-            'isSupervisor': is_supervisor
-        })
-        stores_map[store_id]['employeeCount'] += 1
+    """Get employees currently working, grouped by store (served from the live attendance view)"""
+    # Super admins and single-tenant (pre-migration) tokens see every store
+    tenant_id = None if token.get('role') == 'superadmin' else token.get('tenantId')
+    return live_attendance.stores(tenant_id)
+
+SSE_RETRY_MS = 3000  # Client reconnect delay advertised in the stream
+
+async def _today_snapshot(tenant_id: Optional[str], store_id: Optional[str]) -> dict:
+    """Today's attendance and shifts for a tenant/store scope (same shape as the polling endpoints)"""
+    today = get_current_time().date()
+    start_of_day = datetime.combine(today, time.min)
+    end_of_day = start_of_day + timedelta(days=1)
+    
+    attendance_ref = firebase_db.collection('attendance')
+    shifts_ref = firebase_db.collection('shifts').where('date', '==', today.isoformat())
+    if tenant_id is not None:
+        attendance_ref = attendance_ref.where('tenantId', '==', tenant_id)
+        shifts_ref = shifts_ref.where('tenantId', '==', tenant_id)
+    if store_id:
+        attendance_ref = attendance_ref.where('storeId', '==', store_id)
+        shifts_ref = shifts_ref.where('storeId', '==', store_id)
+    attendance_ref = attendance_ref.where(
+        'clockInTime', '>=', start_of_day.isoformat()
+    ).where('clockInTime', '<', end_of_day.isoformat())
+    
+    return {
+        'attendance': [{"id": doc.id, **doc.to_dict()} async for doc in attendance_ref.stream()],
+        'shifts': [{"id": doc.id, **doc.to_dict()} async for doc in shifts_ref.stream()],
+        'today': today.isoformat()
+    }
+
+@api_router.get("/events/attendance")
+async def stream_attendance_events(
+    request: Request,
+    storeId: Optional[str] = None,
+    cursor: Optional[str] = None,
+    token: dict = Depends(verify_token)
+):
+    """
+    Server-sent event stream of today's attendance and shift changes
+    
+    Sends a `snapshot` event (today's attendance and shifts in the caller's
+    tenant, optionally one store), then a `change` event for each write and a
+    heartbeat comment when idle. Reconnect with the Last-Event-ID header (or
+    ?cursor=) to resume; a new `snapshot` is sent when the cursor can't be
+    resumed or the day rolls over.
+    """
+    tenant_id = _tenant_scope(await _resolve_user(token))
+    last_event_id = request.headers.get('Last-Event-ID') or cursor
     
-    return list(stores_map.values())
+    async def generate_events():
+        waiter = change_feed.register()
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            
+            seq = change_feed.parse_cursor(last_event_id)
+            needs_snapshot = seq is None or change_feed.events_since(seq) is None
+            
+            while not await request.is_disconnected():
+                if needs_snapshot:
+                    # Take the cursor first: changes racing the snapshot are replayed, not lost
+                    seq = change_feed.parse_cursor(change_feed.cursor())
+                    snapshot = await _today_snapshot(tenant_id, storeId)
+                    yield sse_message('snapshot', snapshot, f"{change_feed.epoch}:{seq}")
+                    needs_snapshot = False
+                
+                waiter.clear()
+                events = change_feed.events_since(seq)
+                if events is None:
+                    needs_snapshot = True
+                    continue
+                
+                for event in events:
+                    seq = event['seq']
+                    if not change_feed.matches(event, tenant_id, storeId):
+                        continue
+                    if event['kind'] == 'day':
+                        needs_snapshot = True
+                        break
+                    yield sse_message('change', {
+                        'kind': event['kind'],
+                        'op': event['op'],
+                        'id': event['id'],
+                        'data': event['data']
+                    }, f"{change_feed.epoch}:{seq}")
+                
+                if needs_snapshot:
+                    continue
+                
+                try:
+                    await asyncio.wait_for(waiter.wait(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+        finally:
+            change_feed.unregister(waiter)
+    
+    return StreamingResponse(
+        generate_events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 @api_router.post("/attendance/auto-clock-out")
 async def auto_clock_out_expired(user: dict = Depends(require_role(['OWNER', 'CO']))):
-    """Auto clock out employees whose shift has ended - OWNER/CO only"""
+    """Auto clock out employees whose shift has ended (except on overtime days) - OWNER/CO only"""
     now = get_current_time()
     
     # Get all active attendance records
-    active_records = list(firebase_db.collection('attendance').where(
+    active_records = [doc async for doc in firebase_db.collection('attendance').where(
         'status', '==', 'CLOCKED_IN'
-    ).stream())
+    ).stream()]
     
-    auto_clocked_out = []
+    shift_loader = ShiftLoader(firebase_db)
+    await shift_loader.prime(record.to_dict().get('shiftId') for record in active_records)
+    
+    overtime = {}  # (tenant ID, date) -> overtime enabled
+    closing = {}
     
     for record in active_records:
         record_data = record.to_dict()
@@ -679,27 +1544,42 @@ async def auto_clock_out_expired(user: dict = Depends(require_role(['OWNER', 'CO
             continue
         
         # Get shift end time
-        shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-        if not shift_doc.exists:
+        shift_data = await shift_loader.load(shift_id)
+        if shift_data is None:
             continue
         
-        shift_data = shift_doc.to_dict()
-        shift_end = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
-        shift_end = TIMEZONE.localize(shift_end.replace(tzinfo=None))
-        
         # Auto clock out if shift ended more than 1 hour ago
-        if now > shift_end + timedelta(hours=1):
-            firebase_db.collection('attendance').document(record.id).update({
-                'clockOutTime': shift_end.isoformat(),
-                'status': 'CLOCKED_OUT',
-                'autoClockOut': True,
-                'updatedAt': now.isoformat()
-            })
-            auto_clocked_out.append({
-                'employeeName': record_data.get('employeeName'),
-                'storeName': record_data.get('storeName'),
-                'shiftEnd': shift_end.isoformat()
-            })
+        shift_end = _shift_time(shift_data, 'endTime')
+        if now <= shift_end + AUTO_CLOCK_OUT_AFTER:
+            continue
+        overtime_key = (record_data.get('tenantId'), shift_data['date'])
+        if overtime_key not in overtime:
+            overtime[overtime_key] = await _overtime_enabled(*overtime_key)
+        if overtime[overtime_key]:
+            continue
+        
+        closing[record.id] = (record_data, shift_end)
+    
+    # One transaction per record: the clock-out and its payroll aggregate commit together
+    runner = TransactionRunner()
+    for record_id, (record_data, shift_end) in closing.items():
+        runner.run(_commit_auto_clock_out, record_id, record_data, shift_end, now, tag=record_id, ops=3)
+    result = await runner.close()
+    for record_id, error in result.failed:
+        print(f"✗ Failed to auto clock out attendance {record_id}: {error}")
+    closed = [record_id for record_id in closing if result.values.get(record_id)]
+    
+    auto_clocked_out = []
+    for record_id in closed:
+        record_data, shift_end = closing[record_id]
+        live_attendance.remove(record_id)
+        deadline_scheduler.cancel('auto_clock_out', record_data['shiftId'])
+        auto_clocked_out.append({
+            'employeeName': record_data.get('employeeName'),
+            'storeName': record_data.get('storeName'),
+            'shiftEnd': shift_end.isoformat()
+        })
+    await bump_payroll_versions(firebase_db, (closing[record_id][0].get('tenantId') for record_id in closed))
     
     return {
         'message': f'Auto clocked out {len(auto_clocked_out)} employees',
@@ -712,7 +1592,7 @@ async def detect_no_shows(user: dict = Depends(require_role(['OWNER', 'CO']))):
     CRITICAL FIX: Auto-detect no-shows for shifts with no attendance
     
     This endpoint should be called by a cron job every 30 minutes.
-    It checks all shifts that started more than 30 minutes ago and have no attendance record.
+    It checks shifts that started more than 30 minutes ago (since the last run) and have no attendance record.
     Creates a no-show attendance record with penalty flag.
     
     Usage:
@@ -746,75 +1626,9 @@ async def detect_no_shows_internal(request: Request):
 
 async def _detect_no_shows_logic():
     now = get_current_time()
-    no_show_threshold = now - timedelta(minutes=30)  # 30 min after shift start
     
-    # Get all shifts that started more than 30 minutes ago
-    all_shifts = list(firebase_db.collection('shifts').stream())
-    
-    no_shows_detected = []
-    
-    for shift in all_shifts:
-        shift_data = shift.to_dict()
-        shift_id = shift_data.get('id')
-        employee_id = shift_data.get('employeeId')
-        
-        if not shift_id or not employee_id:
-            continue
-        
-        # Parse shift start time
-        try:
-            shift_start = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-            shift_start = TIMEZONE.localize(shift_start.replace(tzinfo=None))
-        except Exception as e:
-            print(f"Error parsing shift time: {e}")
-            continue
-        
-        # Only process shifts that started more than 30 minutes ago
-        if shift_start > no_show_threshold:
-            continue
-        
-        # Check if attendance record exists for this shift
-        attendance_records = list(firebase_db.collection('attendance').where(
-            'shiftId', '==', shift_id
-        ).stream())
-        
-        # If no attendance record exists, mark as no-show
-        if not attendance_records:
-            # Check if we already created a no-show record (idempotent)
-            existing_no_show = list(firebase_db.collection('attendance').where(
-                'shiftId', '==', shift_id
-            ).where('noShow', '==', True).stream())
-            
-            if not existing_no_show:
-                # Create no-show attendance record
-                no_show_dict = {
-                    'id': str(uuid.uuid4()),
-                    'employeeId': employee_id,
-                    'employeeName': shift_data.get('employeeName', 'Unknown'),
-                    'shiftId': shift_id,
-                    'storeId': shift_data.get('storeId', ''),
-                    'storeName': shift_data.get('storeName', 'Unknown Store'),
-                    'status': 'NO_SHOW',
-                    'noShow': True,
-                    'clockInTime': None,
-                    'clockOutTime': None,
-                    'isLate': False,
-                    'lateByMinutes': 0,
-                    'createdAt': now.isoformat(),
-                    'detectedAt': now.isoformat(),
-                    'autoDetected': True
-                }
-                
-                # Save no-show record
-                firebase_db.collection('attendance').document(no_show_dict['id']).set(no_show_dict)
-                
-                no_shows_detected.append({
-                    'employeeId': employee_id,
-                    'employeeName': shift_data.get('employeeName'),
-                    'storeName': shift_data.get('storeName'),
-                    'shiftDate': shift_data.get('date'),
-                    'shiftStartTime': shift_data.get('startTime')
-                })
+    # Only shifts that became eligible since each tenant's last run are scanned
+    no_shows_detected = await no_shows.detect_no_shows(firebase_db, now, TIMEZONE)
     
     return {
         'message': f'Detected {len(no_shows_detected)} no-shows',
@@ -822,48 +1636,183 @@ async def _detect_no_shows_logic():
         'timestamp': now.isoformat()
     }
 
+# ==================== DEADLINE SCHEDULER ====================
+
+AUTO_CLOCK_OUT_AFTER = timedelta(hours=1)  # Open sessions are closed 1 hour after shift end
+
+def _shift_time(shift_data: dict, field: str) -> datetime:
+    """Localized shift startTime/endTime"""
+    value = datetime.fromisoformat(f"{shift_data['date']}T{shift_data[field]}")
+    return TIMEZONE.localize(value.replace(tzinfo=None))
+
+async def _overtime_enabled(tenant_id: Optional[str], date: str) -> bool:
+    """Whether the tenant turned on overtime (no auto clock-out) for a date"""
+    if not tenant_id:
+        return False
+    overtime_doc = await firebase_db.collection('tenants').document(tenant_id).collection('overtime').document(date).get()
+    return overtime_doc.exists and overtime_doc.to_dict().get('enabled', False)
+
+def _auto_clock_out_fields(shift_end: datetime, now: datetime) -> dict:
+    return {
+        'clockOutTime': shift_end.isoformat(),
+        'status': 'CLOCKED_OUT',
+        'autoClockOut': True,
+        'updatedAt': now.isoformat()
+    }
+
+async def _commit_auto_clock_out(record_id: str, record_data: dict, shift_end: datetime, now: datetime) -> bool:
+    """
+    Close an open attendance record at its shift end, with its payroll aggregate, in one transaction
+    
+    Returns:
+        False if the record was no longer open
+    """
+    attendance_ref = firebase_db.collection('attendance').document(record_id)
+    fields = _auto_clock_out_fields(shift_end, now)
+    
+    def stage(transaction, state):
+        current = state['docs'][attendance_ref.path]
+        if current is None or current.get('status') != 'CLOCKED_IN':
+            return False
+        transaction.update(attendance_ref, fields)
+        transaction.delete(firebase_db.collection('active_sessions').document(record_data['employeeId']))
+        if record_id in state['attendance']:
+            state['attendance'][record_id].update(fields)
+        return True
+    
+    closed, _ = await payroll_aggregates.commit_with_aggregates(
+        firebase_db, record_data.get('tenantId'), record_data['employeeId'],
+        [payroll_aggregates.month_key(record_data['clockInTime'])],
+        now, TIMEZONE, stage, read_refs=[attendance_ref]
+    )
+    return closed
+
+async def _auto_clock_out_record(record_id: str, record_data: dict, shift_data: dict, now: datetime) -> Optional[dict]:
+    """Close an open attendance record at its shift end (None if overtime is on or it was already closed)"""
+    if await _overtime_enabled(record_data.get('tenantId'), shift_data['date']):
+        return None
+    
+    shift_end = _shift_time(shift_data, 'endTime')
+    if not await _commit_auto_clock_out(record_id, record_data, shift_end, now):
+        return None
+    live_attendance.remove(record_id)
+    await bump_payroll_version(firebase_db, record_data.get('tenantId'))
+    return {
+        'employeeName': record_data.get('employeeName'),
+        'storeName': record_data.get('storeName'),
+        'shiftEnd': shift_end.isoformat()
+    }
+
+def _schedule_no_show(shift_id: str, shift_data: dict):
+    shift_start = no_shows.shift_start(shift_data, TIMEZONE)
+    if shift_start is not None and shift_data.get('employeeId'):
+        deadline_scheduler.schedule('no_show', shift_id, shift_start + timedelta(minutes=NO_SHOW_GRACE_MINUTES))
+
+def _schedule_auto_clock_out(shift_id: str, shift_data: dict):
+    try:
+        deadline_scheduler.schedule('auto_clock_out', shift_id, _shift_time(shift_data, 'endTime') + AUTO_CLOCK_OUT_AFTER)
+    except (KeyError, ValueError):
+        pass
+
+async def _deadline_no_show(shift_id: str):
+    """No-show deadline: mark the shift as a no-show if it still has no attendance"""
+    shift_data = await ShiftLoader(firebase_db).load(shift_id)
+    if shift_data is None or not shift_data.get('employeeId'):
+        return
+    if shift_id in await no_shows.shifts_with_attendance(firebase_db, [shift_id]):
+        return
+    await no_shows.mark_no_show(firebase_db, shift_id, shift_data, get_current_time(), TIMEZONE)
+
+async def _deadline_auto_clock_out(shift_id: str):
+    """Auto clock-out deadline: close the shift's sessions that are still open"""
+    shift_data = await ShiftLoader(firebase_db).load(shift_id)
+    if shift_data is None:
+        return
+    
+    open_records = [doc async for doc in firebase_db.collection('attendance').where(
+        'shiftId', '==', shift_id
+    ).where('status', '==', 'CLOCKED_IN').stream()]
+    
+    now = get_current_time()
+    for record in open_records:
+        await _auto_clock_out_record(record.id, record.to_dict(), shift_data, now)
+
+async def seed_deadlines():
+    """Schedule no-show checks for today's unattended shifts and auto clock-out for every open session"""
+    today_shifts = {doc.id: doc.to_dict() async for doc in firebase_db.collection('shifts').where(
+        'date', '==', get_current_time().date().isoformat()
+    ).stream()}
+    attended = await no_shows.shifts_with_attendance(firebase_db, today_shifts.keys())
+    for shift_id, shift_data in today_shifts.items():
+        if shift_id not in attended:
+            _schedule_no_show(shift_id, shift_data)
+    
+    open_records = [doc.to_dict() async for doc in firebase_db.collection('attendance').where(
+        'status', '==', 'CLOCKED_IN'
+    ).stream()]
+    shift_loader = ShiftLoader(firebase_db)
+    await shift_loader.prime(record.get('shiftId') for record in open_records)
+    for record in open_records:
+        shift_data = await shift_loader.load(record.get('shiftId'))
+        if shift_data is not None:
+            _schedule_auto_clock_out(record['shiftId'], shift_data)
+
+deadline_scheduler.register('no_show', _deadline_no_show)
+deadline_scheduler.register('auto_clock_out', _deadline_auto_clock_out)
+
 # ==================== STORE ROUTES ====================
 
 @api_router.get("/stores")
-async def get_stores(token: dict = Depends(verify_token)):
-    """Get all stores"""
-    stores = firebase_db.collection('stores').stream()
+async def get_stores(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    token: dict = Depends(verify_token)
+):
+    """Get all stores, ordered by ID
+    
+    Paginated with limit/cursor (next cursor in the X-Next-Page-Token header);
+    fields= limits the returned fields.
+    """
+    stores_ref = firebase_db.collection('stores')
+    stores, next_cursor = await paginate(stores_ref, stores_ref, [], limit, cursor, parse_fields(fields))
+    set_next_page_token(response, next_cursor)
     return [{"id": store.id, **store.to_dict()} for store in stores]
 
 @api_router.get("/stores/count")
 async def get_store_count(user: dict = Depends(require_role(['OWNER', 'CO']))):
-    """Get store count and max limit - OWNER/CO only"""
-    stores = list(firebase_db.collection('stores').stream())
-    count = len(stores)
-    max_stores = 50
+    """Get the tenant's store count and max limit - OWNER/CO only"""
+    count = await count_stores(firebase_db, _tenant_scope(user))
     
     return {
         'count': count,
-        'max': max_stores,
-        'canAdd': count < max_stores
+        'max': MAX_STORES,
+        'canAdd': count < MAX_STORES
     }
 
 @api_router.post("/stores")
 async def create_store(store_data: StoreCreate, user: dict = Depends(require_role(['OWNER']))):
     """Create a new store - OWNER only"""
     # Check store limit
-    stores = list(firebase_db.collection('stores').stream())
-    if len(stores) >= 50:
-        raise HTTPException(status_code=400, detail="Maximum store limit (50) reached")
+    if await count_stores(firebase_db, _tenant_scope(user)) >= MAX_STORES:
+        raise HTTPException(status_code=400, detail=f"Maximum store limit ({MAX_STORES}) reached")
     
     store_dict = store_data.dict()
     store_dict['id'] = str(uuid.uuid4())
+    store_dict['tenantId'] = user.get('tenantId')
     store_dict['createdAt'] = get_current_time().isoformat()
     store_dict['updatedAt'] = get_current_time().isoformat()
     
-    firebase_db.collection('stores').document(store_dict['id']).set(store_dict)
+    await firebase_db.collection('stores').document(store_dict['id']).set(store_dict)
+    daily_index.put_store(store_dict['id'], store_dict)
     return store_dict
 
 @api_router.put("/stores/{store_id}")
 async def update_store(store_id: str, store_data: StoreCreate, user: dict = Depends(require_role(['OWNER']))):
     """Update a store - OWNER only"""
     store_ref = firebase_db.collection('stores').document(store_id)
-    store_doc = store_ref.get()
+    store_doc = await store_ref.get()
     
     if not store_doc.exists:
         raise HTTPException(status_code=404, detail="Store not found")
@@ -871,15 +1820,17 @@ async def update_store(store_id: str, store_data: StoreCreate, user: dict = Depe
     update_data = store_data.dict()
     update_data['updatedAt'] = get_current_time().isoformat()
     
-    store_ref.update(update_data)
+    await store_ref.update(update_data)
     
-    updated_doc = store_ref.get()
+    updated_doc = await store_ref.get()
+    daily_index.put_store(store_id, updated_doc.to_dict())
     return {"id": store_id, **updated_doc.to_dict()}
 
 @api_router.delete("/stores/{store_id}")
 async def delete_store(store_id: str, user: dict = Depends(require_role(['OWNER']))):
     """Delete a store - OWNER only"""
-    firebase_db.collection('stores').document(store_id).delete()
+    await firebase_db.collection('stores').document(store_id).delete()
+    daily_index.remove_store(store_id)
     return {"message": "Store deleted successfully"}
 
 # ==================== INGREDIENT ROUTES ====================
@@ -892,7 +1843,7 @@ async def get_ingredients(storeId: Optional[str] = None, token: dict = Depends(v
     if storeId:
         ingredients_ref = ingredients_ref.where('storeId', '==', storeId)
     
-    ingredients = list(ingredients_ref.stream())
+    ingredients = [doc async for doc in ingredients_ref.stream()]
     return [{"id": ing.id, **ing.to_dict()} for ing in ingredients]
 
 @api_router.post("/ingredients")
@@ -903,14 +1854,14 @@ async def create_ingredient(ingredient_data: IngredientCreate, user: dict = Depe
     ingredient_dict['createdAt'] = get_current_time().isoformat()
     ingredient_dict['updatedAt'] = get_current_time().isoformat()
     
-    firebase_db.collection('ingredients').document(ingredient_dict['id']).set(ingredient_dict)
+    await firebase_db.collection('ingredients').document(ingredient_dict['id']).set(ingredient_dict)
     return ingredient_dict
 
 @api_router.put("/ingredients/{ingredient_id}")
 async def update_ingredient(ingredient_id: str, ingredient_data: IngredientCreate, user: dict = Depends(require_role(['OWNER']))):
     """Update an ingredient - OWNER only"""
     ingredient_ref = firebase_db.collection('ingredients').document(ingredient_id)
-    ingredient_doc = ingredient_ref.get()
+    ingredient_doc = await ingredient_ref.get()
     
     if not ingredient_doc.exists:
         raise HTTPException(status_code=404, detail="Ingredient not found")
@@ -918,15 +1869,15 @@ async def update_ingredient(ingredient_id: str, ingredient_data: IngredientCreat
     update_data = ingredient_data.dict()
     update_data['updatedAt'] = get_current_time().isoformat()
     
-    ingredient_ref.update(update_data)
+    await ingredient_ref.update(update_data)
     
-    updated_doc = ingredient_ref.get()
+    updated_doc = await ingredient_ref.get()
     return {"id": ingredient_id, **updated_doc.to_dict()}
 
 @api_router.delete("/ingredients/{ingredient_id}")
 async def delete_ingredient(ingredient_id: str, user: dict = Depends(require_role(['OWNER']))):
     """Delete an ingredient - OWNER only"""
-    firebase_db.collection('ingredients').document(ingredient_id).delete()
+    await firebase_db.collection('ingredients').document(ingredient_id).delete()
     return {"message": "Ingredient deleted successfully"}
 
 @api_router.post("/ingredient-counts")
@@ -935,11 +1886,7 @@ async def submit_ingredient_count(count_data: IngredientCountCreate, token: dict
     uid = token['uid']
     
     # Get user details
-    user_doc = firebase_db.collection('users').document(uid).get()
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_data = user_doc.to_dict()
+    user_data = await get_user_document(uid, firebase_db)
     
     # Verify user has access to this store (for supervisor role)
     if user_data.get('role') == 'SUPERVISOR' and user_data.get('assignedStoreId') != count_data.storeId:
@@ -952,18 +1899,27 @@ async def submit_ingredient_count(count_data: IngredientCountCreate, token: dict
     count_dict['submittedAt'] = get_current_time().isoformat()
     count_dict['date'] = get_current_time().date().isoformat()
     
-    firebase_db.collection('ingredient_counts').document(count_dict['id']).set(count_dict)
+    await firebase_db.collection('ingredient_counts').document(count_dict['id']).set(count_dict)
     return count_dict
 
 @api_router.get("/ingredient-counts")
 async def get_ingredient_counts(
+    response: Response,
     storeId: Optional[str] = None,
     ingredientId: Optional[str] = None,
     date: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
     token: dict = Depends(verify_token)
 ):
-    """Get ingredient counts with optional filters"""
-    counts_ref = firebase_db.collection('ingredient_counts')
+    """Get ingredient counts with optional filters, ordered by ID
+    
+    Paginated with limit/cursor (next cursor in the X-Next-Page-Token header);
+    fields= limits the returned fields.
+    """
+    counts_col = firebase_db.collection('ingredient_counts')
+    counts_ref = counts_col
     
     if storeId:
         counts_ref = counts_ref.where('storeId', '==', storeId)
@@ -972,24 +1928,32 @@ async def get_ingredient_counts(
     if date:
         counts_ref = counts_ref.where('date', '==', date)
     
-    counts = list(counts_ref.stream())
+    counts, next_cursor = await paginate(counts_ref, counts_col, [], limit, cursor, parse_fields(fields))
+    set_next_page_token(response, next_cursor)
     return [{"id": count.id, **count.to_dict()} for count in counts]
 
 # ==================== LEAVE REQUEST ROUTES ====================
 
 @api_router.get("/leave-requests")
-async def get_leave_requests(status: Optional[str] = None, token: dict = Depends(verify_token)):
-    """Get leave requests - employees see their own, managers see all"""
-    uid = token['uid']
-    user_doc = firebase_db.collection('users').document(uid).get()
-    
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="User not found")
+async def get_leave_requests(
+    response: Response,
+    status: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    token: dict = Depends(verify_token)
+):
+    """Get leave requests - employees see their own, managers see all
     
-    user_data = user_doc.to_dict()
+    Newest first. Paginated with limit/cursor (next cursor in the
+    X-Next-Page-Token header); fields= limits the returned fields.
+    """
+    uid = token['uid']
+    user_data = await get_user_document(uid, firebase_db)
     user_role = user_data.get('role', '').upper()
     
-    leaves_ref = firebase_db.collection('leave_requests')
+    leaves_col = firebase_db.collection('leave_requests')
+    leaves_ref = leaves_col
     
     # Regular employees only see their own requests
     if user_role not in ['OWNER', 'CO', 'MANAGER']:
@@ -999,26 +1963,31 @@ async def get_leave_requests(status: Optional[str] = None, token: dict = Depends
     if status:
         leaves_ref = leaves_ref.where('status', '==', status.upper())
     
-    leaves = list(leaves_ref.stream())
+    leaves, next_cursor = await paginate(leaves_ref, leaves_col, ['-createdAt'], limit, cursor, parse_fields(fields))
+    set_next_page_token(response, next_cursor)
     return [{"id": leave.id, **leave.to_dict()} for leave in leaves]
 
+@api_router.get("/leave-requests/count")
+async def get_pending_leave_count(user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER']))):
+    """Get the number of pending leave requests in the tenant - OWNER/CO/MANAGER only"""
+    return {'count': await count_pending_leaves(firebase_db, _tenant_scope(user))}
+
 @api_router.post("/leave-requests")
 async def create_leave_request(leave_data: LeaveRequestCreate, token: dict = Depends(verify_token)):
     """Create a leave request"""
     uid = token['uid']
     
     # Get user details
-    user_doc = firebase_db.collection('users').document(uid).get()
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_data = user_doc.to_dict()
+    user_data = await get_user_document(uid, firebase_db)
     
     # For 'leave' type, check if employee has a shift on that date
     if leave_data.type == 'leave':
-        shifts_on_date = list(firebase_db.collection('shifts').where(
-            'employeeId', '==', uid
-        ).where('date', '==', leave_data.date).stream())
+        if leave_data.date == daily_index.day:
+            shifts_on_date = daily_index.shifts_for_employee(uid)
+        else:
+            shifts_on_date = [doc async for doc in firebase_db.collection('shifts').where(
+                'employeeId', '==', uid
+            ).where('date', '==', leave_data.date).stream()]
         
         if not shifts_on_date:
             raise HTTPException(
@@ -1031,12 +2000,10 @@ async def create_leave_request(leave_data: LeaveRequestCreate, token: dict = Dep
         request_date = datetime.fromisoformat(leave_data.date).date()
         
         if request_date == today:
-            # Check for active attendance
-            active_attendance = list(firebase_db.collection('attendance').where(
-                'employeeId', '==', uid
-            ).where('status', '==', 'CLOCKED_IN').stream())
+            # Check for an open session
+            session_doc = await firebase_db.collection('active_sessions').document(uid).get()
             
-            if active_attendance:
+            if session_doc.exists:
                 raise HTTPException(
                     status_code=400,
                     detail="Cannot request leave: You are currently clocked in. Please clock out first."
@@ -1048,23 +2015,24 @@ async def create_leave_request(leave_data: LeaveRequestCreate, token: dict = Dep
     leave_dict['id'] = str(uuid.uuid4())
     leave_dict['employeeId'] = uid
     leave_dict['employeeName'] = user_data.get('name', 'Unknown')
+    leave_dict['tenantId'] = user_data.get('tenantId')
     leave_dict['status'] = 'PENDING'
     leave_dict['createdAt'] = get_current_time().isoformat()
     leave_dict['updatedAt'] = get_current_time().isoformat()
     
-    firebase_db.collection('leave_requests').document(leave_dict['id']).set(leave_dict)
+    await firebase_db.collection('leave_requests').document(leave_dict['id']).set(leave_dict)
     return leave_dict
 
 @api_router.put("/leave-requests/{request_id}")
 async def update_leave_status(request_id: str, status_update: LeaveStatusUpdate, user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER']))):
     """Update leave request status - OWNER/CO/MANAGER only"""
     leave_ref = firebase_db.collection('leave_requests').document(request_id)
-    leave_doc = leave_ref.get()
+    leave_doc = await leave_ref.get()
     
     if not leave_doc.exists:
         raise HTTPException(status_code=404, detail="Leave request not found")
     
-    leave_ref.update({
+    await leave_ref.update({
         'status': status_update.status.upper(),
         'reviewedBy': user['uid'],
         'reviewedByName': user.get('name', 'Unknown'),
@@ -1072,7 +2040,7 @@ async def update_leave_status(request_id: str, status_update: LeaveStatusUpdate,
         'updatedAt': get_current_time().isoformat()
     })
     
-    updated_doc = leave_ref.get()
+    updated_doc = await leave_ref.get()
     return {"id": request_id, **updated_doc.to_dict()}
 
 # ==================== EARNINGS/PAYROLL ROUTES ====================
@@ -1083,7 +2051,7 @@ async def get_my_earnings(token: dict = Depends(verify_token)):
     uid = token['uid']
     
     # Get user data using helper
-    user_data = get_user_document(uid, firebase_db)
+    user_data = await get_user_document(uid, firebase_db)
     hourly_rate = user_data.get('salary', 0)
     
     if not hourly_rate or hourly_rate <= 0:
@@ -1102,146 +2070,43 @@ async def get_my_earnings(token: dict = Depends(verify_token)):
             "message": "No salary configured"
         }
     
-    today = get_current_time().date()
-    month_start = datetime(today.year, today.month, 1).isoformat()
-    month_end = datetime.combine(today, datetime.max.time()).isoformat()
-    
-    # Get all attendance for this employee (simplified query to avoid index requirement)
-    all_attendance = list(firebase_db.collection('attendance').where(
-        'employeeId', '==', uid
-    ).stream())
-    
-    # Filter to this month's clocked out attendance in memory
-    month_attendance = []
-    for att in all_attendance:
-        att_data = att.to_dict()
-        if att_data.get('status') == 'CLOCKED_OUT':
-            clock_in_time = att_data.get('clockInTime', '')
-            if month_start <= clock_in_time <= month_end:
-                month_attendance.append(att)
-    
-    # Calculate hours and count late arrivals
-    month_hours = 0
-    late_count = 0
-    late_penalty_hours = 0
-    
-    for att in month_attendance:
-        att_data = att.to_dict()
-        clock_in = datetime.fromisoformat(att_data['clockInTime'].replace('Z', '+00:00'))
-        clock_out = datetime.fromisoformat(att_data['clockOutTime'].replace('Z', '+00:00'))
-        hours = (clock_out - clock_in).total_seconds() / 3600
-        month_hours += hours
-        
-        # Count late arrivals
-        if att_data.get('isLate', False):
-            late_count += 1
-            
-            # Apply penalty for 3rd+ late (after 2 warnings)
-            if late_count > 2:
-                # Get shift hours for this attendance
-                shift_id = att_data.get('shiftId')
-                if shift_id:
-                    shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-                    if shift_doc.exists:
-                        shift_data = shift_doc.to_dict()
-                        start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-                        end_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
-                        shift_hours = (end_time - start_time).total_seconds() / 3600
-                        # Penalty is half the shift hours
-                        late_penalty_hours += shift_hours * 0.5
-    
-    # Calculate no-shows (scheduled shifts but no attendance) - simplified query
-    all_shifts = list(firebase_db.collection('shifts').where(
-        'employeeId', '==', uid
-    ).stream())
-    
-    no_show_count = 0
-    no_show_penalty_hours = 0
-    
-    # Filter to this month's past shifts in memory
-    month_start_date = today.replace(day=1)
-    for shift in all_shifts:
-        shift_data = shift.to_dict()
-        shift_date_str = shift_data.get('date', '')
-        
-        try:
-            shift_date = datetime.fromisoformat(shift_date_str).date()
-            
-            # Only check shifts from this month that have passed
-            if month_start_date <= shift_date < today:
-                shift_id = shift.id
-                
-                # Check if there's attendance for this shift
-                has_attendance = any(
-                    att.to_dict().get('shiftId') == shift_id 
-                    for att in month_attendance
-                )
-                
-                if not has_attendance:
-                    no_show_count += 1
-                    # No-show penalty = 2 days worth of shift hours
-                    start_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['startTime']}")
-                    end_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['endTime']}")
-                    shift_hours = (end_time - start_time).total_seconds() / 3600
-                    no_show_penalty_hours += shift_hours * 2
-        except:
-            continue
+    now = get_current_time()
     
-    # Calculate today's earnings (separate from month for display)
-    today_start = datetime.combine(today, datetime.min.time()).isoformat()
-    today_end = datetime.combine(today, datetime.max.time()).isoformat()
-    
-    today_attendance = [att for att in month_attendance if att.to_dict().get('clockInTime', '').startswith(today.isoformat())]
-    today_hours = 0
-    today_late_penalty = 0
-    
-    for att in today_attendance:
-        att_data = att.to_dict()
-        clock_in = datetime.fromisoformat(att_data['clockInTime'].replace('Z', '+00:00'))
-        clock_out = datetime.fromisoformat(att_data['clockOutTime'].replace('Z', '+00:00'))
-        hours = (clock_out - clock_in).total_seconds() / 3600
-        today_hours += hours
-        
-        # Check if today's attendance was late and counts toward penalty
-        if att_data.get('isLate', False) and late_count > 2:
-            shift_id = att_data.get('shiftId')
-            if shift_id:
-                shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-                if shift_doc.exists:
-                    shift_data = shift_doc.to_dict()
-                    start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-                    end_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
-                    shift_hours = (end_time - start_time).total_seconds() / 3600
-                    today_late_penalty = shift_hours * 0.5
+    # Month figures come from the maintained aggregate; today's from today's records
+    result = await payroll_aggregates.load_employee_month(
+        firebase_db, token.get('tenantId'), now.date().isoformat()[:7], uid, now, TIMEZONE
+    )
+    today_result = await payroll_aggregates.today_figures(firebase_db, uid, result['lateCount'], now)
     
     # Calculate earnings using helper
-    month_earnings_calc = calculate_net_earnings(month_hours, hourly_rate, late_penalty_hours, no_show_penalty_hours)
-    today_earnings_calc = calculate_net_earnings(today_hours, hourly_rate, today_late_penalty, 0)
+    month_earnings_calc = period_earnings(result, hourly_rate)
+    today_earnings_calc = calculate_net_earnings(today_result['hours'], hourly_rate, today_result['latePenaltyHours'], 0)
     
     return {
         "employeeId": uid,
         "employeeName": user_data.get('name', 'Unknown'),
         "hourlyRate": hourly_rate,
         "todayEarnings": today_earnings_calc['net'],
-        "todayHours": round(today_hours, 2),
+        "todayHours": round(today_result['hours'], 2),
         "monthEarnings": month_earnings_calc['net'],
         "monthGrossEarnings": month_earnings_calc['gross'],
-        "monthHours": round(month_hours, 2),
-        "lateCount": late_count,
+        "monthHours": round(result['hours'], 2),
+        "lateCount": result['lateCount'],
         "latePenalty": month_earnings_calc['late_penalty'],
-        "noShowCount": no_show_count,
+        "noShowCount": result['noShowCount'],
         "noShowPenalty": month_earnings_calc['no_show_penalty'],
     }
 
 @api_router.get("/earnings/all-employees")
 async def get_all_employees_earnings(user: dict = Depends(require_role(['OWNER', 'CO']))):
     """Get all employees' earnings for current month - OWNER/CO only"""
-    today = get_current_time().date()
-    month_start = datetime(today.year, today.month, 1).isoformat()
-    month_end = datetime.combine(today, datetime.max.time()).isoformat()
+    now = get_current_time()
+    today = now.date()
+    tenant_id = _tenant_scope(user)
     
     # Get all employees
-    all_users = list(firebase_db.collection('users').stream())
+    all_users = await get_all_employees(firebase_db, tenant_id=tenant_id)
+    results = await payroll_aggregates.load_month(firebase_db, tenant_id, today.isoformat()[:7], now, TIMEZONE)
     
     earnings_list = []
     
@@ -1253,51 +2118,78 @@ async def get_all_employees_earnings(user: dict = Depends(require_role(['OWNER',
         if not hourly_rate or hourly_rate <= 0:
             continue
         
-        # Get this month's attendance
-        all_attendance = list(firebase_db.collection('attendance').where(
-            'employeeId', '==', uid
-        ).stream())
-        
-        month_attendance = []
-        for att in all_attendance:
-            att_data = att.to_dict()
-            if att_data.get('status') == 'CLOCKED_OUT':
-                clock_in_time = att_data.get('clockInTime', '')
-                if month_start <= clock_in_time <= month_end:
-                    month_attendance.append(att)
-        
-        # Calculate hours
-        month_hours = 0
-        for att in month_attendance:
-            att_data = att.to_dict()
-            clock_in = datetime.fromisoformat(att_data['clockInTime'].replace('Z', '+00:00'))
-            clock_out = datetime.fromisoformat(att_data['clockOutTime'].replace('Z', '+00:00'))
-            hours = (clock_out - clock_in).total_seconds() / 3600
-            month_hours += hours
-        
-        month_earnings = round(month_hours * hourly_rate, 2)
+        result = results.get(uid) or empty_result(uid)
+        month_earnings = round(result['hours'] * hourly_rate, 2)
         
         earnings_list.append({
             "employeeId": uid,
             "employeeName": user_data.get('name', 'Unknown'),
             "role": user_data.get('role', 'EMPLOYEE'),
             "hourlyRate": hourly_rate,
-            "monthHours": round(month_hours, 2),
+            "monthHours": round(result['hours'], 2),
             "monthEarnings": month_earnings,
         })
     
     return earnings_list
 
+async def _cached_payroll_view(view: str, variant: str, user: dict, response: Response,
+                               if_none_match: Optional[str], compute):
+    """Serve a current-month payroll view from payroll_cache with an ETag
+    
+    Keyed by (view, tenant, month, variant, tenant payroll version); a matching
+    If-None-Match gets 304. Super admin views span every tenant and are not cached.
+    """
+    if user.get('isSuperAdmin'):
+        return await compute()
+    
+    tenant_id = _tenant_scope(user)
+    version = await payroll_version(firebase_db, tenant_id)
+    key = (view, tenant_id, get_current_time().date().isoformat()[:7], variant, version)
+    etag = payroll_etag(key)
+    
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': 'private, no-cache'})
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return await payroll_cache.get_or_compute(key, compute)
+
 @api_router.get("/payroll/all-earnings")
-async def get_all_earnings_with_status(user: dict = Depends(require_role(['OWNER', 'CO', 'ACCOUNTANT']))):
-    """Get all employees with payment status - OWNER/CO/ACCOUNTANT"""
-    today = get_current_time().date()
+async def get_all_earnings_with_status(
+    response: Response,
+    user: dict = Depends(require_role(['OWNER', 'CO', 'ACCOUNTANT'])),
+    if_none_match: Optional[str] = Header(None, alias='If-None-Match')
+):
+    """Get all employees with payment status - OWNER/CO/ACCOUNTANT
+    
+    Cached until the tenant's payroll data changes; send the ETag back in If-None-Match.
+    """
+    user_role = user.get('role', '').upper()
+    # CO does not see OWNER rows
+    variant = 'CO' if user_role == 'CO' else ''
+    return await _cached_payroll_view(
+        'all-earnings', variant, user, response, if_none_match,
+        lambda: _all_earnings_with_status(_tenant_scope(user), user_role)
+    )
+
+async def _all_earnings_with_status(tenant_id: Optional[str], user_role: str):
+    now = get_current_time()
+    today = now.date()
     current_month = today.month
     current_year = today.year
     
     # Get all employees using helper
-    user_role = user.get('role', '').upper()
-    all_users = get_all_employees(firebase_db, exclude_owner_for_co=True, current_user_role=user_role)
+    all_users = await get_all_employees(firebase_db, exclude_owner_for_co=True, current_user_role=user_role, tenant_id=tenant_id)
+    results = await payroll_aggregates.load_month(firebase_db, tenant_id, today.isoformat()[:7], now, TIMEZONE)
+    
+    # The tenant's payment records for this month, grouped by employee (one query)
+    payments_by_employee = {}
+    payments_query = filter_by_tenant(firebase_db.collection('payment_history'), tenant_id)
+    payment_records = [doc async for doc in payments_query.where(
+        'month', '==', current_month
+    ).where('year', '==', current_year).stream()]
+    for payment in payment_records:
+        payment_data = payment.to_dict()
+        payments_by_employee.setdefault(payment_data.get('employeeId'), []).append(payment_data)
     
     earnings_list = []
     
@@ -1310,130 +2202,30 @@ async def get_all_earnings_with_status(user: dict = Depends(require_role(['OWNER
         if not hourly_rate or hourly_rate <= 0:
             continue
         
-        # Get all attendance for this month
-        month_start = datetime(current_year, current_month, 1).isoformat()
-        month_end = datetime.combine(today, datetime.max.time()).isoformat()
-        
-        all_attendance = list(firebase_db.collection('attendance').where(
-            'employeeId', '==', uid
-        ).stream())
-        
-        month_attendance = []
-        for att in all_attendance:
-            att_data = att.to_dict()
-            if att_data.get('status') == 'CLOCKED_OUT':
-                clock_in_time = att_data.get('clockInTime', '')
-                if month_start <= clock_in_time <= month_end:
-                    month_attendance.append(att)
-        
-        # Separate paid and unpaid hours
-        paid_hours = 0
-        unpaid_hours = 0
-        late_count = 0
-        late_penalty_hours = 0
-        
-        for att in month_attendance:
-            att_data = att.to_dict()
-            clock_in = datetime.fromisoformat(att_data['clockInTime'].replace('Z', '+00:00'))
-            clock_out = datetime.fromisoformat(att_data['clockOutTime'].replace('Z', '+00:00'))
-            hours = (clock_out - clock_in).total_seconds() / 3600
-            
-            if att_data.get('paid', False):
-                paid_hours += hours
-            else:
-                unpaid_hours += hours
-            
-            # Count late arrivals
-            if att_data.get('isLate', False):
-                late_count += 1
-                if late_count > 2:
-                    shift_id = att_data.get('shiftId')
-                    if shift_id:
-                        shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-                        if shift_doc.exists:
-                            shift_data = shift_doc.to_dict()
-                            start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-                            end_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
-                            shift_hours = (end_time - start_time).total_seconds() / 3600
-                            late_penalty_hours += shift_hours * 0.5
-        
-        # Calculate no-shows (both auto-detected and manual)
-        # CRITICAL FIX: Now includes NO_SHOW status from auto-detection endpoint
-        all_shifts = list(firebase_db.collection('shifts').where(
-            'employeeId', '==', uid
-        ).stream())
-        
-        no_show_count = 0
-        no_show_penalty_hours = 0
-        month_start_date = today.replace(day=1)
-        
-        # Get all attendance including NO_SHOW records
-        all_attendance_with_no_shows = list(firebase_db.collection('attendance').where(
-            'employeeId', '==', uid
-        ).stream())
-        
-        for shift in all_shifts:
-            shift_data = shift.to_dict()
-            shift_date_str = shift_data.get('date', '')
-            
-            try:
-                shift_date = datetime.fromisoformat(shift_date_str).date()
-                
-                if month_start_date <= shift_date <= today:
-                    shift_id = shift.id
-                    
-                    # Check if there's any attendance record (including NO_SHOW)
-                    attendance_for_shift = [
-                        att for att in all_attendance_with_no_shows
-                        if att.to_dict().get('shiftId') == shift_id
-                    ]
-                    
-                    # If no attendance at all (legacy detection)
-                    if not attendance_for_shift:
-                        no_show_count += 1
-                        start_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['startTime']}")
-                        end_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['endTime']}")
-                        shift_hours = (end_time - start_time).total_seconds() / 3600
-                        no_show_penalty_hours += shift_hours * 2
-                    else:
-                        # Check if marked as NO_SHOW by auto-detection
-                        for att in attendance_for_shift:
-                            att_data = att.to_dict()
-                            if att_data.get('noShow', False) or att_data.get('status') == 'NO_SHOW':
-                                no_show_count += 1
-                                start_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['startTime']}")
-                                end_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['endTime']}")
-                                shift_hours = (end_time - start_time).total_seconds() / 3600
-                                no_show_penalty_hours += shift_hours * 2
-                                break
-            except:
-                continue
+        result = results.get(uid) or empty_result(uid)
         
         # Calculate earnings using helper
-        total_hours = paid_hours + unpaid_hours
-        unpaid_calc = calculate_net_earnings(unpaid_hours, hourly_rate, late_penalty_hours, no_show_penalty_hours)
-        
-        # Check if there's a payment record for this month
-        payment_records = list(firebase_db.collection('payment_history').where(
-            'employeeId', '==', uid
-        ).where('month', '==', current_month).where('year', '==', current_year).stream())
+        unpaid_calc = calculate_net_earnings(
+            result['unpaidHours'], hourly_rate, result['latePenaltyHours'], result['noShowPenaltyHours']
+        )
         
-        is_paid = len(payment_records) > 0
-        has_unpaid = unpaid_hours > 0
-        last_payment_date = payment_records[0].to_dict().get('paymentDate') if payment_records else None
+        employee_payments = payments_by_employee.get(uid, [])
+        is_paid = len(employee_payments) > 0
+        has_unpaid = result['unpaidHours'] > 0
+        last_payment_date = employee_payments[0].get('paymentDate') if employee_payments else None
         
         earnings_list.append({
             "employeeId": uid,
             "employeeName": user_data.get('name', 'Unknown'),
             "role": user_data.get('role', 'EMPLOYEE'),
             "hourlyRate": hourly_rate,
-            "totalHours": round(total_hours, 2),
-            "paidHours": round(paid_hours, 2),
-            "unpaidHours": round(unpaid_hours, 2),
+            "totalHours": round(result['hours'], 2),
+            "paidHours": round(result['paidHours'], 2),
+            "unpaidHours": round(result['unpaidHours'], 2),
             "grossUnpaid": unpaid_calc['gross'],
-            "lateCount": late_count,
+            "lateCount": result['lateCount'],
             "latePenalty": unpaid_calc['late_penalty'],
-            "noShowCount": no_show_count,
+            "noShowCount": result['noShowCount'],
             "noShowPenalty": unpaid_calc['no_show_penalty'],
             "netUnpaid": unpaid_calc['net'],
             "isPaid": is_paid,
@@ -1446,14 +2238,29 @@ async def get_all_earnings_with_status(user: dict = Depends(require_role(['OWNER
     return earnings_list
 
 @api_router.get("/payroll/unpaid-earnings")
-async def get_unpaid_earnings(user: dict = Depends(require_role(['OWNER', 'CO']))):
-    """Get employees with unpaid earnings - OWNER/CO only"""
-    today = get_current_time().date()
+async def get_unpaid_earnings(
+    response: Response,
+    user: dict = Depends(require_role(['OWNER', 'CO'])),
+    if_none_match: Optional[str] = Header(None, alias='If-None-Match')
+):
+    """Get employees with unpaid earnings - OWNER/CO only
+    
+    Cached until the tenant's payroll data changes; send the ETag back in If-None-Match.
+    """
+    return await _cached_payroll_view(
+        'unpaid-earnings', '', user, response, if_none_match,
+        lambda: _unpaid_earnings(_tenant_scope(user))
+    )
+
+async def _unpaid_earnings(tenant_id: Optional[str]):
+    now = get_current_time()
+    today = now.date()
     current_month = today.month
     current_year = today.year
     
     # Get all employees
-    all_users = list(firebase_db.collection('users').stream())
+    all_users = await get_all_employees(firebase_db, tenant_id=tenant_id)
+    results = await payroll_aggregates.load_month(firebase_db, tenant_id, today.isoformat()[:7], now, TIMEZONE)
     
     unpaid_list = []
     
@@ -1466,102 +2273,26 @@ async def get_unpaid_earnings(user: dict = Depends(require_role(['OWNER', 'CO'])
         if not hourly_rate or hourly_rate <= 0:
             continue
         
-        # Get unpaid attendance for this month
-        month_start = datetime(current_year, current_month, 1).isoformat()
-        month_end = datetime.combine(today, datetime.max.time()).isoformat()
-        
-        all_attendance = list(firebase_db.collection('attendance').where(
-            'employeeId', '==', uid
-        ).stream())
-        
-        unpaid_attendance = []
-        for att in all_attendance:
-            att_data = att.to_dict()
-            if att_data.get('status') == 'CLOCKED_OUT' and not att_data.get('paid', False):
-                clock_in_time = att_data.get('clockInTime', '')
-                if month_start <= clock_in_time <= month_end:
-                    unpaid_attendance.append(att)
-        
-        if not unpaid_attendance:
+        result = results.get(uid)
+        if result is None or result['unpaidHours'] <= 0:
             continue
         
-        # Calculate unpaid hours
-        unpaid_hours = 0
-        late_count = 0
-        late_penalty_hours = 0
-        
-        for att in unpaid_attendance:
-            att_data = att.to_dict()
-            clock_in = datetime.fromisoformat(att_data['clockInTime'].replace('Z', '+00:00'))
-            clock_out = datetime.fromisoformat(att_data['clockOutTime'].replace('Z', '+00:00'))
-            hours = (clock_out - clock_in).total_seconds() / 3600
-            unpaid_hours += hours
-            
-            # Count late arrivals
-            if att_data.get('isLate', False):
-                late_count += 1
-                if late_count > 2:
-                    shift_id = att_data.get('shiftId')
-                    if shift_id:
-                        shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-                        if shift_doc.exists:
-                            shift_data = shift_doc.to_dict()
-                            start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-                            end_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
-                            shift_hours = (end_time - start_time).total_seconds() / 3600
-                            late_penalty_hours += shift_hours * 0.5
-        
-        # Calculate no-shows for this month
-        all_shifts = list(firebase_db.collection('shifts').where(
-            'employeeId', '==', uid
-        ).stream())
-        
-        no_show_count = 0
-        no_show_penalty_hours = 0
-        month_start_date = today.replace(day=1)
-        
-        for shift in all_shifts:
-            shift_data = shift.to_dict()
-            shift_date_str = shift_data.get('date', '')
-            
-            try:
-                shift_date = datetime.fromisoformat(shift_date_str).date()
-                
-                if month_start_date <= shift_date < today:
-                    shift_id = shift.id
-                    has_attendance = any(
-                        att.to_dict().get('shiftId') == shift_id 
-                        for att in unpaid_attendance
-                    )
-                    
-                    if not has_attendance:
-                        no_show_count += 1
-                        start_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['startTime']}")
-                        end_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['endTime']}")
-                        shift_hours = (end_time - start_time).total_seconds() / 3600
-                        no_show_penalty_hours += shift_hours * 2
-            except:
-                continue
-        
         # Calculate earnings
-        gross_earnings = round(unpaid_hours * hourly_rate, 2)
-        late_penalty = round(late_penalty_hours * hourly_rate, 2)
-        no_show_penalty = round(no_show_penalty_hours * hourly_rate, 2)
-        net_earnings = round(gross_earnings - late_penalty - no_show_penalty, 2)
+        earnings = period_earnings(result, hourly_rate, unpaid_only=True)
         
-        if net_earnings > 0:
+        if earnings['net'] > 0:
             unpaid_list.append({
                 "employeeId": uid,
                 "employeeName": user_data.get('name', 'Unknown'),
                 "role": user_data.get('role', 'EMPLOYEE'),
                 "hourlyRate": hourly_rate,
-                "unpaidHours": round(unpaid_hours, 2),
-                "grossEarnings": gross_earnings,
-                "lateCount": late_count,
-                "latePenalty": late_penalty,
-                "noShowCount": no_show_count,
-                "noShowPenalty": no_show_penalty,
-                "netEarnings": net_earnings,
+                "unpaidHours": round(result['unpaidHours'], 2),
+                "grossEarnings": earnings['gross'],
+                "lateCount": result['lateCount'],
+                "latePenalty": earnings['late_penalty'],
+                "noShowCount": result['noShowCount'],
+                "noShowPenalty": earnings['no_show_penalty'],
+                "netEarnings": earnings['net'],
                 "month": current_month,
                 "year": current_year,
             })
@@ -1569,385 +2300,500 @@ async def get_unpaid_earnings(user: dict = Depends(require_role(['OWNER', 'CO'])
     return unpaid_list
 
 @api_router.post("/payroll/mark-as-paid")
-async def mark_as_paid(payment_data: PaymentRecord, user: dict = Depends(require_role(['OWNER', 'CO']))):
-    """Mark employee's earnings as paid for a specific month - OWNER/CO only"""
+async def mark_as_paid(
+    payment_data: PaymentRecord,
+    response: Response,
+    user: dict = Depends(require_role(['OWNER', 'CO'])),
+    idempotency_key: Optional[str] = Header(None, alias='Idempotency-Key')
+):
+    """Mark employee's earnings as paid for a specific month - OWNER/CO only
+    
+    Retries sent with the same Idempotency-Key replay the first payment record.
+    """
+    result, replayed = await idempotency_store.run(
+        firebase_db, idempotency_key, f"mark-as-paid:{user['uid']}", payment_data.dict(),
+        lambda: _mark_as_paid(payment_data, user)
+    )
+    _mark_replayed(response, replayed)
+    return result
+
+async def _mark_as_paid(payment_data: PaymentRecord, user: dict):
     employee_id = payment_data.employeeId
     month = payment_data.month
     year = payment_data.year
     
-    # Get all unpaid attendance for this employee and month
-    month_start = datetime(year, month, 1).isoformat()
-    # Get last day of month
-    if month == 12:
-        next_month = datetime(year + 1, 1, 1)
-    else:
-        next_month = datetime(year, month + 1, 1)
-    month_end = (next_month - timedelta(days=1)).replace(hour=23, minute=59, second=59).isoformat()
-    
-    all_attendance = list(firebase_db.collection('attendance').where(
-        'employeeId', '==', employee_id
-    ).stream())
-    
-    # Filter unpaid attendance for this month
-    unpaid_attendance = []
-    for att in all_attendance:
-        att_data = att.to_dict()
-        if att_data.get('status') == 'CLOCKED_OUT' and not att_data.get('paid', False):
-            clock_in_time = att_data.get('clockInTime', '')
-            if month_start <= clock_in_time <= month_end:
-                unpaid_attendance.append(att)
-    
-    if not unpaid_attendance:
-        raise HTTPException(status_code=400, detail="No unpaid earnings for this period")
+    await _ensure_period_open(_tenant_scope(user), year, month)
     
-    # Get employee data
-    user_doc = firebase_db.collection('users').document(employee_id).get()
+    # Read the employee directly, not through the profile cache: the payment uses their current salary
+    user_doc = await firebase_db.collection('users').document(employee_id).get()
     if not user_doc.exists:
         raise HTTPException(status_code=404, detail="Employee not found")
-    
     user_data = user_doc.to_dict()
-    hourly_rate = user_data.get('salary', 0)
+    tenant_id = _tenant_scope(user)
+    if tenant_id is not None and user_data.get('tenantId') != tenant_id:
+        raise HTTPException(status_code=404, detail="Employee not found")
     
-    # Calculate total earnings
-    total_hours = 0
-    late_count = 0
-    late_penalty_hours = 0
-    
-    for att in unpaid_attendance:
-        att_data = att.to_dict()
-        clock_in = datetime.fromisoformat(att_data['clockInTime'].replace('Z', '+00:00'))
-        clock_out = datetime.fromisoformat(att_data['clockOutTime'].replace('Z', '+00:00'))
-        hours = (clock_out - clock_in).total_seconds() / 3600
-        total_hours += hours
-        
-        if att_data.get('isLate', False):
-            late_count += 1
-            if late_count > 2:
-                shift_id = att_data.get('shiftId')
-                if shift_id:
-                    shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-                    if shift_doc.exists:
-                        shift_data = shift_doc.to_dict()
-                        start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-                        end_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
-                        shift_hours = (end_time - start_time).total_seconds() / 3600
-                        late_penalty_hours += shift_hours * 0.5
-    
-    # Calculate no-shows
-    all_shifts = list(firebase_db.collection('shifts').where(
-        'employeeId', '==', employee_id
-    ).stream())
-    
-    no_show_count = 0
-    no_show_penalty_hours = 0
-    
-    for shift in all_shifts:
-        shift_data = shift.to_dict()
-        shift_date_str = shift_data.get('date', '')
-        
-        try:
-            shift_date = datetime.fromisoformat(shift_date_str).date()
-            
-            # Only check shifts in the payment period
-            period_start = datetime(year, month, 1).date()
-            period_end = (next_month - timedelta(days=1)).date()
-            
-            if period_start <= shift_date <= period_end:
-                shift_id = shift.id
-                has_attendance = any(
-                    att.to_dict().get('shiftId') == shift_id 
-                    for att in unpaid_attendance
-                )
-                
-                if not has_attendance:
-                    no_show_count += 1
-                    start_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['startTime']}")
-                    end_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['endTime']}")
-                    shift_hours = (end_time - start_time).total_seconds() / 3600
-                    no_show_penalty_hours += shift_hours * 2
-        except:
-            continue
+    try:
+        payment_record = await retry_transient(_settle, employee_id, user_data, month, year, user, get_current_time())
+    except Exception as e:
+        print(f"✗ Failed to settle {employee_id} for {year}-{month:02d}: {e}")
+        raise HTTPException(status_code=503, detail="Failed to record the payment, please retry")
+    
+    if payment_record is None:
+        raise HTTPException(status_code=400, detail="No unpaid earnings for this period")
+    await bump_payroll_version(firebase_db, user_data.get('tenantId'))
+    
+    return payment_record
+
+async def _ensure_period_open(tenant_id: Optional[str], year: int, month: int):
+    """Payments cannot be recorded in a closed period (409)"""
+    if await payroll_periods.load_header(firebase_db, tenant_id, year, month) is not None:
+        raise HTTPException(status_code=409, detail="This payroll period is closed; reopen it to record payments")
+
+SETTLEMENT_CONCURRENCY = 10  # Employees settled at once by the bulk mark-as-paid
+
+async def _settle(employee_id: str, user_data: dict, month: int, year: int,
+                  user: dict, now: datetime) -> Optional[dict]:
+    """Settle an employee's unpaid earnings for a month
     
-    gross_earnings = round(total_hours * hourly_rate, 2)
-    late_penalty = round(late_penalty_hours * hourly_rate, 2)
-    no_show_penalty = round(no_show_penalty_hours * hourly_rate, 2)
-    net_earnings = round(gross_earnings - late_penalty - no_show_penalty, 2)
+    One transaction reads the month's records and the employee's user
+    document, marks the unpaid records as paid, writes the payment record and
+    the recomputed payroll aggregate: either the whole settlement lands or
+    none of it, and it always pays exactly the records that were unpaid, at
+    the salary that was current, when it committed.
     
-    # Mark all attendance as paid
-    for att in unpaid_attendance:
-        firebase_db.collection('attendance').document(att.id).update({
+    Returns:
+        The payment record (None if nothing was unpaid or the employee no longer exists)
+    """
+    key = f"{year:04d}-{month:02d}"
+    employee_ref = firebase_db.collection('users').document(employee_id)
+    
+    def stage(transaction, state):
+        employee_data = state['docs'][employee_ref.path]
+        result = payroll_aggregates.month_result(state, employee_id, key, now, TIMEZONE)
+        if employee_data is None or result is None or not result['unpaidAttendanceIds']:
+            return None
+        payment_record = _payment_record(employee_id, result, employee_data, month, year, user, now)
+        paid_fields = {
             'paid': True,
-            'paidAt': get_current_time().isoformat(),
+            'paidAt': now.isoformat(),
             'paidBy': user['uid'],
-        })
+        }
+        
+        # Mark all attendance as paid
+        for attendance_id in result['unpaidAttendanceIds']:
+            transaction.update(firebase_db.collection('attendance').document(attendance_id), paid_fields)
+            state['attendance'][attendance_id].update(paid_fields)
+        transaction.set(firebase_db.collection('payment_history').document(payment_record['id']), payment_record)
+        return payment_record
+    
+    payment_record, _ = await payroll_aggregates.commit_with_aggregates(
+        firebase_db, user_data.get('tenantId'), employee_id, [key], now, TIMEZONE, stage,
+        read_refs=[employee_ref]
+    )
+    return payment_record
+
+def _payment_record(employee_id: str, result: dict, user_data: dict,
+                    month: int, year: int, user: dict, now: datetime) -> dict:
+    """Payment history record for an employee's unpaid earnings in a month"""
+    earnings = period_earnings(result, user_data.get('salary', 0), unpaid_only=True)
     
     # Create payment history record
     payment_record = {
         'id': str(uuid.uuid4()),
         'employeeId': employee_id,
         'employeeName': user_data.get('name', 'Unknown'),
+        'tenantId': user_data.get('tenantId'),
         'month': month,
         'year': year,
-        'totalHours': round(total_hours, 2),
-        'grossEarnings': gross_earnings,
-        'lateCount': late_count,
-        'latePenalty': late_penalty,
-        'noShowCount': no_show_count,
-        'noShowPenalty': no_show_penalty,
-        'netEarnings': net_earnings,
+        'totalHours': round(result['unpaidHours'], 2),
+        'grossEarnings': earnings['gross'],
+        'lateCount': result['lateCount'],
+        'latePenalty': earnings['late_penalty'],
+        'noShowCount': result['noShowCount'],
+        'noShowPenalty': earnings['no_show_penalty'],
+        'netEarnings': earnings['net'],
         'paid': True,  # Mark as paid
-        'paymentDate': get_current_time().isoformat(),
+        'paymentDate': now.isoformat(),
         'paidBy': user['uid'],
         'paidByName': user.get('name', 'Unknown'),
     }
+    return payment_record
+
+@api_router.post("/payroll/mark-as-paid/bulk")
+async def mark_month_as_paid(
+    payment_data: BulkPaymentRequest,
+    response: Response,
+    user: dict = Depends(require_role(['OWNER', 'CO'])),
+    idempotency_key: Optional[str] = Header(None, alias='Idempotency-Key')
+):
+    """Mark every employee's unpaid earnings for a month as paid - OWNER/CO only
+    
+    Each employee is settled in one transaction, several employees at a time. Employees
+    whose transaction failed are listed under 'failed' and keep their whole unpaid balance.
+    Retries sent with the same Idempotency-Key replay the first response.
+    """
+    result, replayed = await idempotency_store.run(
+        firebase_db, idempotency_key, f"mark-as-paid-bulk:{user['uid']}", payment_data.dict(),
+        lambda: _mark_month_as_paid(payment_data, user)
+    )
+    _mark_replayed(response, replayed)
+    return result
+
+async def _mark_month_as_paid(payment_data: BulkPaymentRequest, user: dict):
+    month = payment_data.month
+    year = payment_data.year
+    tenant_id = _tenant_scope(user)
+    now = get_current_time()
+    await _ensure_period_open(tenant_id, year, month)
     
-    firebase_db.collection('payment_history').document(payment_record['id']).set(payment_record)
+    period_start, period_end = month_bounds(year, month)
+    results = await compute_payroll(firebase_db, tenant_id, period_start, period_end, now, TIMEZONE)
     
-    return payment_record
+    unpaid = {employee_id: result for employee_id, result in results.items() if result['unpaidAttendanceIds']}
+    user_loader = DocumentLoader(firebase_db, 'users')
+    await user_loader.prime(unpaid.keys())
+    
+    # One transaction per employee, throttled and retried on transient errors
+    runner = TransactionRunner(max_in_flight=SETTLEMENT_CONCURRENCY)
+    employees = {}
+    for employee_id, result in unpaid.items():
+        user_data = await user_loader.load(employee_id)
+        if user_data is None:
+            continue
+        employees[employee_id] = user_data
+        runner.run(
+            _settle, employee_id, user_data, month, year, user, now,
+            tag=employee_id, ops=len(result['unpaidAttendanceIds']) + 2
+        )
+    outcome = await runner.close()
+    
+    failed = {}  # employee ID -> name
+    for employee_id, error in outcome.failed:
+        print(f"✗ Failed to settle {employee_id} for {year}-{month:02d}: {error}")
+        failed[employee_id] = employees[employee_id].get('name', 'Unknown')
+    
+    settled = [record for record in outcome.values.values() if record is not None]
+    await bump_payroll_versions(firebase_db, (record['tenantId'] for record in settled))
+    
+    return {
+        'month': month,
+        'year': year,
+        'paidCount': len(settled),
+        'totalNetEarnings': round(sum(record['netEarnings'] for record in settled), 2),
+        'payments': settled,
+        'failed': [
+            {'employeeId': employee_id, 'employeeName': employee_name}
+            for employee_id, employee_name in failed.items()
+        ]
+    }
+
+@api_router.post("/payroll/aggregates/rebuild")
+async def rebuild_payroll_aggregates(
+    year: int,
+    month: int,
+    tenant_id: Optional[str] = None,
+    user: dict = Depends(require_role(['OWNER']))
+):
+    """
+    Recompute a month's payroll aggregates from raw attendance - OWNER only
+    Used for backfill and to repair drift; super admins may pass tenant_id
+    """
+    scope = tenant_id if user.get('isSuperAdmin') else user.get('tenantId')
+    written = await payroll_aggregates.rebuild_month(firebase_db, scope, year, month, get_current_time(), TIMEZONE)
+    await bump_payroll_version(firebase_db, scope)
+    
+    return {
+        'tenantId': scope,
+        'month': f"{year:04d}-{month:02d}",
+        'employees': written,
+        'message': f'Rebuilt payroll aggregates for {written} employees'
+    }
 
 @api_router.get("/payroll/payment-history/{employee_id}")
-async def get_payment_history(employee_id: str, user: dict = Depends(require_role(['OWNER', 'CO', 'ACCOUNTANT']))):
-    """Get payment history for an employee - OWNER/CO/ACCOUNTANT"""
-    payments = list(firebase_db.collection('payment_history').where(
-        'employeeId', '==', employee_id
-    ).stream())
+async def get_payment_history(
+    employee_id: str,
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    year: Optional[int] = None,
+    month: Optional[int] = None,
+    user: dict = Depends(require_role(['OWNER', 'CO', 'ACCOUNTANT']))
+):
+    """Get payment history for an employee, newest first - OWNER/CO/ACCOUNTANT
+    
+    Paginated with limit/cursor (next cursor in the X-Next-Page-Token header);
+    fields= limits the returned fields. year/month restrict it to one payroll
+    period, which is read from the period's snapshot once it is closed.
+    """
+    projection = parse_fields(fields)
+    payments_col = firebase_db.collection('payment_history')
+    query = payments_col.where('employeeId', '==', employee_id)
+    
+    if year and month:
+        snapshot = await payroll_periods.load_snapshot(firebase_db, _tenant_scope(user), year, month, employee_id)
+        if snapshot is not None:
+            payments = payroll_periods.snapshot_payments(snapshot, employee_id)
+            if projection is not None:
+                payments = [
+                    {'id': payment['id'], **{field: payment[field] for field in projection if field in payment}}
+                    for payment in payments
+                ]
+            return payments
+        query = query.where('month', '==', month).where('year', '==', year)
+    
+    payments, next_cursor = await paginate(
+        query, payments_col, ['-paymentDate'], limit, cursor, projection
+    )
+    set_next_page_token(response, next_cursor)
+    
+    return [{"id": payment.id, **payment.to_dict()} for payment in payments]
+
+@api_router.post("/payroll/periods/close")
+async def close_payroll_period(period: PayrollPeriodRequest, user: dict = Depends(require_role(['OWNER', 'CO']))):
+    """
+    Freeze a settled month into a checksummed snapshot - OWNER/CO only
+    
+    Payment history and payroll exports for a closed month are served from the
+    snapshot, and no payments can be recorded for it until it is reopened.
+    """
+    tenant_id = _tenant_scope(user)
+    now = get_current_time()
+    period_start, period_end = month_bounds(period.year, period.month)
+    
+    if period_end >= now.date():
+        raise HTTPException(status_code=400, detail="Only months that have ended can be closed")
+    if await payroll_periods.load_header(firebase_db, tenant_id, period.year, period.month) is not None:
+        raise HTTPException(status_code=409, detail="This payroll period is already closed")
+    
+    results = await compute_payroll(firebase_db, tenant_id, period_start, period_end, now, TIMEZONE)
+    unpaid = [employee_id for employee_id, result in results.items() if result['unpaidAttendanceIds']]
+    if unpaid:
+        raise HTTPException(
+            status_code=409,
+            detail=f"{len(unpaid)} employees still have unpaid earnings for this period; mark them as paid first"
+        )
+    
+    all_users = await get_all_employees(firebase_db, tenant_id=tenant_id)
+    payments_query = filter_by_tenant(firebase_db.collection('payment_history'), tenant_id)
+    payments = [{'id': doc.id, **doc.to_dict()} async for doc in payments_query.where(
+        'month', '==', period.month
+    ).where('year', '==', period.year).stream()]
     
-    # Sort by date descending
-    payment_list = [{"id": payment.id, **payment.to_dict()} for payment in payments]
-    payment_list.sort(key=lambda x: x.get('paymentDate', ''), reverse=True)
+    employees = payroll_periods.employee_snapshots(all_users, results, payments)
+    try:
+        header = await payroll_periods.close_period(
+            firebase_db, tenant_id, period.year, period.month, employees, user, now
+        )
+    except Exception as e:
+        print(f"✗ Failed to close payroll period {period.year}-{period.month:02d}: {e}")
+        raise HTTPException(status_code=503, detail="Failed to write the period snapshot, please retry")
+    
+    return {key: value for key, value in header.items() if key != 'shardChecksums'}
+
+@api_router.post("/payroll/periods/reopen")
+async def reopen_payroll_period(period: PayrollPeriodRequest, user: dict = Depends(require_role(['OWNER']))):
+    """Invalidate a closed month's snapshot so it is computed from attendance again - OWNER only"""
+    tenant_id = _tenant_scope(user)
+    reopened = await payroll_periods.reopen_period(
+        firebase_db, tenant_id, period.year, period.month, user, get_current_time()
+    )
+    if not reopened:
+        raise HTTPException(status_code=404, detail="This payroll period is not closed")
+    
+    return {
+        'tenantId': tenant_id,
+        'month': period.month,
+        'year': period.year,
+        'status': 'OPEN',
+        'message': 'Payroll period reopened'
+    }
+
+@api_router.get("/payroll/periods/{year}/{month}")
+async def get_payroll_period(year: int, month: int, user: dict = Depends(require_role(['OWNER', 'CO', 'ACCOUNTANT']))):
+    """Snapshot of a closed month, employees sorted by name - OWNER/CO/ACCOUNTANT"""
+    snapshot = await payroll_periods.load_snapshot(firebase_db, _tenant_scope(user), year, month)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="No valid snapshot for this payroll period")
     
-    return payment_list
+    employees = sorted(snapshot.pop('employees').values(), key=lambda employee: employee['employeeName'])
+    snapshot.pop('shardChecksums', None)
+    return {**snapshot, 'employees': employees}
 
 # ==================== EXPORT ROUTES ====================
 
 @api_router.get("/exports/hours/{store_id}")
 async def export_hours_csv(store_id: str, user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER', 'ACCOUNTANT']))):
     """Export hours worked to CSV with analytics - Management only"""
-    from fastapi.responses import StreamingResponse
-    import io
+    from urllib.parse import quote
     
     # Get store details
-    store_doc = firebase_db.collection('stores').document(store_id).get()
+    store_doc = await firebase_db.collection('stores').document(store_id).get()
     if not store_doc.exists:
         raise HTTPException(status_code=404, detail="Store not found")
     
     store_data = store_doc.to_dict()
     store_name = store_data.get('name', 'Unknown')
     
-    # Get all attendance for this store
-    attendance_records = list(firebase_db.collection('attendance').where(
+    # Completed attendance for this store, grouped by employee, then by date. Ordered by
+    # employeeId: an order_by field drops records without it, and employeeName can be missing
+    attendance_query = firebase_db.collection('attendance').where(
         'storeId', '==', store_id
-    ).stream())
-    
-    # Create CSV content with BOM for Arabic support
-    csv_content = "\ufeff"  # UTF-8 BOM
-    csv_content += f"Store: {store_name}\n"
-    csv_content += f"Generated: {get_current_time().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    csv_content += "Date,Employee,Clock In,Clock Out,Total Hours\n"
-    
-    # Sort by employee name, then by date
-    attendance_list = [{"id": att.id, **att.to_dict()} for att in attendance_records if att.to_dict().get('status') == 'CLOCKED_OUT']
-    attendance_list.sort(key=lambda x: (x.get('employeeName', ''), x.get('clockInTime', '')))
-    
-    current_employee = None
-    employee_total_minutes = 0
-    grand_total_minutes = 0
-    
-    for record in attendance_list:
-        employee_name = record.get('employeeName', 'Unknown')
-        clock_in_str = record.get('clockInTime', '')
-        clock_out_str = record.get('clockOutTime', '')
-        
-        if clock_in_str and clock_out_str:
+    ).where('status', '==', 'CLOCKED_OUT').order_by('employeeId').order_by('clockInTime')
+    
+    async def generate_rows():
+        yield csv_row(f"Store: {store_name}")
+        yield csv_row(f"Generated: {get_current_time().strftime('%Y-%m-%d %H:%M:%S')}")
+        yield "\n"
+        yield csv_row("Date", "Employee", "Clock In", "Clock Out", "Total Hours")
+        
+        current_employee = None
+        employee_total_minutes = 0
+        grand_total_minutes = 0
+        
+        async for doc in attendance_query.stream():
+            record = doc.to_dict()
+            employee_id = record.get('employeeId')
+            employee_name = record.get('employeeName', 'Unknown')
+            clock_in_str = record.get('clockInTime', '')
+            clock_out_str = record.get('clockOutTime', '')
+            
+            if not clock_in_str or not clock_out_str:
+                continue
+            
             clock_in = datetime.fromisoformat(clock_in_str.replace('Z', '+00:00'))
             clock_out = datetime.fromisoformat(clock_out_str.replace('Z', '+00:00'))
             
             # Calculate duration in minutes and round to nearest minute
-            duration_seconds = (clock_out - clock_in).total_seconds()
-            duration_minutes = round(duration_seconds / 60)
-            hours = duration_minutes // 60
-            minutes = duration_minutes % 60
-            duration_str = f"{hours:02d}:{minutes:02d}"
+            duration_minutes = round((clock_out - clock_in).total_seconds() / 60)
             
-            # Check if we're starting a new employee section
-            if current_employee != employee_name:
-                # Print previous employee's subtotal
+            # Starting a new employee section: close the previous one
+            if current_employee != employee_id:
                 if current_employee is not None and employee_total_minutes > 0:
-                    hours = employee_total_minutes // 60
-                    minutes = employee_total_minutes % 60
-                    csv_content += f",,,,Subtotal: {hours:02d}:{minutes:02d}\n"
-                    csv_content += "\n"  # Blank line between employees
+                    yield csv_row("", "", "", "", f"Subtotal: {format_minutes(employee_total_minutes)}")
+                    yield "\n"  # Blank line between employees
                 
-                current_employee = employee_name
+                current_employee = employee_id
                 employee_total_minutes = 0
             
-            # Add to totals
             employee_total_minutes += duration_minutes
             grand_total_minutes += duration_minutes
             
-            date_str = clock_in.strftime('%Y-%m-%d')
-            time_in = clock_in.strftime('%H:%M')
-            time_out = clock_out.strftime('%H:%M')
-            
-            csv_content += f"{date_str},{employee_name},{time_in},{time_out},{duration_str}\n"
-    
-    # Add last employee's subtotal
-    if current_employee is not None and employee_total_minutes > 0:
-        hours = employee_total_minutes // 60
-        minutes = employee_total_minutes % 60
-        csv_content += f",,,,Subtotal: {hours:02d}:{minutes:02d}\n"
-    
-    # Add grand total
-    csv_content += "\n"
-    hours = grand_total_minutes // 60
-    minutes = grand_total_minutes % 60
-    csv_content += f",,,,GRAND TOTAL: {hours:02d}:{minutes:02d}\n"
-    
-    # Create streaming response with URL-encoded filename for Arabic support
-    output = io.StringIO()
-    output.write(csv_content)
-    output.seek(0)
+            yield csv_row(
+                clock_in.strftime('%Y-%m-%d'),
+                employee_name,
+                clock_in.strftime('%H:%M'),
+                clock_out.strftime('%H:%M'),
+                format_minutes(duration_minutes)
+            )
+        
+        # Last employee's subtotal
+        if current_employee is not None and employee_total_minutes > 0:
+            yield csv_row("", "", "", "", f"Subtotal: {format_minutes(employee_total_minutes)}")
+        
+        yield "\n"
+        yield csv_row("", "", "", "", f"GRAND TOTAL: {format_minutes(grand_total_minutes)}")
     
     # URL-encode filename to support Arabic characters
-    from urllib.parse import quote
     safe_store_name = quote(store_name.replace(' ', '_'))
     filename = f"hours_{safe_store_name}_{get_current_time().strftime('%Y%m%d')}.csv"
     
-    return StreamingResponse(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        media_type="text/csv",
-        headers={
-            "Content-Disposition": f"attachment; filename*=UTF-8''{filename}"
-        }
-    )
+    return streaming_csv_response(generate_rows(), f"attachment; filename*=UTF-8''{filename}")
 
 @api_router.get("/exports/ingredients/{store_id}")
 async def export_ingredients_csv(store_id: str, user: dict = Depends(require_role(['OWNER', 'CO', 'MANAGER']))):
     """Export ingredient counts to CSV with analytics - Management only"""
-    from fastapi.responses import StreamingResponse
-    import io
+    from urllib.parse import quote
     
     # Get store details
-    store_doc = firebase_db.collection('stores').document(store_id).get()
+    store_doc = await firebase_db.collection('stores').document(store_id).get()
     if not store_doc.exists:
         raise HTTPException(status_code=404, detail="Store not found")
     
     store_data = store_doc.to_dict()
     store_name = store_data.get('name', 'Unknown')
     
-    # Get all ingredient counts for this store
-    counts = list(firebase_db.collection('ingredient_counts').where(
-        'storeId', '==', store_id
-    ).stream())
-    
-    # Get ingredient details
-    ingredients_map = {}
-    ingredients = list(firebase_db.collection('ingredients').where(
+    # Ingredient list is small; counts are streamed per ingredient below
+    ingredients = [doc async for doc in firebase_db.collection('ingredients').where(
         'storeId', '==', store_id
-    ).stream())
-    
-    for ing in ingredients:
-        ing_data = ing.to_dict()
-        ingredients_map[ing.id] = ing_data
-    
-    # Create CSV content with BOM for Arabic support
-    csv_content = "\ufeff"  # UTF-8 BOM
-    csv_content += f"Store: {store_name}\n"
-    csv_content += f"Generated: {get_current_time().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    csv_content += "Date,Ingredient,Count Type,First Count,Added,Final Count,Usage\n"
-    
-    # Group counts by ingredient and date
-    counts_by_ingredient = {}
-    for count in counts:
-        count_data = count.to_dict()
-        ingredient_id = count_data.get('ingredientId')
-        date = count_data.get('date', '')
-        
-        if ingredient_id not in counts_by_ingredient:
-            counts_by_ingredient[ingredient_id] = {}
-        
-        if date not in counts_by_ingredient[ingredient_id]:
-            counts_by_ingredient[ingredient_id][date] = {
-                'FIRST': 0,
-                'ADD': 0,
-                'FINAL': 0
-            }
-        
-        count_type = count_data.get('countType', 'FIRST')
-        value = count_data.get('value', 0)
-        counts_by_ingredient[ingredient_id][date][count_type] = value
-    
-    # Sort ingredients by name
+    ).stream()]
     sorted_ingredients = sorted(
-        ingredients_map.items(),
+        ((ing.id, ing.to_dict()) for ing in ingredients),
         key=lambda x: x[1].get('name', '')
     )
     
-    grand_total_usage = 0
+    def format_value(value, count_type_str):
+        return f"{value:.2f}" if count_type_str == 'KILO' else f"{int(value)}"
     
-    for ingredient_id, ingredient_data in sorted_ingredients:
-        ingredient_name = ingredient_data.get('name', 'Unknown')
-        count_type_str = ingredient_data.get('countType', 'BOX')
-        
-        if ingredient_id not in counts_by_ingredient:
-            continue
-        
-        ingredient_total_usage = 0
+    async def generate_rows():
+        yield csv_row(f"Store: {store_name}")
+        yield csv_row(f"Generated: {get_current_time().strftime('%Y-%m-%d %H:%M:%S')}")
+        yield "\n"
+        yield csv_row("Date", "Ingredient", "Count Type", "First Count", "Added", "Final Count", "Usage")
         
-        # Sort dates
-        sorted_dates = sorted(counts_by_ingredient[ingredient_id].items())
+        grand_total_usage = 0
         
-        for date, counts_dict in sorted_dates:
-            first = counts_dict['FIRST']
-            added = counts_dict['ADD']
-            final = counts_dict['FINAL']
+        for ingredient_id, ingredient_data in sorted_ingredients:
+            ingredient_name = ingredient_data.get('name', 'Unknown')
+            count_type_str = ingredient_data.get('countType', 'BOX')
             
-            # Calculate usage: (First + Added) - Final
-            usage = (first + added) - final
-            ingredient_total_usage += usage
-            grand_total_usage += usage
+            # Counts arrive in date order, so each date is complete once the next one starts
+            counts_query = firebase_db.collection('ingredient_counts').where(
+                'ingredientId', '==', ingredient_id
+            ).order_by('date')
             
-            # Format based on count type
-            if count_type_str == 'KILO':
-                first_str = f"{first:.2f}"
-                added_str = f"{added:.2f}"
-                final_str = f"{final:.2f}"
-                usage_str = f"{usage:.2f}"
-            else:
-                first_str = f"{int(first)}"
-                added_str = f"{int(added)}"
-                final_str = f"{int(final)}"
-                usage_str = f"{int(usage)}"
+            def date_row(date, counts_dict):
+                # Usage: (First + Added) - Final
+                usage = (counts_dict['FIRST'] + counts_dict['ADD']) - counts_dict['FINAL']
+                row = csv_row(
+                    date, ingredient_name, count_type_str,
+                    format_value(counts_dict['FIRST'], count_type_str),
+                    format_value(counts_dict['ADD'], count_type_str),
+                    format_value(counts_dict['FINAL'], count_type_str),
+                    format_value(usage, count_type_str)
+                )
+                return usage, row
+            
+            current_date = None
+            counts_dict = None
+            ingredient_total_usage = 0
+            has_counts = False
+            
+            async for doc in counts_query.stream():
+                count_data = doc.to_dict()
+                date = count_data.get('date', '')
+                
+                if date != current_date:
+                    if counts_dict is not None:
+                        usage, row = date_row(current_date, counts_dict)
+                        ingredient_total_usage += usage
+                        yield row
+                    current_date = date
+                    counts_dict = {'FIRST': 0, 'ADD': 0, 'FINAL': 0}
+                
+                has_counts = True
+                counts_dict[count_data.get('countType', 'FIRST')] = count_data.get('value', 0)
+            
+            if not has_counts:
+                continue
             
-            csv_content += f"{date},{ingredient_name},{count_type_str},{first_str},{added_str},{final_str},{usage_str}\n"
+            usage, row = date_row(current_date, counts_dict)
+            ingredient_total_usage += usage
+            yield row
+            grand_total_usage += ingredient_total_usage
+            
+            # Ingredient subtotal
+            yield csv_row("", "", "", "", "", "", f"Subtotal: {format_value(ingredient_total_usage, count_type_str)}")
+            yield "\n"  # Blank line between ingredients
         
-        # Add ingredient subtotal
-        if count_type_str == 'KILO':
-            csv_content += f",,,,,,Subtotal: {ingredient_total_usage:.2f}\n"
-        else:
-            csv_content += f",,,,,,Subtotal: {int(ingredient_total_usage)}\n"
-        csv_content += "\n"  # Blank line between ingredients
-    
-    # Add grand total
-    csv_content += f",,,,,,GRAND TOTAL: {grand_total_usage:.2f}\n"
-    
-    # Create streaming response with URL-encoded filename for Arabic support
-    output = io.StringIO()
-    output.write(csv_content)
-    output.seek(0)
+        yield csv_row("", "", "", "", "", "", f"GRAND TOTAL: {grand_total_usage:.2f}")
     
     # URL-encode filename to support Arabic characters
-    from urllib.parse import quote
     safe_store_name = quote(store_name.replace(' ', '_'))
     filename = f"ingredients_{safe_store_name}_{get_current_time().strftime('%Y%m%d')}.csv"
     
-    return StreamingResponse(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        media_type="text/csv",
-        headers={
-            "Content-Disposition": f"attachment; filename*=UTF-8''{filename}"
-        }
-    )
+    return streaming_csv_response(generate_rows(), f"attachment; filename*=UTF-8''{filename}")
 
 # ==================== MULTI-TENANT ROUTES (VireoHR) ====================
 
@@ -1980,7 +2826,7 @@ async def create_custom_token_signup(
             pass  # Good, email is available
         
         # 1. Create tenant document
-        tenant_id = create_tenant_document(firebase_db, owner_email, business_name)
+        tenant_id = await create_tenant_document(firebase_db, owner_email, business_name)
         
         # 2. Create owner user in Firebase Auth
         owner_user = admin_auth.create_user(
@@ -1999,13 +2845,11 @@ async def create_custom_token_signup(
             'updatedAt': get_current_time().isoformat()
         }
         
-        firebase_db.collection('users').document(owner_user.uid).set(owner_doc)
+        await firebase_db.collection('users').document(owner_user.uid).set(owner_doc)
+        user_cache.invalidate(owner_user.uid)
         
         # 4. Set custom claims on user
-        admin_auth.set_custom_user_claims(owner_user.uid, {
-            'tenantId': tenant_id,
-            'role': 'OWNER'
-        })
+        sync_user_claims(owner_user.uid, owner_doc)
         
         # 5. Create custom token
         custom_token = create_custom_token_with_tenant(owner_user.uid, tenant_id, 'OWNER')
@@ -2035,7 +2879,7 @@ async def get_my_tenant(token: dict = Depends(verify_token)):
         raise HTTPException(status_code=404, detail="No tenant associated with this user")
     
     # Fetch tenant document
-    tenant_doc = firebase_db.collection('tenants').document(tenant_id).get()
+    tenant_doc = await firebase_db.collection('tenants').document(tenant_id).get()
     
     if not tenant_doc.exists:
         raise HTTPException(status_code=404, detail="Tenant not found")
@@ -2077,7 +2921,7 @@ async def toggle_overtime(
         'setAt': get_current_time().isoformat()
     }
     
-    firebase_db.collection('tenants').document(tenant_id).collection('overtime').document(date).set(overtime_doc)
+    await firebase_db.collection('tenants').document(tenant_id).collection('overtime').document(date).set(overtime_doc)
     
     return {
         'date': date,
@@ -2094,7 +2938,7 @@ async def get_overtime_toggle(date: str, token: dict = Depends(verify_token)):
     if not tenant_id:
         return {'enabled': False}
     
-    overtime_doc = firebase_db.collection('tenants').document(tenant_id).collection('overtime').document(date).get()
+    overtime_doc = await firebase_db.collection('tenants').document(tenant_id).collection('overtime').document(date).get()
     
     if not overtime_doc.exists:
         return {'enabled': False, 'date': date}
@@ -2118,7 +2962,7 @@ async def list_all_tenants(
     skip = int(request.query_params.get("skip", 0))
     limit = int(request.query_params.get("limit", 50))
     
-    tenants = list(firebase_db.collection('tenants').stream())
+    tenants = [doc async for doc in firebase_db.collection('tenants').stream()]
     
     tenant_list = []
     for tenant in tenants:
@@ -2149,18 +2993,30 @@ async def list_all_tenants(
     }
 
 
+@api_router.get("/admin/token-cache/stats")
+async def get_token_cache_stats(user: dict = Depends(require_role(['superadmin']))):
+    """Verified-token cache hit/miss counters - Super Admin only"""
+    return token_cache.stats()
+
+
+@api_router.get("/admin/payroll-cache/stats")
+async def get_payroll_cache_stats(user: dict = Depends(require_role(['superadmin']))):
+    """Payroll result cache hit/miss/coalesced counters - Super Admin only"""
+    return payroll_cache.stats()
+
+
 @api_router.post("/admin/tenants/{tenant_id}/suspend")
 async def suspend_tenant(tenant_id: str, suspend: bool, user: dict = Depends(require_role(['superadmin']))):
     """Suspend or activate a tenant - Super Admin only"""
     tenant_ref = firebase_db.collection('tenants').document(tenant_id)
-    tenant_doc = tenant_ref.get()
+    tenant_doc = await tenant_ref.get()
     
     if not tenant_doc.exists:
         raise HTTPException(status_code=404, detail="Tenant not found")
     
     new_status = 'suspended' if suspend else 'active'
     
-    tenant_ref.update({
+    await tenant_ref.update({
         'status': new_status,
         'updatedAt': get_current_time().isoformat(),
         'updatedBy': user.get('uid')
@@ -2173,6 +3029,52 @@ async def suspend_tenant(tenant_id: str, suspend: bool, user: dict = Depends(req
     }
 
 
+payroll_run_tasks = {}  # Run ID -> background task executing it in this process
+
+
+@api_router.post("/admin/payroll/run")
+async def start_payroll_run(run_request: PayrollRunRequest, user: dict = Depends(require_role(['superadmin']))):
+    """
+    Compute a month's payroll for every tenant in a process pool - Super Admin only
+    
+    Starts in the background and returns the run ID; poll GET /admin/payroll/runs/{run_id}
+    for progress. Passing runId resumes an interrupted run (completed tenants are skipped).
+    """
+    now = get_current_time()
+    if run_request.runId:
+        run_doc = await payroll_run.run_ref(firebase_db, run_request.runId).get()
+        if not run_doc.exists:
+            raise HTTPException(status_code=404, detail="Payroll run not found")
+        run_id = run_request.runId
+    else:
+        if not run_request.year or not run_request.month:
+            raise HTTPException(status_code=400, detail="year and month are required to start a run")
+        run_id = await payroll_run.start_run(firebase_db, run_request.year, run_request.month, now, user.get('uid'))
+    
+    if run_id in payroll_run_tasks and not payroll_run_tasks[run_id].done():
+        raise HTTPException(status_code=409, detail="This payroll run is already in progress")
+    
+    async def execute():
+        try:
+            await payroll_run.execute_run(firebase_db, run_id, now, run_request.workers)
+        except Exception as e:
+            print(f"✗ Payroll run {run_id} error: {e}")
+        finally:
+            payroll_run_tasks.pop(run_id, None)
+    
+    payroll_run_tasks[run_id] = asyncio.create_task(execute())
+    return {'runId': run_id, 'status': 'RUNNING'}
+
+
+@api_router.get("/admin/payroll/runs/{run_id}")
+async def get_payroll_run(run_id: str, user: dict = Depends(require_role(['superadmin']))):
+    """Progress of a payroll run - Super Admin only"""
+    run_doc = await payroll_run.run_ref(firebase_db, run_id).get()
+    if not run_doc.exists:
+        raise HTTPException(status_code=404, detail="Payroll run not found")
+    return {**payroll_run.run_progress(run_doc.to_dict()), 'active': run_id in payroll_run_tasks}
+
+
 @api_router.put("/admin/tenants/{tenant_id}/subscription")
 async def update_subscription(
     tenant_id: str,
@@ -2181,12 +3083,12 @@ async def update_subscription(
 ):
     """Update tenant subscription end date - Super Admin only"""
     tenant_ref = firebase_db.collection('tenants').document(tenant_id)
-    tenant_doc = tenant_ref.get()
+    tenant_doc = await tenant_ref.get()
     
     if not tenant_doc.exists:
         raise HTTPException(status_code=404, detail="Tenant not found")
     
-    tenant_ref.update({
+    await tenant_ref.update({
         'subscriptionEnd': subscription_end,
         'updatedAt': get_current_time().isoformat(),
         'updatedBy': user.get('uid')
@@ -2201,6 +3103,8 @@ async def update_subscription(
 
 # ==================== PAYROLL EXPORT ROUTE ====================
 
+PAYROLL_EXPORT_PREFETCH = 8  # Employees computed ahead of the row being written
+
 @api_router.get("/export/payroll")
 async def export_payroll_csv(
     from_date: Optional[str] = None,
@@ -2210,144 +3114,102 @@ async def export_payroll_csv(
     """
     Export payroll data to CSV
     Includes: employee name, hours worked, salary, penalties, net pay
-    """
-    from fastapi.responses import StreamingResponse
-    import io
-    from datetime import datetime
     
+    Streamed per employee: a closed month comes from its snapshot, otherwise
+    each salaried employee's figures are computed (compute_payroll scoped to
+    them) just ahead of their row.
+    """
     tenant_id = user.get('tenantId')
+    now = get_current_time()
+    today = now.date()
     
     # Default to current month if no dates provided
     if not from_date or not to_date:
-        today = get_current_time().date()
         from_date = datetime(today.year, today.month, 1).isoformat()
         to_date = datetime.combine(today, datetime.max.time()).isoformat()
-    
-    # Get all employees for this tenant
-    from utils.helpers import get_all_employees
-    all_users = get_all_employees(firebase_db, tenant_id=tenant_id)
-    
-    # Create CSV content with BOM for Arabic support
-    csv_content = "\ufeff"  # UTF-8 BOM
-    csv_content += f"Payroll Report\n"
-    csv_content += f"Period: {from_date[:10]} to {to_date[:10]}\n"
-    csv_content += f"Generated: {get_current_time().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    csv_content += "Employee Name,Role,Hourly Rate,Hours Worked,Gross Pay,Late Count,Late Penalty,No-Show Count,No-Show Penalty,Net Pay\n"
-    
-    total_hours = 0
-    total_gross = 0
-    total_net = 0
-    
-    for user_doc in all_users:
-        user_data = user_doc.to_dict()
-        uid = user_doc.id
-        employee_name = user_data.get('name', 'Unknown')
-        role = user_data.get('role', 'EMPLOYEE')
-        hourly_rate = user_data.get('salary', 0)
+    start_date = datetime.fromisoformat(from_date).date()
+    end_date = datetime.fromisoformat(to_date).date()
+    
+    # A whole closed month is served from its snapshot
+    snapshot = None
+    if end_date < today and (start_date, end_date) == month_bounds(start_date.year, start_date.month):
+        snapshot = await payroll_periods.load_snapshot(firebase_db, tenant_id, start_date.year, start_date.month)
+    
+    async def compute_employee(user_doc):
+        results = await compute_payroll(firebase_db, tenant_id, start_date, end_date, now, TIMEZONE, employee_id=user_doc.id)
+        return payroll_periods.employee_snapshots([user_doc], results, []).get(user_doc.id)
+    
+    async def employee_figures():
+        if snapshot is not None:
+            for employee in snapshot['employees'].values():
+                yield employee
+            return
+        
+        # A few employees are computed concurrently, rows still come out in user order
+        pending = deque()
+        try:
+            async for user_doc in filter_by_tenant(firebase_db.collection('users'), tenant_id).stream():
+                if (user_doc.to_dict().get('salary', 0) or 0) <= 0:
+                    continue  # Not exported; skip their payroll reads
+                pending.append(asyncio.ensure_future(compute_employee(user_doc)))
+                if len(pending) >= PAYROLL_EXPORT_PREFETCH:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def generate_rows():
+        yield csv_row("Payroll Report")
+        yield csv_row(f"Period: {from_date[:10]} to {to_date[:10]}")
+        yield csv_row(f"Generated: {get_current_time().strftime('%Y-%m-%d %H:%M:%S')}")
+        if snapshot is not None:
+            yield csv_row(f"Closed: {snapshot['closedAt'][:10]} (snapshot {snapshot['checksum'][:12]})")
+        yield "\n"
+        yield csv_row(
+            "Employee Name", "Role", "Hourly Rate", "Hours Worked", "Gross Pay",
+            "Late Count", "Late Penalty", "No-Show Count", "No-Show Penalty", "Net Pay"
+        )
         
-        if not hourly_rate or hourly_rate <= 0:
-            continue
+        total_hours = 0
+        total_gross = 0
+        total_net = 0
         
-        # Get attendance for this period
-        all_attendance = list(firebase_db.collection('attendance').where(
-            'employeeId', '==', uid
-        ).where('tenantId', '==', tenant_id).stream())
-        
-        period_attendance = []
-        for att in all_attendance:
-            att_data = att.to_dict()
-            if att_data.get('status') == 'CLOCKED_OUT':
-                clock_in_time = att_data.get('clockInTime', '')
-                if from_date <= clock_in_time <= to_date:
-                    period_attendance.append(att)
-        
-        # Calculate hours and penalties
-        hours_worked = 0
-        late_count = 0
-        late_penalty_hours = 0
-        
-        for att in period_attendance:
-            att_data = att.to_dict()
-            clock_in = datetime.fromisoformat(att_data['clockInTime'].replace('Z', '+00:00'))
-            clock_out = datetime.fromisoformat(att_data['clockOutTime'].replace('Z', '+00:00'))
-            hours = (clock_out - clock_in).total_seconds() / 3600
-            hours_worked += hours
+        async for employee in employee_figures():
+            hourly_rate = employee['hourlyRate']
             
-            if att_data.get('isLate', False):
-                late_count += 1
-                if late_count > 2:
-                    shift_id = att_data.get('shiftId')
-                    if shift_id:
-                        shift_doc = firebase_db.collection('shifts').document(shift_id).get()
-                        if shift_doc.exists:
-                            shift_data = shift_doc.to_dict()
-                            start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
-                            end_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
-                            shift_hours = (end_time - start_time).total_seconds() / 3600
-                            late_penalty_hours += shift_hours * 0.5
-        
-        # Calculate no-shows
-        all_shifts = list(firebase_db.collection('shifts').where(
-            'employeeId', '==', uid
-        ).where('tenantId', '==', tenant_id).stream())
-        
-        no_show_count = 0
-        no_show_penalty_hours = 0
-        
-        from_date_obj = datetime.fromisoformat(from_date).date()
-        to_date_obj = datetime.fromisoformat(to_date).date()
-        
-        for shift in all_shifts:
-            shift_data = shift.to_dict()
-            shift_date_str = shift_data.get('date', '')
+            if hourly_rate <= 0:
+                continue
             
-            try:
-                shift_date = datetime.fromisoformat(shift_date_str).date()
-                
-                if from_date_obj <= shift_date <= to_date_obj:
-                    shift_id = shift.id
-                    has_attendance = any(
-                        att.to_dict().get('shiftId') == shift_id 
-                        for att in period_attendance
-                    )
-                    
-                    if not has_attendance:
-                        no_show_count += 1
-                        start_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['startTime']}")
-                        end_time = datetime.fromisoformat(f"{shift_date_str}T{shift_data['endTime']}")
-                        shift_hours = (end_time - start_time).total_seconds() / 3600
-                        no_show_penalty_hours += shift_hours * 2
-            except:
+            hours_worked = employee['hours']
+            
+            if hours_worked <= 0 and employee['noShowCount'] <= 0:
                 continue
-        
-        # Calculate earnings
-        from utils.helpers import calculate_net_earnings
-        earnings = calculate_net_earnings(hours_worked, hourly_rate, late_penalty_hours, no_show_penalty_hours)
-        
-        if hours_worked > 0 or no_show_count > 0:
-            csv_content += f"{employee_name},{role},{hourly_rate:.2f},{hours_worked:.2f},{earnings['gross']:.2f},{late_count},{earnings['late_penalty']:.2f},{no_show_count},{earnings['no_show_penalty']:.2f},{earnings['net']:.2f}\n"
+            
+            yield csv_row(
+                employee['employeeName'],
+                employee['role'],
+                f"{hourly_rate:.2f}",
+                f"{hours_worked:.2f}",
+                f"{employee['grossEarnings']:.2f}",
+                employee['lateCount'],
+                f"{employee['latePenalty']:.2f}",
+                employee['noShowCount'],
+                f"{employee['noShowPenalty']:.2f}",
+                f"{employee['netEarnings']:.2f}"
+            )
             
             total_hours += hours_worked
-            total_gross += earnings['gross']
-            total_net += earnings['net']
-    
-    # Add totals row
-    csv_content += f"\nTOTALS,,{total_hours:.2f},{total_gross:.2f},,,,{total_net:.2f}\n"
-    
-    # Create streaming response
-    output = io.StringIO()
-    output.write(csv_content)
-    output.seek(0)
+            total_gross += employee['grossEarnings']
+            total_net += employee['netEarnings']
+        
+        yield "\n"
+        yield csv_row("TOTALS", "", f"{total_hours:.2f}", f"{total_gross:.2f}", "", "", "", f"{total_net:.2f}")
     
     filename = f"payroll_{from_date[:7]}.csv"
     
-    return StreamingResponse(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        media_type="text/csv",
-        headers={
-            "Content-Disposition": f"attachment; filename={filename}"
-        }
-    )
+    return streaming_csv_response(generate_rows(), f"attachment; filename={filename}")
 
 
 # Mount API router
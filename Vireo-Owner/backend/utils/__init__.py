@@ -3,12 +3,27 @@ Backend utility helpers for VireoHR API
 """
 from .helpers import (
     get_user_document,
+    get_user_profile,
     calculate_net_earnings,
-    get_all_employees
+    get_all_employees,
+    get_employees_page
+)
+from .user_cache import user_cache
+from .batch_loader import DocumentLoader, ShiftLoader
+from .token_cache import (
+    token_cache,
+    verify_id_token_cached
 )
 
 __all__ = [
     'get_user_document',
+    'get_user_profile',
     'calculate_net_earnings',
-    'get_all_employees'
+    'get_all_employees',
+    'get_employees_page',
+    'user_cache',
+    'DocumentLoader',
+    'ShiftLoader',
+    'token_cache',
+    'verify_id_token_cached'
 ]
@@ -0,0 +1,63 @@
+"""
+Batched document loading for VireoHR
+Replaces per-record point reads inside loops with chunked get_all calls
+"""
+from typing import Optional, Dict, Any, Iterable
+
+
+# Document references sent per BatchGetDocuments call
+GET_ALL_CHUNK_SIZE = 300
+
+
+class DocumentLoader:
+    """
+    Request-scoped loader for documents of one collection
+
+    Collect IDs up front with prime(), then read them with load(); documents
+    are fetched with get_all in chunks and memoized for the rest of the
+    request. Missing documents are memoized as None.
+
+    Usage:
+        shifts = DocumentLoader(firebase_db, 'shifts')
+        await shifts.prime(att.get('shiftId') for att in records)
+        shift_data = await shifts.load(shift_id)
+    """
+
+    def __init__(self, firebase_db, collection: str):
+        self.firebase_db = firebase_db
+        self.collection = collection
+        self._docs: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    async def prime(self, doc_ids: Iterable[Optional[str]]):
+        """Fetch every not-yet-loaded ID in as few round trips as possible"""
+        pending = []
+        seen = set()
+        for doc_id in doc_ids:
+            if doc_id and doc_id not in self._docs and doc_id not in seen:
+                seen.add(doc_id)
+                pending.append(doc_id)
+
+        collection_ref = self.firebase_db.collection(self.collection)
+        for start in range(0, len(pending), GET_ALL_CHUNK_SIZE):
+            chunk = pending[start:start + GET_ALL_CHUNK_SIZE]
+            refs = [collection_ref.document(doc_id) for doc_id in chunk]
+            for doc_id in chunk:
+                self._docs[doc_id] = None
+            async for snapshot in self.firebase_db.get_all(refs):
+                if snapshot.exists:
+                    self._docs[snapshot.id] = snapshot.to_dict()
+
+    async def load(self, doc_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Return one document as a dict (None if missing), fetching it if not primed"""
+        if not doc_id:
+            return None
+        if doc_id not in self._docs:
+            await self.prime([doc_id])
+        return self._docs[doc_id]
+
+
+class ShiftLoader(DocumentLoader):
+    """Request-scoped batched loader for the 'shifts' collection"""
+
+    def __init__(self, firebase_db):
+        super().__init__(firebase_db, 'shifts')
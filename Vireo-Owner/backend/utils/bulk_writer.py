@@ -0,0 +1,297 @@
+"""
+Bulk writes for VireoHR
+Queues document writes and commits them as concurrent write batches with retry and throttling
+
+The AsyncClient has no BulkWriter, so this provides the same behaviour on
+top of WriteBatch: writes are grouped into batches of up to 500, at most
+max_in_flight batches are committed at once, and throughput follows
+Firestore's 500/50/5 ramp-up rule (start at 500 writes/s, +50% every
+5 minutes). Transient errors retry the batch with exponential backoff; a
+batch rejected for one of its documents (AlreadyExists, NotFound, ...) is
+split and retried write by write, so only that write fails.
+
+TransactionRunner applies the same throttling, retry and failure reporting
+to fan-outs of independent transactions (one per employee), for writes
+that must commit atomically with their payroll aggregate.
+"""
+from google.api_core import exceptions as api_exceptions
+from typing import Optional, Dict, List, Any, Tuple, Callable, Awaitable
+import asyncio
+import os
+import random
+import time
+
+
+BATCH_LIMIT = 500               # Firestore write batch limit
+RAMP_UP_INTERVAL_SECONDS = 300  # 500/50/5 rule: +50% every 5 minutes
+RAMP_UP_FACTOR = 1.5
+
+RETRYABLE_ERRORS = (
+    api_exceptions.Aborted,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.InternalServerError,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable
+)
+
+
+def _backoff_seconds(attempt: int) -> float:
+    """Jittered exponential backoff before retry number attempt + 1"""
+    return min(2 ** attempt, 30) * (0.5 + random.random() / 2)
+
+
+class RateLimiter:
+    """Spaces out writes to follow the 500/50/5 ramp-up rule"""
+
+    def __init__(self, ops_per_second: Optional[int] = None, max_ops_per_second: Optional[int] = None):
+        self.ops_per_second = ops_per_second or int(os.getenv('BULK_WRITER_OPS_PER_SECOND', 500))
+        self.max_ops_per_second = max_ops_per_second or int(os.getenv('BULK_WRITER_MAX_OPS_PER_SECOND', 10000))
+        self._started_at = time.monotonic()
+        self._next_slot = self._started_at
+        self._lock = asyncio.Lock()
+
+    def current_rate(self) -> float:
+        """Allowed writes per second under the 500/50/5 ramp"""
+        intervals = int((time.monotonic() - self._started_at) / RAMP_UP_INTERVAL_SECONDS)
+        return min(self.ops_per_second * RAMP_UP_FACTOR ** intervals, self.max_ops_per_second)
+
+    async def acquire(self, ops: int):
+        """Wait for the slot of ops writes"""
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + ops / self.current_rate()
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def retry_transient(
+    operation: Callable[..., Awaitable[Any]],
+    *args,
+    max_attempts: Optional[int] = None,
+    limiter: Optional[RateLimiter] = None,
+    ops: int = 1
+) -> Any:
+    """
+    Await operation(*args), retrying transient errors with jittered exponential backoff
+
+    Args:
+        operation: Coroutine function doing the writes (e.g. a transaction)
+        max_attempts: Attempts before the last transient error is raised
+        limiter: Throttle each attempt through this rate limiter
+        ops: Writes per attempt, for the limiter
+
+    Raises:
+        The last transient error once attempts run out; any other error at once
+    """
+    max_attempts = max_attempts or int(os.getenv('BULK_WRITER_MAX_ATTEMPTS', 5))
+    for attempt in range(max_attempts):
+        if limiter is not None:
+            await limiter.acquire(ops)
+        try:
+            return await operation(*args)
+        except RETRYABLE_ERRORS:
+            if attempt == max_attempts - 1:
+                raise
+            await asyncio.sleep(_backoff_seconds(attempt))
+
+
+class BulkWriteResult:
+    """
+    Outcome of a BulkWriter or TransactionRunner: tags of the writes that
+    landed and of those that failed (plus each transaction's return value)
+    """
+
+    def __init__(self):
+        self.written: List[Any] = []
+        self.failed: List[Tuple[Any, Exception]] = []
+        self.values: Dict[Any, Any] = {}
+
+    @property
+    def failed_tags(self) -> set:
+        return {tag for tag, _ in self.failed}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'written': len(self.written), 'failed': len(self.failed)}
+
+
+class BulkWriter:
+    """
+    Writer for large numbers of independent document writes
+
+    Writes are not atomic with each other, so only use it for writes that
+    stand on their own; writes that must land together belong in one
+    WriteBatch or transaction (see TransactionRunner for many of those).
+    Tag a write to find out whether it landed.
+    Batches start committing as soon as they fill up.
+
+    Usage:
+        writer = BulkWriter(firebase_db)
+        for key in expired_keys:
+            writer.delete(firebase_db.collection('idempotency_keys').document(key), tag=key)
+        result = await writer.close()
+    """
+
+    def __init__(
+        self,
+        firebase_db,
+        batch_size: int = BATCH_LIMIT,
+        max_in_flight: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        ops_per_second: Optional[int] = None,
+        max_ops_per_second: Optional[int] = None
+    ):
+        self.firebase_db = firebase_db
+        self.batch_size = min(batch_size, BATCH_LIMIT)
+        self.max_attempts = max_attempts
+        self._limiter = RateLimiter(ops_per_second, max_ops_per_second)
+        self._semaphore = asyncio.Semaphore(max_in_flight or int(os.getenv('BULK_WRITER_MAX_IN_FLIGHT', 10)))
+        self._pending: List[Tuple[str, Any, Any, Any]] = []
+        self._tasks: List[asyncio.Task] = []
+        self._result = BulkWriteResult()
+        self._closed = False
+
+    def create(self, ref, data: Dict[str, Any], tag: Any = None):
+        """Create a document (fails with AlreadyExists if it exists)"""
+        self._add('create', ref, data, tag)
+
+    def set(self, ref, data: Dict[str, Any], merge: bool = False, tag: Any = None):
+        self._add('set_merge' if merge else 'set', ref, data, tag)
+
+    def update(self, ref, data: Dict[str, Any], tag: Any = None):
+        """Update fields of an existing document (fails with NotFound if it is missing)"""
+        self._add('update', ref, data, tag)
+
+    def delete(self, ref, tag: Any = None):
+        self._add('delete', ref, None, tag)
+
+    def _add(self, op: str, ref, data: Optional[Dict[str, Any]], tag: Any):
+        if self._closed:
+            raise RuntimeError("BulkWriter is closed")
+        self._pending.append((op, ref, data, tag))
+        if len(self._pending) >= self.batch_size:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        if self._pending:
+            writes, self._pending = self._pending, []
+            self._tasks.append(asyncio.create_task(self._commit(writes)))
+
+    async def flush(self):
+        """Commit everything queued so far"""
+        self._flush_pending()
+        tasks, self._tasks = self._tasks, []
+        await asyncio.gather(*tasks)
+
+    async def close(self) -> BulkWriteResult:
+        """Commit everything queued and return the outcome; the writer cannot be reused"""
+        await self.flush()
+        self._closed = True
+        return self._result
+
+    async def _commit_batch(self, writes: List[Tuple[str, Any, Any, Any]]):
+        batch = self.firebase_db.batch()
+        for op, ref, data, _ in writes:
+            if op == 'create':
+                batch.create(ref, data)
+            elif op == 'set':
+                batch.set(ref, data)
+            elif op == 'set_merge':
+                batch.set(ref, data, merge=True)
+            elif op == 'update':
+                batch.update(ref, data)
+            else:
+                batch.delete(ref)
+        await batch.commit()
+
+    async def _commit(self, writes: List[Tuple[str, Any, Any, Any]]):
+        async with self._semaphore:
+            error = await self._commit_with_retry(writes)
+
+        if error is None:
+            self._result.written.extend(tag for _, _, _, tag in writes if tag is not None)
+        elif len(writes) > 1 and not isinstance(error, RETRYABLE_ERRORS):
+            # One bad document fails the whole batch: isolate it
+            await asyncio.gather(*(self._commit([write]) for write in writes))
+        else:
+            if not isinstance(error, api_exceptions.AlreadyExists):
+                print(f"✗ Bulk write failed ({len(writes)} writes): {error}")
+            self._result.failed.extend((tag, error) for _, _, _, tag in writes if tag is not None)
+
+    async def _commit_with_retry(self, writes: List[Tuple[str, Any, Any, Any]]) -> Optional[Exception]:
+        """Commit one batch, retrying transient errors; returns the final error (None on success)"""
+        try:
+            await retry_transient(
+                self._commit_batch, writes,
+                max_attempts=self.max_attempts, limiter=self._limiter, ops=len(writes)
+            )
+            return None
+        except Exception as e:
+            return e
+
+
+class TransactionRunner:
+    """
+    Fan-out of independent transactions with BulkWriter's throttling and retry
+
+    Each job is a coroutine function that commits its own transaction (e.g.
+    payroll_aggregates.commit_with_aggregates for one employee). At most
+    max_in_flight run at once, each attempt takes ops slots of the 500/50/5
+    ramp, and transient errors are retried with backoff. Failed jobs are
+    reported by tag in the result instead of raised; callers log them with
+    their own context.
+
+    Usage:
+        runner = TransactionRunner()
+        for employee_id, employee_shifts in by_employee.items():
+            runner.run(_create_no_shows, firebase_db, employee_shifts, now, timezone, tag=employee_id)
+        result = await runner.close()
+        for employee_id, error in result.failed:
+            ...
+    """
+
+    def __init__(
+        self,
+        max_in_flight: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        ops_per_second: Optional[int] = None,
+        max_ops_per_second: Optional[int] = None
+    ):
+        self.max_attempts = max_attempts
+        self._limiter = RateLimiter(ops_per_second, max_ops_per_second)
+        self._semaphore = asyncio.Semaphore(max_in_flight or int(os.getenv('BULK_WRITER_MAX_IN_FLIGHT', 10)))
+        self._tasks: List[asyncio.Task] = []
+        self._result = BulkWriteResult()
+        self._closed = False
+
+    def run(self, operation: Callable[..., Awaitable[Any]], *args, tag: Any = None, ops: int = 2):
+        """
+        Queue operation(*args); it starts as soon as a slot is free
+
+        Args:
+            tag: Key of the job in the result (written / failed / values)
+            ops: Writes per transaction, for throttling (default: one
+                document plus its payroll aggregate)
+        """
+        if self._closed:
+            raise RuntimeError("TransactionRunner is closed")
+        self._tasks.append(asyncio.create_task(self._run(operation, args, tag, ops)))
+
+    async def _run(self, operation, args, tag, ops):
+        async with self._semaphore:
+            try:
+                value = await retry_transient(
+                    operation, *args, max_attempts=self.max_attempts, limiter=self._limiter, ops=ops
+                )
+            except Exception as e:
+                self._result.failed.append((tag, e))
+                return
+        self._result.written.append(tag)
+        self._result.values[tag] = value
+
+    async def close(self) -> BulkWriteResult:
+        """Wait for every queued job and return the outcome; the runner cannot be reused"""
+        self._closed = True
+        tasks, self._tasks = self._tasks, []
+        await asyncio.gather(*tasks)
+        return self._result
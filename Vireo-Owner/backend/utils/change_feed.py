@@ -0,0 +1,168 @@
+"""
+Attendance and shift change feed for VireoHR
+Bounded in-process log of today's attendance/shift changes, fed by Firestore snapshot listeners
+
+Each event carries a cursor ("<epoch>:<seq>"). Server-sent event clients
+resume from their last cursor; when it is from another process or has
+fallen out of the buffer they receive a fresh snapshot instead.
+"""
+from collections import deque
+from typing import Optional, Dict, List, Any
+import asyncio
+import json
+import os
+import threading
+import uuid
+
+from .tenant import tenant_key
+
+
+HEARTBEAT_SECONDS = int(os.getenv('CHANGE_FEED_HEARTBEAT_SECONDS', 15))
+
+
+def sse_message(event: str, data: Any, event_id: Optional[str] = None) -> str:
+    """Format one server-sent event"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class ChangeFeed:
+    """
+    Sequence-numbered ring buffer of change events
+
+    Listener callbacks publish from background threads; subscribers wait on
+    asyncio events that are set thread-safely on their own loop.
+    """
+
+    def __init__(self, buffer_size: int = 5000):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._events: deque = deque(maxlen=buffer_size)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._waiters: Dict[asyncio.Event, asyncio.AbstractEventLoop] = {}
+        self._watches = []
+
+    def cursor(self) -> str:
+        """Cursor of the latest published event"""
+        with self._lock:
+            return f"{self.epoch}:{self._seq}"
+
+    def parse_cursor(self, cursor: Optional[str]) -> Optional[int]:
+        """Sequence number of a cursor from this process (None = unusable)"""
+        if not cursor:
+            return None
+        epoch, _, seq = cursor.partition(':')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def publish(self, kind: str, op: str, doc_id: Optional[str], data: Optional[Dict[str, Any]],
+                tenant_id: Optional[str] = None, store_id: Optional[str] = None, broadcast: bool = False):
+        """
+        Append an event and wake every subscriber
+
+        Args:
+            kind: 'attendance', 'shift' or 'day'
+            op: 'upsert', 'delete' or 'reset'
+            doc_id: Document ID the event is about
+            data: Document data (None for deletes)
+            tenant_id: Tenant the document belongs to
+            store_id: Store the document belongs to
+            broadcast: Deliver to every subscriber regardless of scope
+        """
+        with self._lock:
+            self._seq += 1
+            self._events.append({
+                'seq': self._seq,
+                'kind': kind,
+                'op': op,
+                'id': doc_id,
+                'data': data,
+                'tenantKey': None if broadcast else tenant_key(tenant_id),
+                'storeId': None if broadcast else store_id
+            })
+            waiters = list(self._waiters.items())
+
+        for event, loop in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def events_since(self, seq: int) -> Optional[List[Dict[str, Any]]]:
+        """Events after seq, or None if some of them were already evicted"""
+        with self._lock:
+            if self._events and self._events[0]['seq'] > seq + 1:
+                return None
+            if seq > self._seq:
+                return None
+            return [event for event in self._events if event['seq'] > seq]
+
+    @staticmethod
+    def matches(event: Dict[str, Any], tenant_id: Optional[str], store_id: Optional[str]) -> bool:
+        """
+        Whether an event is visible to a subscriber scope
+
+        Args:
+            tenant_id: Subscriber's tenant (None = every tenant)
+            store_id: Subscriber's store (None = every store)
+        """
+        if event['tenantKey'] is None:
+            return True
+        if tenant_id is not None and event['tenantKey'] != tenant_key(tenant_id):
+            return False
+        return store_id is None or event['storeId'] == store_id
+
+    def register(self) -> asyncio.Event:
+        """Wake-up event for one subscriber (call from its event loop)"""
+        event = asyncio.Event()
+        with self._lock:
+            self._waiters[event] = asyncio.get_running_loop()
+        return event
+
+    def unregister(self, event: asyncio.Event):
+        with self._lock:
+            self._waiters.pop(event, None)
+
+    def watch(self, query, kind: str):
+        """
+        Publish a synchronous-client query's changes (the initial snapshot is skipped)
+
+        Args:
+            query: Firestore query from the sync client (the async client has no on_snapshot)
+            kind: Event kind for its documents ('attendance' or 'shift')
+        """
+        initial = [True]
+
+        def on_snapshot(docs, changes, read_time):
+            if initial[0]:
+                initial[0] = False
+                return
+            for change in changes:
+                data = change.document.to_dict() or {}
+                deleted = change.type.name == 'REMOVED'
+                self.publish(
+                    kind, 'delete' if deleted else 'upsert', change.document.id,
+                    None if deleted else {'id': change.document.id, **data},
+                    data.get('tenantId'), data.get('storeId')
+                )
+
+        self._watches.append(query.on_snapshot(on_snapshot))
+
+    def stop_watches(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'cursor': self.cursor(),
+            'buffered': len(self._events),
+            'subscribers': len(self._waiters),
+            'watches': len(self._watches)
+        }
+
+
+# Global change feed (one per process)
+change_feed = ChangeFeed(buffer_size=int(os.getenv('CHANGE_FEED_BUFFER', 5000)))
@@ -0,0 +1,80 @@
+"""
+Document counting for VireoHR
+Firestore aggregation (count()) queries scoped per tenant
+
+A count() query is evaluated server-side and billed at one read per 1000
+index entries, instead of downloading every matching document to len() it.
+"""
+from typing import Optional
+import asyncio
+
+
+MAX_STORES = 50  # Stores per tenant
+LEGACY_TENANT_FIELD = 'legacyData'  # Set by migrate_multi_tenant.py on the tenant that owns pre-tenancy data
+
+
+def _scoped(query, tenant_id: Optional[str]):
+    """Filter a query to one tenant (None = super admin, every tenant)"""
+    return query.where('tenantId', '==', tenant_id) if tenant_id is not None else query
+
+
+async def count_documents(query) -> int:
+    """
+    Number of documents matching a query, via an aggregation query
+
+    Usage:
+        count = await count_documents(firebase_db.collection('stores').where('tenantId', '==', tenant_id))
+    """
+    results = await query.count(alias='count').get()
+    return int(results[0][0].value) if results else 0
+
+
+async def count_unstamped(firebase_db, collection: str) -> int:
+    """
+    Documents of a collection without a tenantId (missing or null), written before multi-tenancy
+
+    A missing field cannot be matched by a filter, so this is every document
+    minus those whose tenantId is set (two count queries).
+    """
+    collection_ref = firebase_db.collection(collection)
+    total, stamped = await asyncio.gather(
+        count_documents(collection_ref),
+        count_documents(collection_ref.where('tenantId', '!=', None))
+    )
+    return total - stamped
+
+
+async def count_stores(firebase_db, tenant_id: Optional[str]) -> int:
+    """
+    A tenant's stores for the MAX_STORES cap
+
+    Stores without a tenantId predate multi-tenancy, so they belong to the
+    tenant migrate_multi_tenant.py created for that data (marked with
+    LEGACY_TENANT_FIELD) and count towards its cap only, until
+    --backfill-only stamps them. Other tenants count just their own stores.
+    """
+    stores_ref = firebase_db.collection('stores')
+    if tenant_id is None:
+        return await count_documents(stores_ref)
+    scoped, tenant_doc = await asyncio.gather(
+        count_documents(_scoped(stores_ref, tenant_id)),
+        firebase_db.collection('tenants').document(tenant_id).get()
+    )
+    if not (tenant_doc.exists and tenant_doc.to_dict().get(LEGACY_TENANT_FIELD)):
+        return scoped
+    return scoped + await count_unstamped(firebase_db, 'stores')
+
+
+async def count_employees(firebase_db, tenant_id: Optional[str]) -> int:
+    return await count_documents(_scoped(firebase_db.collection('users'), tenant_id))
+
+
+async def count_pending_leaves(firebase_db, tenant_id: Optional[str]) -> int:
+    query = firebase_db.collection('leave_requests').where('status', '==', 'PENDING')
+    return await count_documents(_scoped(query, tenant_id))
+
+
+async def count_open_attendance(firebase_db, tenant_id: Optional[str]) -> int:
+    """Attendance records still clocked in"""
+    query = firebase_db.collection('attendance').where('status', '==', 'CLOCKED_IN')
+    return await count_documents(_scoped(query, tenant_id))
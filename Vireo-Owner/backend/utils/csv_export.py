@@ -0,0 +1,58 @@
+"""
+Streaming CSV helpers for VireoHR exports
+Rows are produced by async generators and flushed in small chunks as Firestore documents arrive
+"""
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Any
+import csv
+import io
+
+
+UTF8_BOM = "\ufeff"          # Lets Excel open Arabic text correctly
+FLUSH_BYTES = 16 * 1024    # Flush to the client roughly every 16 KB
+
+
+def csv_row(*values: Any) -> str:
+    """Format one CSV line (quoting only when a value needs it)"""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(values)
+    return buffer.getvalue()
+
+
+def format_minutes(total_minutes: int) -> str:
+    """Format a minute count as HH:MM"""
+    return f"{total_minutes // 60:02d}:{total_minutes % 60:02d}"
+
+
+async def _encode_chunks(lines: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    pending = [UTF8_BOM]
+    size = 0
+    async for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= FLUSH_BYTES:
+            yield ''.join(pending).encode('utf-8')
+            pending = []
+            size = 0
+    if pending:
+        yield ''.join(pending).encode('utf-8')
+
+
+def streaming_csv_response(lines: AsyncIterator[str], content_disposition: str) -> StreamingResponse:
+    """
+    Wrap an async generator of CSV lines in a UTF-8 (with BOM) streaming response
+
+    Args:
+        lines: Async generator yielding CSV text lines
+        content_disposition: Full Content-Disposition header value
+
+    Usage:
+        return streaming_csv_response(generate_rows(), f"attachment; filename*=UTF-8''{filename}")
+    """
+    return StreamingResponse(
+        _encode_chunks(lines),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": content_disposition
+        }
+    )
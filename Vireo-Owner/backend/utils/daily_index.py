@@ -0,0 +1,148 @@
+"""
+Daily shift and store index for VireoHR
+Today's shifts (by shift ID and by employee) and every store's geofence, held in memory
+
+Built at startup and at local midnight, refreshed by the shift/store write
+endpoints and, when enabled, by snapshot listeners (so writes made on other
+replicas are seen). Lookups that miss (another day's shift, a store created
+elsewhere moments ago) fall back to a Firestore read in the caller.
+"""
+from typing import Optional, Dict, List, Any, Set
+import threading
+
+
+class DailyIndex:
+    """
+    In-memory index of one day's shifts and all stores
+
+    Thread-safe: snapshot listeners call in from background threads.
+    """
+
+    def __init__(self):
+        self.day: Optional[str] = None
+        self._shifts: Dict[str, Dict[str, Any]] = {}
+        self._by_employee: Dict[str, Set[str]] = {}
+        self._stores: Dict[str, Dict[str, Any]] = {}
+        self.stores_version = 0  # Bumped on every store change (lets derived indexes rebuild lazily)
+        self._lock = threading.Lock()
+        self._watches = []
+
+    def _remove_shift(self, shift_id: str):
+        shift_data = self._shifts.pop(shift_id, None)
+        if shift_data is None:
+            return
+        shift_ids = self._by_employee.get(shift_data.get('employeeId'))
+        if shift_ids is not None:
+            shift_ids.discard(shift_id)
+            if not shift_ids:
+                del self._by_employee[shift_data.get('employeeId')]
+
+    def put_shift(self, shift_id: str, shift_data: Dict[str, Any]):
+        """Add or refresh a shift (shifts on other days are dropped)"""
+        with self._lock:
+            self._remove_shift(shift_id)
+            if shift_data.get('date') != self.day:
+                return
+            self._shifts[shift_id] = dict(shift_data)
+            self._by_employee.setdefault(shift_data.get('employeeId'), set()).add(shift_id)
+
+    def remove_shift(self, shift_id: str):
+        with self._lock:
+            self._remove_shift(shift_id)
+
+    def put_store(self, store_id: str, store_data: Dict[str, Any]):
+        with self._lock:
+            self._stores[store_id] = dict(store_data)
+            self.stores_version += 1
+
+    def remove_store(self, store_id: str):
+        with self._lock:
+            if self._stores.pop(store_id, None) is not None:
+                self.stores_version += 1
+
+    def get_shift(self, shift_id: str) -> Optional[Dict[str, Any]]:
+        """Today's shift by ID (None if unknown or not today)"""
+        with self._lock:
+            shift_data = self._shifts.get(shift_id)
+            return dict(shift_data) if shift_data is not None else None
+
+    def shifts_for_employee(self, employee_id: str) -> List[Dict[str, Any]]:
+        """An employee's shifts today"""
+        with self._lock:
+            return [dict(self._shifts[shift_id]) for shift_id in self._by_employee.get(employee_id, ())]
+
+    def get_store(self, store_id: str) -> Optional[Dict[str, Any]]:
+        """Store by ID (name, lat, lng, radius, ...)"""
+        with self._lock:
+            store_data = self._stores.get(store_id)
+            return dict(store_data) if store_data is not None else None
+
+    def stores(self) -> Dict[str, Dict[str, Any]]:
+        """Snapshot of every indexed store (store ID -> data)"""
+        with self._lock:
+            return {store_id: dict(store_data) for store_id, store_data in self._stores.items()}
+
+    async def build(self, firebase_db, day: str):
+        """
+        Load a day's shifts and every store, replacing the current contents
+
+        Args:
+            firebase_db: Firestore AsyncClient instance
+            day: ISO date (local TIMEZONE) to index shifts for
+        """
+        shifts = [doc async for doc in firebase_db.collection('shifts').where('date', '==', day).stream()]
+        stores = [doc async for doc in firebase_db.collection('stores').stream()]
+
+        with self._lock:
+            self.day = day
+            self._shifts = {}
+            self._by_employee = {}
+            self._stores = {doc.id: doc.to_dict() for doc in stores}
+            self.stores_version += 1
+
+        for doc in shifts:
+            self.put_shift(doc.id, doc.to_dict())
+
+    def watch(self, shifts_query, stores_query):
+        """
+        Follow shift and store changes with snapshot listeners
+
+        Args:
+            shifts_query: Sync-client query on the indexed day's shifts
+            stores_query: Sync-client query on stores
+        """
+        self.stop_watches()
+
+        def on_shifts(docs, changes, read_time):
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self.remove_shift(change.document.id)
+                else:
+                    self.put_shift(change.document.id, change.document.to_dict())
+
+        def on_stores(docs, changes, read_time):
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self.remove_store(change.document.id)
+                else:
+                    self.put_store(change.document.id, change.document.to_dict())
+
+        self._watches = [shifts_query.on_snapshot(on_shifts), stores_query.on_snapshot(on_stores)]
+
+    def stop_watches(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'day': self.day,
+            'shifts': len(self._shifts),
+            'employees': len(self._by_employee),
+            'stores': len(self._stores),
+            'listening': bool(self._watches)
+        }
+
+
+# Global daily index (one per process)
+daily_index = DailyIndex()
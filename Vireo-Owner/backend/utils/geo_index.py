@@ -0,0 +1,152 @@
+"""
+Store geofence index for VireoHR
+Uniform-grid index over store geofences with a vectorized haversine
+
+Each store is registered in every grid cell its geofence circle overlaps,
+so locating a coordinate only measures the stores of one cell. Indexes are
+built per tenant (plus one across all tenants for super admins) and rebuilt
+lazily when the store data version changes.
+"""
+from typing import Optional, Dict, Any, Callable, Tuple
+import math
+import threading
+import numpy as np
+
+
+EARTH_RADIUS_METERS = 6371000   # Same as calculate_distance in server.py
+METERS_PER_DEGREE = 111320      # Length of one degree of latitude
+CELL_DEGREES = 0.01             # ~1.1 km cells
+DEFAULT_RADIUS_METERS = 10      # Same default as the clock-in geofence
+ALL_TENANTS_KEY = '*'
+
+
+def haversine_many(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """Distances in meters from one coordinate to arrays of coordinates"""
+    phi1 = math.radians(lat)
+    phi2 = np.radians(lats)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(lngs) - math.radians(lng)
+
+    a = np.sin(delta_phi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def haversine_pairs(lats1: np.ndarray, lngs1: np.ndarray, lats2: np.ndarray, lngs2: np.ndarray) -> np.ndarray:
+    """Element-wise distances in meters between two arrays of coordinates"""
+    phi1 = np.radians(lats1)
+    phi2 = np.radians(lats2)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(lngs2) - np.radians(lngs1)
+
+    a = np.sin(delta_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def _cell(lat: float, lng: float) -> Tuple[int, int]:
+    return math.floor(lat / CELL_DEGREES), math.floor(lng / CELL_DEGREES)
+
+
+class StoreGeoIndex:
+    """Grid index over a fixed set of stores"""
+
+    def __init__(self, stores: Dict[str, Dict[str, Any]]):
+        located = [
+            (store_id, store_data) for store_id, store_data in stores.items()
+            if store_data.get('lat') is not None and store_data.get('lng') is not None
+        ]
+        self.store_ids = [store_id for store_id, _ in located]
+        self.stores = [store_data for _, store_data in located]
+        self.lats = np.array([store_data['lat'] for store_data in self.stores], dtype=float)
+        self.lngs = np.array([store_data['lng'] for store_data in self.stores], dtype=float)
+        self.radii = np.array(
+            [store_data.get('radius') or DEFAULT_RADIUS_METERS for store_data in self.stores], dtype=float
+        )
+
+        cells: Dict[Tuple[int, int], list] = {}
+        for index, (lat, lng, radius) in enumerate(zip(self.lats, self.lngs, self.radii)):
+            # Register the store in every cell its geofence's bounding box touches
+            delta_lat = radius / METERS_PER_DEGREE
+            delta_lng = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+            min_row, min_col = _cell(lat - delta_lat, lng - delta_lng)
+            max_row, max_col = _cell(lat + delta_lat, lng + delta_lng)
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    cells.setdefault((row, col), []).append(index)
+        self.cells = {cell: np.array(indexes, dtype=int) for cell, indexes in cells.items()}
+
+    def locate(self, lat: float, lng: float) -> Optional[Dict[str, Any]]:
+        """
+        Store whose geofence contains a coordinate, else the nearest store
+
+        Returns:
+            {'storeId', 'store', 'distance', 'withinGeofence'} or None if there are no stores
+        """
+        if not self.store_ids:
+            return None
+
+        candidates = self.cells.get(_cell(lat, lng))
+        if candidates is not None:
+            distances = haversine_many(lat, lng, self.lats[candidates], self.lngs[candidates])
+            inside = distances <= self.radii[candidates]
+            if inside.any():
+                # Overlapping geofences: the nearest center wins
+                best = int(np.argmin(np.where(inside, distances, np.inf)))
+                return self._match(int(candidates[best]), float(distances[best]), True)
+
+        distances = haversine_many(lat, lng, self.lats, self.lngs)
+        best = int(np.argmin(distances))
+        return self._match(best, float(distances[best]), False)
+
+    def _match(self, index: int, distance: float, within: bool) -> Dict[str, Any]:
+        return {
+            'storeId': self.store_ids[index],
+            'store': {'id': self.store_ids[index], **self.stores[index]},
+            'distance': distance,
+            'withinGeofence': within
+        }
+
+
+class StoreLocator:
+    """Per-tenant StoreGeoIndex cache, rebuilt when the store data version changes"""
+
+    def __init__(self):
+        self._indexes: Dict[str, Tuple[int, StoreGeoIndex]] = {}
+        self._lock = threading.Lock()
+
+    def index(self, tenant_id: Optional[str], version: int,
+              load_stores: Callable[[], Dict[str, Dict[str, Any]]]) -> StoreGeoIndex:
+        """
+        Geo index of a tenant's stores
+
+        Args:
+            tenant_id: Tenant to index (None = every tenant, for super admins)
+            version: Current store data version
+            load_stores: Returns every store (store ID -> data); only called on rebuild
+        """
+        key = tenant_id or ALL_TENANTS_KEY
+        with self._lock:
+            cached = self._indexes.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        stores = load_stores()
+        if tenant_id is not None:
+            stores = {store_id: data for store_id, data in stores.items() if data.get('tenantId') == tenant_id}
+        index = StoreGeoIndex(stores)
+        with self._lock:
+            self._indexes[key] = (version, index)
+        return index
+
+    def locate(self, tenant_id: Optional[str], lat: float, lng: float, version: int,
+               load_stores: Callable[[], Dict[str, Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """
+        Locate a coordinate among a tenant's stores
+
+        Usage:
+            match = store_locator.locate(tenant_id, lat, lng, daily_index.stores_version, daily_index.stores)
+        """
+        return self.index(tenant_id, version, load_stores).locate(lat, lng)
+
+
+# Global store locator
+store_locator = StoreLocator()
@@ -3,16 +3,42 @@ Helper functions for VireoHR backend API
 Consolidates duplicate logic across endpoints
 """
 from fastapi import HTTPException
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple
 
+from .user_cache import user_cache
+from .pagination import paginate
 
-def get_user_document(uid: str, firebase_db, tenant_id: Optional[str] = None) -> Dict[str, Any]:
+
+async def get_user_profile(uid: str, firebase_db) -> Optional[Dict[str, Any]]:
+    """
+    Fetch a user document through the shared profile cache
+    
+    Args:
+        uid: Firebase user ID
+        firebase_db: Firestore AsyncClient instance
+        
+    Returns:
+        User document as dictionary, or None if it does not exist
+    """
+    user_data = user_cache.get(uid)
+    if user_data is not None:
+        return user_data
+    
+    user_doc = await firebase_db.collection('users').document(uid).get()
+    if not user_doc.exists:
+        return None
+    
+    user_data = user_doc.to_dict()
+    user_cache.put(uid, user_data)
+    return user_data
+
+async def get_user_document(uid: str, firebase_db, tenant_id: Optional[str] = None) -> Dict[str, Any]:
     """
-    Fetch user document from Firestore with existence validation
+    Fetch user document (via the profile cache) with existence validation
     
     Args:
         uid: Firebase user ID
-        firebase_db: Firestore client instance
+        firebase_db: Firestore AsyncClient instance
         tenant_id: Optional tenant ID for multi-tenant filtering
         
     Returns:
@@ -23,16 +49,14 @@ def get_user_document(uid: str, firebase_db, tenant_id: Optional[str] = None) ->
         HTTPException: 403 if user belongs to different tenant
         
     Usage:
-        user_data = get_user_document(uid, firebase_db, tenant_id)
+        user_data = await get_user_document(uid, firebase_db, tenant_id)
     """
-    user_doc = firebase_db.collection('users').document(uid).get()
+    user_data = await get_user_profile(uid, firebase_db)
     
-    if not user_doc.exists:
+    if user_data is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_data = user_doc.to_dict()
-    
-    # Tenant isolation check
+    # Tenant isolation check (applied to cached and fresh reads alike)
     if tenant_id is not None and user_data.get('tenantId') != tenant_id:
         raise HTTPException(status_code=403, detail="Access denied to this tenant's data")
     
@@ -85,7 +109,7 @@ def calculate_net_earnings(
     }
 
 
-def get_all_employees(
+async def get_all_employees(
     firebase_db,
     exclude_owner_for_co: bool = False,
     current_user_role: Optional[str] = None,
@@ -95,7 +119,7 @@ def get_all_employees(
     Fetch all employees from Firestore with optional CO filtering and tenant isolation
     
     Args:
-        firebase_db: Firestore client instance
+        firebase_db: Firestore AsyncClient instance
         exclude_owner_for_co: If True and user is CO, filter out OWNER (default: False)
         current_user_role: Current user's role (required if exclude_owner_for_co is True)
         tenant_id: Optional tenant ID for multi-tenant filtering (None = super admin)
@@ -105,28 +129,64 @@ def get_all_employees(
         
     Usage:
         # Get all employees for a tenant
-        all_users = get_all_employees(firebase_db, tenant_id='uuid-123')
+        all_users = await get_all_employees(firebase_db, tenant_id='uuid-123')
         
         # Get all employees (CO can't see OWNER)
-        all_users = get_all_employees(
+        all_users = await get_all_employees(
             firebase_db,
             exclude_owner_for_co=True,
             current_user_role='CO',
             tenant_id='uuid-123'
         )
     """
+    all_users, _ = await get_employees_page(
+        firebase_db,
+        exclude_owner_for_co=exclude_owner_for_co,
+        current_user_role=current_user_role,
+        tenant_id=tenant_id
+    )
+    return all_users
+
+async def get_employees_page(
+    firebase_db,
+    exclude_owner_for_co: bool = False,
+    current_user_role: Optional[str] = None,
+    tenant_id: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[List[str]] = None
+) -> Tuple[List[Any], Optional[str]]:
+    """
+    Fetch one page of employees, ordered by user ID
+    
+    Same filtering as get_all_employees. Filtered-out OWNER accounts still
+    count towards the page, so a page can hold fewer than limit employees.
+    
+    Args:
+        limit: Page size (None = all remaining employees)
+        cursor: Token returned with the previous page
+        fields: Projection from parse_fields() ('role' is added when filtering)
+        
+    Returns:
+        (document snapshots, next page token or None on the last page)
+    """
     # Apply tenant filter if provided
-    query = firebase_db.collection('users')
+    users_ref = firebase_db.collection('users')
+    query = users_ref
     if tenant_id is not None:
         query = query.where('tenantId', '==', tenant_id)
     
-    all_users = list(query.stream())
+    exclude_owner = exclude_owner_for_co and current_user_role == 'CO'
+    if fields is not None and exclude_owner:
+        fields = list(dict.fromkeys(fields + ['role']))
+    
+    all_users, next_cursor = await paginate(query, users_ref, [], limit, cursor, fields)
     
     # CO users cannot see OWNER accounts
-    if exclude_owner_for_co and current_user_role == 'CO':
-        return [
+    if exclude_owner:
+        all_users = [
             u for u in all_users 
             if u.to_dict().get('role', '').upper() != 'OWNER'
         ]
     
-    return all_users
+    return all_users, next_cursor
@@ -0,0 +1,149 @@
+"""
+Idempotency-Key support for VireoHR write endpoints
+TTL store of successful responses, in memory with an optional Firestore spill
+
+A retried request carrying the same Idempotency-Key (for the same caller
+and endpoint) gets the first response back without re-running the handler.
+Only successful responses are stored, so a request that failed validation
+(e.g. outside the geofence) can be retried for real. Concurrent duplicates
+wait for the first request instead of racing it.
+"""
+from fastapi import HTTPException
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Callable, Awaitable, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import pytz
+
+from .ttl_cache import TTLCache
+
+
+IDEMPOTENCY_COLLECTION = 'idempotency_keys'
+MAX_KEY_LENGTH = 255
+
+
+def _fingerprint(payload: Any) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Bounded TTL + LRU store of responses keyed by (scope, Idempotency-Key)
+
+    With spill enabled, responses are also written to idempotency_keys/{hash}
+    (expiresAt can back a Firestore TTL policy), so retries that land on
+    another replica or after a restart are still replayed.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: int = 86400, spill: bool = False):
+        self.ttl_seconds = ttl_seconds
+        self.spill = spill
+        self._entries = TTLCache(max_size, ttl_seconds=ttl_seconds)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.replays = 0
+
+    def _put_local(self, store_key: str, fingerprint: str, response: Any):
+        self._entries.put(store_key, {'fingerprint': fingerprint, 'response': response})
+
+    async def _get_spilled(self, firebase_db, store_key: str) -> Optional[Dict[str, Any]]:
+        doc = await firebase_db.collection(IDEMPOTENCY_COLLECTION).document(store_key).get()
+        if not doc.exists:
+            return None
+        entry = doc.to_dict()
+        if entry['expiresAt'] <= datetime.now(pytz.UTC):
+            return None
+        self._put_local(store_key, entry['fingerprint'], entry['response'])
+        return entry
+
+    async def _lookup(self, firebase_db, store_key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(store_key)
+        if entry is None and self.spill:
+            entry = await self._get_spilled(firebase_db, store_key)
+        return entry
+
+    async def run(
+        self,
+        firebase_db,
+        idempotency_key: Optional[str],
+        scope: str,
+        payload: Any,
+        handler: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        Run handler once per (scope, idempotency_key)
+
+        Args:
+            firebase_db: Firestore AsyncClient instance (used only with spill)
+            idempotency_key: Idempotency-Key header value (None = no idempotency)
+            scope: Endpoint and caller, e.g. f"clock-in:{uid}"
+            payload: Request body, compared against the first request's
+            handler: Coroutine function producing the response
+
+        Returns:
+            (response, replayed)
+
+        Raises:
+            HTTPException: 400 for an oversized key, 422 if the key was used
+                with a different payload
+        """
+        if not idempotency_key:
+            return await handler(), False
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+        store_key = hashlib.sha256(f"{scope}:{idempotency_key}".encode('utf-8')).hexdigest()
+        fingerprint = _fingerprint(payload)
+
+        while True:
+            entry = await self._lookup(firebase_db, store_key)
+            if entry is not None:
+                if entry['fingerprint'] != fingerprint:
+                    raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+                self.replays += 1
+                return entry['response'], True
+
+            inflight = self._inflight.get(store_key)
+            if inflight is None:
+                break
+            # Same key already running: wait for it (its error is ours too), then replay
+            await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[store_key] = future
+        try:
+            response = await handler()
+            self._put_local(store_key, fingerprint, response)
+            if self.spill:
+                await firebase_db.collection(IDEMPOTENCY_COLLECTION).document(store_key).set({
+                    'scope': scope.split(':', 1)[0],
+                    'fingerprint': fingerprint,
+                    'response': response,
+                    'expiresAt': datetime.now(pytz.UTC) + timedelta(seconds=self.ttl_seconds)
+                })
+            future.set_result(None)
+            return response, False
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters re-raise it; nobody else retrieves it
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(store_key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._entries),
+            'inflight': len(self._inflight),
+            'replays': self.replays,
+            'spill': self.spill
+        }
+
+
+# Global idempotency store
+idempotency_store = IdempotencyStore(
+    max_size=int(os.getenv('IDEMPOTENCY_MAX_SIZE', 10000)),
+    ttl_seconds=int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 86400)),
+    spill=os.getenv('IDEMPOTENCY_FIRESTORE_SPILL', 'false').lower() == 'true'
+)
@@ -0,0 +1,181 @@
+"""
+Live view of open attendance for VireoHR
+In-memory index of CLOCKED_IN attendance grouped by tenant and store
+
+The view is seeded once at startup and then kept current by the clock-in/out
+hooks in server.py and, when enabled, by a Firestore snapshot listener on
+CLOCKED_IN attendance (which also picks up writes made by other replicas).
+"""
+from typing import Optional, Dict, List, Any
+import threading
+
+from .batch_loader import ShiftLoader
+from .tenant import tenant_key
+
+
+class LiveAttendanceView:
+    """
+    Open attendance records indexed as tenant -> store -> attendance ID
+
+    All methods are thread-safe: the snapshot listener calls in from a
+    background thread while endpoints read from the event loop.
+    """
+
+    def __init__(self):
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._by_tenant: Dict[str, Dict[str, Dict[str, Dict[str, Any]]]] = {}
+        self._lock = threading.Lock()
+        self._watch = None
+        self.seeded = False
+
+    def _insert(self, attendance_id: str, entry: Dict[str, Any]):
+        self._remove(attendance_id)
+        self._records[attendance_id] = entry
+        stores = self._by_tenant.setdefault(entry['tenantKey'], {})
+        stores.setdefault(entry['storeId'], {})[attendance_id] = entry
+
+    def _remove(self, attendance_id: str):
+        entry = self._records.pop(attendance_id, None)
+        if entry is None:
+            return
+        stores = self._by_tenant[entry['tenantKey']]
+        store = stores[entry['storeId']]
+        del store[attendance_id]
+        if not store:
+            del stores[entry['storeId']]
+        if not stores:
+            del self._by_tenant[entry['tenantKey']]
+
+    def upsert(self, attendance_id: str, att_data: Dict[str, Any], is_supervisor: Optional[bool] = None):
+        """
+        Add or refresh an attendance record (records no longer CLOCKED_IN are dropped)
+
+        Args:
+            attendance_id: Attendance document ID
+            att_data: Attendance document data
+            is_supervisor: Whether the employee supervises this shift. Defaults to
+                the record's isSupervisor field, then to the flag already held
+        """
+        with self._lock:
+            if att_data.get('status') != 'CLOCKED_IN':
+                self._remove(attendance_id)
+                return
+
+            if is_supervisor is None:
+                previous = self._records.get(attendance_id)
+                is_supervisor = att_data.get(
+                    'isSupervisor', previous['isSupervisor'] if previous is not None else False
+                )
+
+            self._insert(attendance_id, {
+                'tenantKey': tenant_key(att_data.get('tenantId')),
+                'storeId': att_data.get('storeId'),
+                'storeName': att_data.get('storeName', 'Unknown Store'),
+                'employeeId': att_data.get('employeeId'),
+                'employeeName': att_data.get('employeeName'),
+                'isSupervisor': bool(is_supervisor)
+            })
+
+    def remove(self, attendance_id: str):
+        """Drop a record after clock-out"""
+        with self._lock:
+            self._remove(attendance_id)
+
+    def stores(self, tenant_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Employees currently working, grouped by store
+
+        Args:
+            tenant_id: Tenant to scope to (None = every tenant)
+
+        Returns:
+            List of {storeId, storeName, employees: [{id, employeeName, isSupervisor}], employeeCount}
+        """
+        with self._lock:
+            if tenant_id is None:
+                tenants = list(self._by_tenant.values())
+            else:
+                tenants = [self._by_tenant.get(tenant_key(tenant_id), {})]
+
+            result = []
+            for stores in tenants:
+                for store_id, records in stores.items():
+                    entries = list(records.values())
+                    result.append({
+                        'storeId': store_id,
+                        'storeName': entries[0]['storeName'],
+                        'employees': [
+                            {
+                                'id': entry['employeeId'],
+                                'employeeName': entry['employeeName'],
+                                'isSupervisor': entry['isSupervisor']
+                            }
+                            for entry in entries
+                        ],
+                        'employeeCount': len(entries)
+                    })
+            return result
+
+    async def seed(self, firebase_db):
+        """
+        Load every CLOCKED_IN record, replacing the current contents
+
+        Records written before clock-in stamped isSupervisor get the flag from
+        their shift, loaded with one batched read.
+        """
+        active = [doc async for doc in firebase_db.collection('attendance').where(
+            'status', '==', 'CLOCKED_IN'
+        ).stream()]
+        records = [(doc.id, doc.to_dict()) for doc in active]
+
+        shift_loader = ShiftLoader(firebase_db)
+        await shift_loader.prime(
+            att_data.get('shiftId') for _, att_data in records if 'isSupervisor' not in att_data
+        )
+
+        with self._lock:
+            self._records.clear()
+            self._by_tenant.clear()
+            self.seeded = True
+
+        for attendance_id, att_data in records:
+            is_supervisor = None
+            if 'isSupervisor' not in att_data:
+                shift_data = await shift_loader.load(att_data.get('shiftId'))
+                is_supervisor = shift_data is not None and shift_data.get('supervisorId') == att_data.get('employeeId')
+            self.upsert(attendance_id, att_data, is_supervisor)
+
+    def start_listener(self, query):
+        """
+        Keep the view current from a snapshot listener
+
+        Args:
+            query: Synchronous-client query on CLOCKED_IN attendance
+                (the async client has no on_snapshot)
+        """
+        self.stop_listener()
+        self._watch = query.on_snapshot(self._on_snapshot)
+
+    def stop_listener(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                self.remove(change.document.id)
+            else:
+                self.upsert(change.document.id, change.document.to_dict())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'openRecords': len(self._records),
+            'tenants': len(self._by_tenant),
+            'seeded': self.seeded,
+            'listening': self._watch is not None
+        }
+
+
+# Global live view (one per process)
+live_attendance = LiveAttendanceView()
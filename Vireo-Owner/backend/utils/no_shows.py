@@ -0,0 +1,275 @@
+"""
+Incremental no-show detection for VireoHR
+Each run only looks at shifts that became eligible since the tenant's last run
+
+A shift is a no-show once its start + NO_SHOW_GRACE_MINUTES has passed with
+no attendance record. Each tenant keeps a watermark (the latest eligible
+start time already processed) in no_show_watermarks/{tenant}; a run scans
+shifts starting in (watermark - grace, now - grace] and checks attendance
+for them with batched `shiftId in [...]` queries.
+
+Shifts without a tenantId get their own pass, which has to read every
+tenant's shifts in the window; it stops once migrate_multi_tenant.py has
+stamped them all (see scan_unstamped()).
+"""
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Any, Iterable, Set
+import os
+
+from . import payroll_aggregates
+from .bulk_writer import TransactionRunner
+from .payroll_cache import bump_payroll_version
+from .payroll import NO_SHOW_GRACE_MINUTES
+from .tenant import tenant_key
+
+
+WATERMARKS_COLLECTION = 'no_show_watermarks'
+IN_QUERY_LIMIT = 30  # Firestore 'in' filter limit
+DETECTION_CONCURRENCY = 10  # Employee transactions in flight per run
+INITIAL_LOOKBACK_DAYS = int(os.getenv('NO_SHOW_INITIAL_LOOKBACK_DAYS', 31))  # First run per tenant
+SCAN_UNSTAMPED = os.getenv('NO_SHOW_SCAN_UNSTAMPED', 'true').lower() == 'true'  # false = no pre-tenancy shifts
+BACKFILLED_FIELD = 'unstampedBackfilledAt'  # Set on the default watermark once no unstamped shifts are left
+
+
+def unstamped_watermark_ref(firebase_db):
+    """Watermark of the unstamped-shift pass (also carries BACKFILLED_FIELD)"""
+    return firebase_db.collection(WATERMARKS_COLLECTION).document(tenant_key(None))
+
+
+async def scan_unstamped(firebase_db) -> bool:
+    """
+    Whether runs still need the unstamped-shift pass
+
+    False with NO_SHOW_SCAN_UNSTAMPED=false, or once migrate_multi_tenant.py
+    has stamped every shift and set BACKFILLED_FIELD (new shifts are always
+    written with a tenantId).
+    """
+    if not SCAN_UNSTAMPED:
+        return False
+    watermark_doc = await unstamped_watermark_ref(firebase_db).get()
+    return not (watermark_doc.exists and watermark_doc.to_dict().get(BACKFILLED_FIELD))
+
+
+def shift_start(shift_data: Dict[str, Any], timezone) -> Optional[datetime]:
+    """Localized start of a shift (None if date/startTime are missing or malformed)"""
+    try:
+        start = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
+        return timezone.localize(start.replace(tzinfo=None))
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+async def shifts_with_attendance(firebase_db, shift_ids: Iterable[str]) -> Set[str]:
+    """IDs among shift_ids that have any attendance record (including no-shows)"""
+    shift_ids = list(dict.fromkeys(shift_ids))
+    attended = set()
+    for start in range(0, len(shift_ids), IN_QUERY_LIMIT):
+        chunk = shift_ids[start:start + IN_QUERY_LIMIT]
+        query = firebase_db.collection('attendance').where('shiftId', 'in', chunk)
+        attended.update([doc.to_dict().get('shiftId') async for doc in query.stream()])
+    return attended
+
+
+def no_show_record(shift_id: str, shift_data: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    """
+    No-show attendance record for a shift
+
+    The record ID is derived from the shift ID, so concurrent runs cannot
+    create a second no-show for the same shift.
+    """
+    return {
+        'id': f"noshow_{shift_id}",
+        'employeeId': shift_data.get('employeeId'),
+        'employeeName': shift_data.get('employeeName', 'Unknown'),
+        'shiftId': shift_id,
+        'storeId': shift_data.get('storeId', ''),
+        'storeName': shift_data.get('storeName', 'Unknown Store'),
+        'tenantId': shift_data.get('tenantId'),
+        'status': 'NO_SHOW',
+        'noShow': True,
+        'clockInTime': None,
+        'clockOutTime': None,
+        'isLate': False,
+        'lateByMinutes': 0,
+        'createdAt': now.isoformat(),
+        'detectedAt': now.isoformat(),
+        'autoDetected': True
+    }
+
+
+async def _create_no_shows(firebase_db, shifts: Dict[str, Dict[str, Any]], now: datetime, timezone) -> List[str]:
+    """
+    Create the no-show records of one employee's shifts together with their payroll aggregates
+
+    One transaction: records that already exist (concurrent run) are skipped.
+
+    Returns:
+        IDs of the shifts whose record was created
+    """
+    first = next(iter(shifts.values()))
+    attendance_ref = firebase_db.collection('attendance')
+    refs = {shift_id: attendance_ref.document(f"noshow_{shift_id}") for shift_id in shifts}
+
+    def stage(transaction, state):
+        created = []
+        for shift_id, ref in refs.items():
+            if state['docs'][ref.path] is None:
+                transaction.create(ref, no_show_record(shift_id, shifts[shift_id], now))
+                created.append(shift_id)
+        return created
+
+    created, _ = await payroll_aggregates.commit_with_aggregates(
+        firebase_db, first.get('tenantId'), first['employeeId'],
+        [payroll_aggregates.month_key(shift_data['date']) for shift_data in shifts.values()],
+        now, timezone, stage, read_refs=refs.values()
+    )
+    return created
+
+
+async def mark_no_show(firebase_db, shift_id: str, shift_data: Dict[str, Any], now: datetime, timezone) -> bool:
+    """
+    Write the no-show attendance record for a shift and update its payroll aggregate
+
+    Returns:
+        True if the record was created, False if it already existed
+    """
+    created = await _create_no_shows(firebase_db, {shift_id: shift_data}, now, timezone)
+    if not created:
+        return False
+
+    await bump_payroll_version(firebase_db, shift_data.get('tenantId'))
+    return True
+
+
+def _window_queries(query, window_start: datetime, window_end: datetime, timezone) -> List[Any]:
+    """
+    Queries for the shifts starting in (window_start, window_end], in local date/startTime terms
+
+    The first and last day are bounded by startTime, so a run only reads the
+    shifts that became eligible since the watermark; days in between (first
+    run, or after downtime) are read whole. The bounds are inclusive and
+    cover both 'HH:MM' and 'HH:MM:SS' values; shift_start() applies the
+    exact window.
+    """
+    start = window_start.astimezone(timezone)
+    end = window_end.astimezone(timezone)
+    first_day, last_day = start.date().isoformat(), end.date().isoformat()
+    after, until = start.strftime('%H:%M'), end.strftime('%H:%M:%S')
+
+    if first_day == last_day:
+        return [query.where('date', '==', first_day).where('startTime', '>=', after).where('startTime', '<=', until)]
+
+    queries = [query.where('date', '==', first_day).where('startTime', '>=', after)]
+    if (end.date() - start.date()).days > 1:
+        queries.append(query.where('date', '>', first_day).where('date', '<', last_day))
+    queries.append(query.where('date', '==', last_day).where('startTime', '<=', until))
+    return queries
+
+
+async def _eligible_shifts(firebase_db, tenant_id: Optional[str], window_start: datetime,
+                           window_end: datetime, timezone) -> Dict[str, Dict[str, Any]]:
+    """
+    Shifts of a tenant whose start falls in (window_start, window_end]
+
+    tenant_id None selects unstamped shifts: Firestore cannot match a missing
+    field, so the window is read without a tenant filter and shifts with a
+    tenantId are dropped (see scan_unstamped()).
+    """
+    query = firebase_db.collection('shifts')
+    if tenant_id is not None:
+        query = query.where('tenantId', '==', tenant_id)
+
+    eligible = {}
+    for window_query in _window_queries(query, window_start, window_end, timezone):
+        async for doc in window_query.stream():
+            shift_data = doc.to_dict()
+            if tenant_id is None and shift_data.get('tenantId'):
+                continue
+            start = shift_start(shift_data, timezone)
+            if shift_data.get('employeeId') and start is not None and window_start < start <= window_end:
+                eligible[doc.id] = shift_data
+    return eligible
+
+
+async def detect_tenant_no_shows(firebase_db, tenant_id: Optional[str], now: datetime, timezone) -> List[Dict[str, Any]]:
+    """
+    Detect one tenant's new no-shows and advance its watermark
+
+    Args:
+        firebase_db: Firestore AsyncClient instance
+        tenant_id: Tenant to scan (None = shifts stored without a tenant)
+        now: Current time (timezone-aware)
+        timezone: pytz timezone shift times are expressed in
+
+    Returns:
+        List of detected no-shows (employeeId, employeeName, storeName, shiftDate, shiftStartTime)
+    """
+    watermark_ref = firebase_db.collection(WATERMARKS_COLLECTION).document(tenant_key(tenant_id))
+    watermark_doc = await watermark_ref.get()
+
+    window_end = now - timedelta(minutes=NO_SHOW_GRACE_MINUTES)
+    if watermark_doc.exists:
+        watermark = datetime.fromisoformat(watermark_doc.to_dict()['watermark'])
+        window_start = watermark - timedelta(minutes=NO_SHOW_GRACE_MINUTES)
+    else:
+        window_start = window_end - timedelta(days=INITIAL_LOOKBACK_DAYS)
+
+    shifts = await _eligible_shifts(firebase_db, tenant_id, window_start, window_end, timezone)
+    attended = await shifts_with_attendance(firebase_db, shifts.keys())
+
+    # One transaction per employee: their no-show records and aggregates commit together
+    by_employee: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for shift_id, shift_data in shifts.items():
+        if shift_id not in attended:
+            by_employee.setdefault(shift_data['employeeId'], {})[shift_id] = shift_data
+
+    runner = TransactionRunner(max_in_flight=DETECTION_CONCURRENCY)
+    for employee_id, employee_shifts in by_employee.items():
+        runner.run(
+            _create_no_shows, firebase_db, employee_shifts, now, timezone,
+            tag=employee_id, ops=len(employee_shifts) + 1
+        )
+    result = await runner.close()
+    for employee_id, error in result.failed:
+        print(f"✗ Failed to record no-shows for employee {employee_id}: {error}")
+    failed = bool(result.failed)
+
+    created = [shifts[shift_id] for ids in result.values.values() for shift_id in ids]
+    if created:
+        await bump_payroll_version(firebase_db, tenant_id)
+
+    detected = [{
+        'employeeId': shift_data.get('employeeId'),
+        'employeeName': shift_data.get('employeeName'),
+        'storeName': shift_data.get('storeName'),
+        'shiftDate': shift_data.get('date'),
+        'shiftStartTime': shift_data.get('startTime')
+    } for shift_data in created]
+
+    if failed:
+        # Leave the watermark so the failed shifts are retried next run
+        return detected
+
+    await watermark_ref.set({
+        'tenantId': tenant_id,
+        'watermark': window_end.isoformat(),
+        'updatedAt': now.isoformat()
+    }, merge=True)
+    return detected
+
+
+async def detect_no_shows(firebase_db, now: datetime, timezone) -> List[Dict[str, Any]]:
+    """
+    Detect new no-shows across every tenant (plus shifts stored without a tenant, until they are backfilled)
+
+    Usage:
+        no_shows = await detect_no_shows(firebase_db, get_current_time(), TIMEZONE)
+    """
+    tenant_ids = [doc.id async for doc in firebase_db.collection('tenants').stream()]
+    if await scan_unstamped(firebase_db):
+        tenant_ids.append(None)
+
+    detected = []
+    for tenant_id in tenant_ids:
+        detected.extend(await detect_tenant_no_shows(firebase_db, tenant_id, now, timezone))
+    return detected
@@ -0,0 +1,120 @@
+"""
+Cursor pagination and field projection for VireoHR list endpoints
+Opaque page tokens over Firestore start_after cursors, fields= over select()
+
+A page token encodes the order-by values and document ID of the last
+document of a page. The next page resumes right after it, so a page costs
+only its own document reads, however deep it is. A projection limits the
+fields Firestore returns (document IDs are always returned).
+"""
+from fastapi import HTTPException
+from google.cloud.firestore_v1.field_path import FieldPath
+from typing import Optional, List, Any, Tuple, Iterable
+import base64
+import json
+import re
+
+
+MAX_PAGE_SIZE = 500
+NEXT_PAGE_TOKEN_HEADER = 'X-Next-Page-Token'
+FIELD_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def parse_fields(fields: Optional[str], required: Iterable[str] = ()) -> Optional[List[str]]:
+    """
+    Projection from a comma-separated fields= parameter
+
+    Args:
+        fields: e.g. "name,role" (None/empty = every field)
+        required: Fields the endpoint itself reads, added to any projection
+
+    Returns:
+        Field list for paginate(), or None for no projection
+    """
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    for name in names:
+        if not FIELD_NAME_PATTERN.match(name):
+            raise HTTPException(status_code=400, detail=f"Invalid field name: {name}")
+    return list(dict.fromkeys(names + list(required)))
+
+
+def set_next_page_token(response, next_page_token: Optional[str]):
+    """Return a page's continuation token in the X-Next-Page-Token header (omitted on the last page)"""
+    if next_page_token:
+        response.headers[NEXT_PAGE_TOKEN_HEADER] = next_page_token
+
+
+def encode_page_token(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_page_token(page_token: str, expected_values: int) -> List[Any]:
+    """Order-by values + document ID encoded in a page token (400 if malformed)"""
+    try:
+        padded = page_token + '=' * (-len(page_token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid pageToken")
+    if not isinstance(values, list) or len(values) != expected_values:
+        raise HTTPException(status_code=400, detail="Invalid pageToken")
+    return values
+
+
+async def paginate(
+    query,
+    collection_ref,
+    order_by: List[str],
+    limit: Optional[int] = None,
+    page_token: Optional[str] = None,
+    fields: Optional[List[str]] = None
+) -> Tuple[List[Any], Optional[str]]:
+    """
+    Read one page of a query ordered by order_by (document ID breaks ties)
+
+    Args:
+        query: Filtered query (no order_by yet)
+        collection_ref: Collection the query reads (to rebuild the cursor document)
+        order_by: Fields to order by, ascending unless prefixed with '-';
+            documents missing one of them are not returned
+        limit: Page size (None = everything from the cursor on)
+        page_token: Token returned with the previous page
+        fields: Projection from parse_fields() (None = every field)
+
+    Returns:
+        (document snapshots, next page token or None on the last page)
+
+    Usage:
+        docs, next_token = await paginate(query, shifts_ref, ['date', 'startTime'], limit, pageToken)
+    """
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    order_fields = [field.lstrip('-') for field in order_by]
+    direction = 'ASCENDING'
+    for field in order_by:
+        direction = 'DESCENDING' if field.startswith('-') else 'ASCENDING'
+        query = query.order_by(field.lstrip('-'), direction=direction)
+    # Tie-break on document ID in the direction of the last order-by (matches the index)
+    query = query.order_by(FieldPath.document_id(), direction=direction)
+
+    if fields is not None:
+        query = query.select(list(dict.fromkeys(fields + order_fields)))
+
+    if page_token:
+        values = decode_page_token(page_token, len(order_fields) + 1)
+        cursor = dict(zip(order_fields, values))
+        cursor[FieldPath.document_id()] = collection_ref.document(values[-1])
+        query = query.start_after(cursor)
+
+    if limit is None:
+        return [doc async for doc in query.stream()], None
+
+    # One extra document tells whether another page follows
+    docs = [doc async for doc in query.limit(limit + 1).stream()]
+    if len(docs) <= limit:
+        return docs, None
+
+    docs = docs[:limit]
+    return docs, encode_page_token([docs[-1].get(field) for field in order_fields] + [docs[-1].id])
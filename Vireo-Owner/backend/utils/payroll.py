@@ -0,0 +1,535 @@
+"""
+Payroll engine for VireoHR
+Single-pass computation of hours, late penalties and no-show penalties for a period
+
+All earnings and payroll endpoints share these rules:
+- Hours come from CLOCKED_OUT attendance whose clockInTime falls in the period
+- The first two late arrivals in a period are warnings; each later one costs
+  half of that shift's scheduled hours
+- A scheduled shift with no attendance once its no-show grace period has
+  passed costs twice the shift's scheduled hours
+"""
+from datetime import datetime, date, timedelta, timezone as dt_timezone
+from typing import Optional, Dict, List, Any
+import os
+import numpy as np
+
+from .helpers import calculate_net_earnings
+
+
+LATE_WARNINGS = 2                   # Late arrivals tolerated before penalties apply
+LATE_PENALTY_SHIFT_FRACTION = 0.5   # 3rd+ late = half the shift
+NO_SHOW_PENALTY_MULTIPLIER = 2      # No-show = 2x the shift
+NO_SHOW_GRACE_MINUTES = 30          # Same threshold as no-show detection
+LATE_GRACE_MINUTES = 15             # Clock-ins more than this after shift start are late
+VECTORIZE_MIN_RECORDS = int(os.getenv('PAYROLL_VECTORIZE_MIN_RECORDS', 2000))  # Smaller periods use the scalar loop
+
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# A period result's figures, as stored in monthly aggregates, payroll runs and closed periods
+SNAPSHOT_FIELDS = (
+    'hours',
+    'paidHours',
+    'unpaidHours',
+    'lateCount',
+    'latePenaltyHours',
+    'unpaidLatePenaltyHours',
+    'noShowCount',
+    'noShowPenaltyHours'
+)
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse an ISO timestamp as stored on attendance records"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def attendance_hours(att_data: Dict[str, Any]) -> float:
+    """Hours between clockInTime and clockOutTime"""
+    clock_in = parse_timestamp(att_data['clockInTime'])
+    clock_out = parse_timestamp(att_data['clockOutTime'])
+    return (clock_out - clock_in).total_seconds() / 3600
+
+
+def lateness(shift_data: Dict[str, Any], clock_in: datetime, timezone):
+    """
+    Late flag and minutes late for a clock-in, as stamped on attendance records
+
+    Returns:
+        (is_late, late_by_minutes): late_by_minutes is 0 unless the clock-in is
+        more than LATE_GRACE_MINUTES after the shift start
+    """
+    shift_start = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
+    shift_start = timezone.localize(shift_start.replace(tzinfo=None))
+    if clock_in > shift_start + timedelta(minutes=LATE_GRACE_MINUTES):
+        return True, int((clock_in - shift_start).total_seconds() / 60)
+    return False, 0
+
+
+def shift_hours(shift_data: Dict[str, Any]) -> float:
+    """Scheduled hours of a shift (date + startTime/endTime)"""
+    start_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
+    end_time = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['endTime']}")
+    return (end_time - start_time).total_seconds() / 3600
+
+
+def month_bounds(year: int, month: int):
+    """First and last day of a calendar month"""
+    first_day = date(year, month, 1)
+    if month == 12:
+        next_month = date(year + 1, 1, 1)
+    else:
+        next_month = date(year, month + 1, 1)
+    return first_day, next_month - timedelta(days=1)
+
+
+def empty_result(employee_id: str) -> Dict[str, Any]:
+    """Result for an employee with no attendance or shifts in the period"""
+    return {
+        'employeeId': employee_id,
+        'hours': 0.0,
+        'paidHours': 0.0,
+        'unpaidHours': 0.0,
+        'lateCount': 0,
+        'latePenaltyHours': 0.0,
+        'unpaidLatePenaltyHours': 0.0,
+        'noShowCount': 0,
+        'noShowPenaltyHours': 0.0,
+        'todayHours': 0.0,
+        'todayLatePenaltyHours': 0.0,
+        'attendanceIds': [],
+        'unpaidAttendanceIds': []
+    }
+
+
+async def load_period(
+    firebase_db,
+    tenant_id: Optional[str],
+    start_date: date,
+    end_date: date,
+    employee_id: Optional[str] = None,
+    transaction=None
+):
+    """
+    Load a period's attendance and shifts with two range queries
+
+    Attendance is read one day wider on each side so that a shift near a
+    period boundary is still matched to its (early or late) clock-in.
+    A tenant filter does not match records without a tenantId (written before
+    multi-tenancy); stamp them with scripts/migrate_multi_tenant.py --backfill-only.
+
+    Args:
+        firebase_db: Firestore AsyncClient instance
+        tenant_id: Tenant to scope to (None = no tenant filter)
+        start_date: First day of the period
+        end_date: Last day of the period (inclusive)
+        employee_id: Optional single employee to scope to
+        transaction: Read inside this transaction
+
+    Returns:
+        (attendance, shifts): list of attendance dicts (with 'id') and a
+        dict of shift ID -> shift dict
+    """
+    attendance_query = firebase_db.collection('attendance')
+    shifts_query = firebase_db.collection('shifts')
+    if tenant_id is not None:
+        attendance_query = attendance_query.where('tenantId', '==', tenant_id)
+        shifts_query = shifts_query.where('tenantId', '==', tenant_id)
+    if employee_id is not None:
+        attendance_query = attendance_query.where('employeeId', '==', employee_id)
+        shifts_query = shifts_query.where('employeeId', '==', employee_id)
+
+    window_start = datetime.combine(start_date - timedelta(days=1), datetime.min.time()).isoformat()
+    window_end = datetime.combine(end_date + timedelta(days=1), datetime.max.time()).isoformat()
+    attendance_query = attendance_query.where('clockInTime', '>=', window_start).where('clockInTime', '<=', window_end)
+    shifts_query = shifts_query.where('date', '>=', start_date.isoformat()).where('date', '<=', end_date.isoformat())
+
+    attendance = [{'id': doc.id, **doc.to_dict()} async for doc in attendance_query.stream(transaction=transaction)]
+    shifts = {doc.id: doc.to_dict() async for doc in shifts_query.stream(transaction=transaction)}
+    return attendance, shifts
+
+
+async def load_late_shifts(
+    firebase_db,
+    attendance: List[Dict[str, Any]],
+    shifts: Dict[str, Dict[str, Any]],
+    transaction=None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Shifts outside the period referenced by late records (for their penalties), in one get_all
+
+    Returns:
+        Dict of shift ID -> shift dict (the extra_shifts of compute_period)
+    """
+    missing = list(dict.fromkeys(
+        att.get('shiftId') for att in attendance
+        if att.get('isLate', False) and att.get('shiftId') and att.get('shiftId') not in shifts
+    ))
+    if not missing:
+        return {}
+    refs = [firebase_db.collection('shifts').document(shift_id) for shift_id in missing]
+    return {doc.id: doc.to_dict() async for doc in firebase_db.get_all(refs, transaction=transaction) if doc.exists}
+
+
+def compute_period(
+    attendance: List[Dict[str, Any]],
+    shifts: Dict[str, Dict[str, Any]],
+    start_date: date,
+    end_date: date,
+    now: datetime,
+    timezone,
+    extra_shifts: Optional[Dict[str, Dict[str, Any]]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Group a period's attendance and shifts by employee in one pass
+
+    Args:
+        attendance: Attendance dicts as returned by load_period
+        shifts: Shifts scheduled in the period (ID -> dict)
+        start_date: First day of the period
+        end_date: Last day of the period (inclusive)
+        now: Current time (timezone-aware)
+        timezone: pytz timezone shift times are expressed in
+        extra_shifts: Shifts outside the period referenced by late records
+
+    Returns:
+        Dict of employee ID -> result dict (hours, paid/unpaid hours, late
+        count and penalty hours, no-show count and penalty hours, today's
+        hours, attendance IDs)
+    """
+    period_start = datetime.combine(start_date, datetime.min.time()).isoformat()
+    period_end = datetime.combine(end_date, datetime.max.time()).isoformat()
+    today_prefix = now.date().isoformat()
+    all_shifts = {**(extra_shifts or {}), **shifts}
+
+    results: Dict[str, Dict[str, Any]] = {}
+    attended_shift_ids = set()
+    worked = []
+
+    for att_data in attendance:
+        if att_data.get('status') == 'NO_SHOW' or att_data.get('noShow', False):
+            continue
+        if att_data.get('shiftId'):
+            attended_shift_ids.add(att_data['shiftId'])
+
+        clock_in_time = att_data.get('clockInTime') or ''
+        if att_data.get('status') == 'CLOCKED_OUT' and period_start <= clock_in_time <= period_end:
+            worked.append(att_data)
+
+    # Late arrivals are ranked chronologically per employee
+    worked.sort(key=lambda a: a.get('clockInTime', ''))
+
+    for att_data in worked:
+        employee_id = att_data.get('employeeId')
+        result = results.setdefault(employee_id, empty_result(employee_id))
+
+        hours = attendance_hours(att_data)
+        is_paid = att_data.get('paid', False)
+        is_today = att_data.get('clockInTime', '').startswith(today_prefix)
+
+        result['hours'] += hours
+        result['attendanceIds'].append(att_data['id'])
+        if is_paid:
+            result['paidHours'] += hours
+        else:
+            result['unpaidHours'] += hours
+            result['unpaidAttendanceIds'].append(att_data['id'])
+        if is_today:
+            result['todayHours'] += hours
+
+        if att_data.get('isLate', False):
+            result['lateCount'] += 1
+            if result['lateCount'] > LATE_WARNINGS:
+                shift_data = all_shifts.get(att_data.get('shiftId'))
+                if shift_data is not None:
+                    penalty = shift_hours(shift_data) * LATE_PENALTY_SHIFT_FRACTION
+                    result['latePenaltyHours'] += penalty
+                    if not is_paid:
+                        result['unpaidLatePenaltyHours'] += penalty
+                    if is_today:
+                        result['todayLatePenaltyHours'] += penalty
+
+    no_show_threshold = now - timedelta(minutes=NO_SHOW_GRACE_MINUTES)
+    for shift_id, shift_data in shifts.items():
+        employee_id = shift_data.get('employeeId')
+        if not employee_id or shift_id in attended_shift_ids:
+            continue
+        try:
+            shift_start = datetime.fromisoformat(f"{shift_data['date']}T{shift_data['startTime']}")
+            shift_start = timezone.localize(shift_start.replace(tzinfo=None))
+            if shift_start > no_show_threshold:
+                continue
+            penalty = shift_hours(shift_data) * NO_SHOW_PENALTY_MULTIPLIER
+        except (KeyError, ValueError):
+            continue
+
+        result = results.setdefault(employee_id, empty_result(employee_id))
+        result['noShowCount'] += 1
+        result['noShowPenaltyHours'] += penalty
+
+    return results
+
+
+def _days_from_civil(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """Days since 1970-01-01 of proleptic Gregorian dates (integer arrays)"""
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def timestamps_to_epoch_us(values: List[str]) -> np.ndarray:
+    """
+    Parse ISO timestamps into epoch microseconds
+
+    Timestamps as written by the API (YYYY-MM-DDTHH:MM:SS[.ffffff] followed
+    by +HH:MM, -HH:MM or Z) are decoded arithmetically from their bytes;
+    anything else goes through parse_timestamp (naive values are read as UTC).
+    """
+    count = len(values)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    try:
+        raw = np.array(values, dtype='S')
+    except UnicodeEncodeError:
+        raw = np.array([value.encode('ascii', 'replace') for value in values], dtype='S')
+    raw = raw.astype(f"S{max(raw.dtype.itemsize, 33)}")  # Room for fraction + offset + terminator
+    chars = raw.view(np.uint8).reshape(count, -1)
+    digits = chars.astype(np.int64) - ord('0')
+    rows = np.arange(count)
+
+    def number(positions, columns=None):
+        value = np.zeros(count, dtype=np.int64)
+        for position in positions:
+            value = value * 10 + (digits[:, position] if columns is None else digits[rows, columns + position])
+        return value
+
+    def is_digit(positions, columns=None):
+        valid = np.ones(count, dtype=bool)
+        for position in positions:
+            column = digits[:, position] if columns is None else digits[rows, columns + position]
+            valid &= (column >= 0) & (column <= 9)
+        return valid
+
+    has_fraction = chars[:, 19] == ord('.')
+    tail = np.where(has_fraction, 26, 19)  # Where the offset starts
+    sign = chars[rows, tail]
+    is_utc = (sign == ord('Z')) & (chars[rows, tail + 1] == 0)
+    has_offset = (
+        ((sign == ord('+')) | (sign == ord('-')))
+        & is_digit((1, 2, 4, 5), tail) & (chars[rows, tail + 3] == ord(':')) & (chars[rows, tail + 6] == 0)
+    )
+    valid = (
+        (chars[:, 4] == ord('-')) & (chars[:, 7] == ord('-')) & (chars[:, 10] == ord('T'))
+        & (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(':'))
+        & is_digit((0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18))
+        & (~has_fraction | is_digit(range(20, 26)))
+        & (is_utc | has_offset)
+    )
+
+    days = _days_from_civil(number((0, 1, 2, 3)), number((5, 6)), number((8, 9)))
+    seconds = days * 86400 + number((11, 12)) * 3600 + number((14, 15)) * 60 + number((17, 18))
+    fraction = np.where(has_fraction, number(range(20, 26)), 0)
+    offset_minutes = np.where(is_utc, 0, number((1, 2), tail) * 60 + number((4, 5), tail))
+    offset_minutes = np.where(sign == ord('-'), -offset_minutes, offset_minutes)
+    epoch_us = (seconds - offset_minutes * 60) * 10**6 + fraction
+
+    for index in np.flatnonzero(~valid):
+        value = parse_timestamp(values[index])
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=dt_timezone.utc)
+        epoch_us[index] = (value - UNIX_EPOCH) // timedelta(microseconds=1)
+    return epoch_us
+
+
+def _grouped_lists(values: np.ndarray, groups: np.ndarray, size: int) -> List[List[Any]]:
+    """values split into one list per group index (0..size-1), keeping their order"""
+    order = np.argsort(groups, kind='stable')
+    bounds = np.searchsorted(groups[order], np.arange(size + 1))
+    ordered = values[order].tolist()
+    return [ordered[bounds[index]:bounds[index + 1]] for index in range(size)]
+
+
+def compute_period_vectorized(
+    attendance: List[Dict[str, Any]],
+    shifts: Dict[str, Dict[str, Any]],
+    start_date: date,
+    end_date: date,
+    now: datetime,
+    timezone,
+    extra_shifts: Optional[Dict[str, Dict[str, Any]]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Column-oriented compute_period for large periods (same arguments, same results)
+
+    Worked records are loaded into arrays (epoch microseconds, employee
+    index, late/paid/today flags, shift hours) in one pass. Per-employee
+    totals are np.bincount sums taken in the scalar loop's chronological
+    order, so every float is accumulated in the same sequence and the
+    results match compute_period exactly.
+    """
+    period_start = datetime.combine(start_date, datetime.min.time()).isoformat()
+    period_end = datetime.combine(end_date, datetime.max.time()).isoformat()
+    today_prefix = now.date().isoformat()
+    all_shifts = {**(extra_shifts or {}), **shifts}
+
+    attended_shift_ids = set()
+    employee_ids: Dict[Any, int] = {}
+    ids, employees, clock_ins, clock_outs, paid, late, shift_ids = [], [], [], [], [], [], []
+    for att_data in attendance:
+        if att_data.get('status') == 'NO_SHOW' or att_data.get('noShow', False):
+            continue
+        if att_data.get('shiftId'):
+            attended_shift_ids.add(att_data['shiftId'])
+
+        clock_in_time = att_data.get('clockInTime') or ''
+        if att_data.get('status') == 'CLOCKED_OUT' and period_start <= clock_in_time <= period_end:
+            ids.append(att_data['id'])
+            employees.append(att_data.get('employeeId'))
+            clock_ins.append(clock_in_time)
+            clock_outs.append(att_data['clockOutTime'])
+            paid.append(bool(att_data.get('paid', False)))
+            late.append(bool(att_data.get('isLate', False)))
+            shift_ids.append(att_data.get('shiftId'))
+
+    # Late arrivals are ranked chronologically per employee (stable, like list.sort)
+    clock_in_strings = np.array(clock_ins, dtype=str)
+    order = np.argsort(clock_in_strings, kind='stable')
+    # Employee indexes follow first (chronological) appearance, like the scalar results dict
+    employee_index = np.array([employee_ids.setdefault(employees[i], len(employee_ids)) for i in order], dtype=np.int64)
+    is_paid = np.array(paid, dtype=bool)[order]
+    is_late = np.array(late, dtype=bool)[order]
+    is_today = np.strings.startswith(clock_in_strings[order], today_prefix)
+
+    if ids:
+        hours = (timestamps_to_epoch_us(clock_outs) - timestamps_to_epoch_us(clock_ins))[order] / 10**6 / 3600
+    else:
+        hours = np.zeros(0)
+
+    # Rank of each late arrival among its employee's late arrivals (1 = first)
+    late_rows = np.flatnonzero(is_late)
+    by_employee = late_rows[np.argsort(employee_index[late_rows], kind='stable')]
+    late_employees = employee_index[by_employee]
+    group_starts = np.r_[0, np.flatnonzero(late_employees[1:] != late_employees[:-1]) + 1]
+    group_sizes = np.diff(np.r_[group_starts, len(late_employees)])
+    late_rank = np.zeros(len(ids), dtype=np.int64)
+    late_rank[by_employee] = np.arange(len(late_employees)) - np.repeat(group_starts, group_sizes) + 1
+
+    # Late penalties: half the shift's scheduled hours from the 3rd late arrival on
+    shift_durations = {}
+    penalty = np.zeros(len(ids))
+    for index in np.flatnonzero(is_late & (late_rank > LATE_WARNINGS)):
+        shift_id = shift_ids[order[index]]
+        shift_data = all_shifts.get(shift_id)
+        if shift_data is not None:
+            if shift_id not in shift_durations:
+                shift_durations[shift_id] = shift_hours(shift_data) * LATE_PENALTY_SHIFT_FRACTION
+            penalty[index] = shift_durations[shift_id]
+
+    # No-shows: same eligibility rules as the scalar loop, one entry per shift in dict order
+    no_show_threshold = now - timedelta(minutes=NO_SHOW_GRACE_MINUTES)
+    no_show_employees = []
+    no_show_hours = []
+    starts = {}
+    for shift_id, shift_data in shifts.items():
+        employee_id = shift_data.get('employeeId')
+        if not employee_id or shift_id in attended_shift_ids:
+            continue
+        try:
+            start_key = f"{shift_data['date']}T{shift_data['startTime']}"
+            if start_key not in starts:
+                starts[start_key] = timezone.localize(datetime.fromisoformat(start_key).replace(tzinfo=None))
+            if starts[start_key] > no_show_threshold:
+                continue
+            scheduled = shift_hours(shift_data)
+        except (KeyError, ValueError):
+            continue
+        no_show_employees.append(employee_ids.setdefault(employee_id, len(employee_ids)))
+        no_show_hours.append(scheduled)
+    no_show_employees = np.array(no_show_employees, dtype=np.int64)
+    no_show_penalty = np.array(no_show_hours, dtype=float) * NO_SHOW_PENALTY_MULTIPLIER
+
+    size = len(employee_ids)
+
+    def total(weights, mask=None, index=employee_index):
+        if mask is not None:
+            weights = np.where(mask, weights, 0.0)
+        return np.bincount(index, weights=weights, minlength=size).astype(float).tolist()
+
+    totals = {
+        'hours': total(hours),
+        'paidHours': total(hours, is_paid),
+        'unpaidHours': total(hours, ~is_paid),
+        'todayHours': total(hours, is_today),
+        'latePenaltyHours': total(penalty),
+        'unpaidLatePenaltyHours': total(penalty, ~is_paid),
+        'todayLatePenaltyHours': total(penalty, is_today),
+        'noShowPenaltyHours': total(no_show_penalty, index=no_show_employees)
+    }
+    late_counts = np.bincount(employee_index[is_late], minlength=size).tolist()
+    no_show_counts = np.bincount(no_show_employees, minlength=size).tolist()
+
+    id_array = np.array(ids, dtype=object)[order]
+    attendance_ids = _grouped_lists(id_array, employee_index, size)
+    unpaid_ids = _grouped_lists(id_array[~is_paid], employee_index[~is_paid], size)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for employee_id, index in employee_ids.items():
+        result = {'employeeId': employee_id}
+        result.update({field: values[index] for field, values in totals.items()})
+        result['lateCount'] = late_counts[index]
+        result['noShowCount'] = no_show_counts[index]
+        result['attendanceIds'] = attendance_ids[index]
+        result['unpaidAttendanceIds'] = unpaid_ids[index]
+        results[employee_id] = {**empty_result(employee_id), **result}
+
+    return results
+
+
+async def compute_payroll(
+    firebase_db,
+    tenant_id: Optional[str],
+    start_date: date,
+    end_date: date,
+    now: datetime,
+    timezone,
+    employee_id: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Compute per-employee payroll results for a period
+
+    Costs two range queries, plus one batched get_all for late arrivals
+    whose shift falls outside the period.
+
+    Usage:
+        results = await compute_payroll(firebase_db, tenant_id, month_start, today, now, TIMEZONE)
+        result = results.get(uid) or empty_result(uid)
+    """
+    attendance, shifts = await load_period(firebase_db, tenant_id, start_date, end_date, employee_id)
+    extra_shifts = await load_late_shifts(firebase_db, attendance, shifts)
+
+    # Large periods take the column-oriented path; both give identical results
+    compute = compute_period_vectorized if len(attendance) >= VECTORIZE_MIN_RECORDS else compute_period
+    return compute(attendance, shifts, start_date, end_date, now, timezone, extra_shifts)
+
+
+def period_earnings(result: Dict[str, Any], hourly_rate: float, unpaid_only: bool = False) -> Dict[str, float]:
+    """
+    Apply calculate_net_earnings to an engine result
+
+    Args:
+        result: Per-employee result from compute_payroll
+        hourly_rate: Hourly pay rate in JD
+        unpaid_only: Only count unpaid hours and late penalties on unpaid records
+    """
+    if unpaid_only:
+        return calculate_net_earnings(
+            result['unpaidHours'], hourly_rate,
+            result['unpaidLatePenaltyHours'], result['noShowPenaltyHours']
+        )
+    return calculate_net_earnings(
+        result['hours'], hourly_rate,
+        result['latePenaltyHours'], result['noShowPenaltyHours']
+    )
@@ -0,0 +1,301 @@
+"""
+Transactionally maintained monthly payroll aggregates for VireoHR
+One document per employee per month at payroll_aggregates/{tenant}/{yyyy-mm}/{employeeId}
+
+An aggregate is never adjusted by hand: every write path that changes payroll
+figures (clock-out, offline sync, auto clock-out, no-show detection, shift
+deletion, mark-as-paid) goes through commit_with_aggregates(), which reads
+the employee's attendance and shifts for the affected months inside one
+Firestore transaction, applies the path's writes to that view, recomputes
+each month with the payroll engine (compute_period) and writes the
+aggregate in the same commit. The aggregates therefore follow the engine's
+rules exactly (late rank by clock-in order, no-shows from unattended
+shifts), and a concurrent write or rebuild can only retry, never interleave.
+
+Months are marked built on payroll_aggregates/{tenant} once rebuilt from raw
+data; load_month() rebuilds a month that is not marked yet, so aggregates
+are backfilled on first read after a deploy (and by the startup backfill
+and scripts/rebuild_payroll_aggregates.py).
+"""
+from google.cloud.firestore import ArrayUnion, async_transactional
+from datetime import datetime
+from typing import Optional, Dict, Any, Callable, Iterable, Tuple
+import asyncio
+import pytz
+
+from .batch_loader import ShiftLoader
+from .payroll import (
+    attendance_hours,
+    compute_payroll,
+    compute_period,
+    load_late_shifts,
+    load_period,
+    month_bounds,
+    shift_hours,
+    LATE_WARNINGS,
+    LATE_PENALTY_SHIFT_FRACTION,
+    SNAPSHOT_FIELDS
+)
+from .tenant import tenant_key
+
+
+AGGREGATES_COLLECTION = 'payroll_aggregates'
+REBUILD_CONCURRENCY = 10  # Employee transactions in flight during a rebuild
+
+# Month rebuilds in flight in this process, so concurrent first reads share one
+_rebuilding: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+def month_key(value: str) -> str:
+    """'yyyy-mm' of an ISO date or timestamp"""
+    return value[:7]
+
+
+def tenant_ref(firebase_db, tenant_id: Optional[str]):
+    return firebase_db.collection(AGGREGATES_COLLECTION).document(tenant_key(tenant_id))
+
+
+def month_collection(firebase_db, tenant_id: Optional[str], month: str):
+    return tenant_ref(firebase_db, tenant_id).collection(month)
+
+
+def empty_aggregate(employee_id: str, tenant_id: Optional[str], month: str) -> Dict[str, Any]:
+    aggregate = {field: 0.0 for field in SNAPSHOT_FIELDS}
+    aggregate.update({
+        'employeeId': employee_id,
+        'tenantId': tenant_id,
+        'month': month,
+        'lateCount': 0,
+        'noShowCount': 0
+    })
+    return aggregate
+
+
+def _month_dates(month: str):
+    return month_bounds(int(month[:4]), int(month[5:7]))
+
+
+def month_result(state: Dict[str, Any], employee_id: str, month: str, now: datetime,
+                 timezone) -> Optional[Dict[str, Any]]:
+    """Payroll engine result for one employee-month of a commit_with_aggregates state (None if no records)"""
+    start_date, end_date = _month_dates(month)
+    month_shifts = {
+        shift_id: shift_data for shift_id, shift_data in state['shifts'].items()
+        if start_date.isoformat() <= (shift_data.get('date') or '') <= end_date.isoformat()
+    }
+    return compute_period(
+        list(state['attendance'].values()), month_shifts, start_date, end_date, now, timezone,
+        {**state['extra_shifts'], **state['shifts']}
+    ).get(employee_id)
+
+
+async def commit_with_aggregates(
+    firebase_db,
+    tenant_id: Optional[str],
+    employee_id: str,
+    months: Iterable[str],
+    now: datetime,
+    timezone,
+    stage: Optional[Callable[[Any, Dict[str, Any]], Any]] = None,
+    read_refs: Iterable[Any] = ()
+) -> Tuple[Any, Dict[str, Dict[str, Any]]]:
+    """
+    Commit one employee's writes together with the recomputed aggregates of the months they touch
+
+    Runs a single transaction that reads the employee's attendance and shifts
+    for each month (plus read_refs), calls stage(transaction, state) to queue
+    its writes and apply them to state, then recomputes every month with the
+    payroll engine from the updated state and writes the aggregates.
+
+    state:
+        'attendance': attendance ID -> record dict (with 'id')
+        'shifts': shift ID -> shift dict, for shifts dated in the months
+        'extra_shifts': other shifts late records refer to (stage may add to it)
+        'docs': path of each read_refs document -> dict (None if missing)
+
+    stage runs again if the transaction is retried, so it must only touch the
+    transaction and state; raising from it aborts without writing anything.
+    month_result(state, ...) gives stage the engine's figures before its writes.
+
+    Usage:
+        def stage(transaction, state):
+            transaction.update(att_ref, {'status': 'CLOCKED_OUT', 'clockOutTime': now_iso})
+            state['attendance'][att_ref.id].update(status='CLOCKED_OUT', clockOutTime=now_iso)
+
+        await commit_with_aggregates(firebase_db, tenant_id, uid, [month], now, TIMEZONE, stage)
+
+    Returns:
+        (stage's return value, month -> aggregate written)
+    """
+    months = sorted(set(months))
+    read_refs = list(read_refs)
+    transaction = firebase_db.transaction()
+
+    @async_transactional
+    async def commit_in_transaction(transaction):
+        state = {'attendance': {}, 'shifts': {}, 'extra_shifts': {}, 'docs': {}}
+        for month in months:
+            start_date, end_date = _month_dates(month)
+            attendance, shifts = await load_period(
+                firebase_db, tenant_id, start_date, end_date, employee_id, transaction=transaction
+            )
+            state['attendance'].update((att['id'], att) for att in attendance)
+            state['shifts'].update(shifts)
+        state['extra_shifts'] = await load_late_shifts(
+            firebase_db, list(state['attendance'].values()), state['shifts'], transaction=transaction
+        )
+        if read_refs:
+            async for doc in firebase_db.get_all(read_refs, transaction=transaction):
+                state['docs'][doc.reference.path] = doc.to_dict() if doc.exists else None
+
+        value = stage(transaction, state) if stage is not None else None
+
+        aggregates = {}
+        for month in months:
+            result = month_result(state, employee_id, month, now, timezone)
+            ref = month_collection(firebase_db, tenant_id, month).document(employee_id)
+            if result is None:
+                transaction.delete(ref)
+                continue
+            aggregate = empty_aggregate(employee_id, tenant_id, month)
+            for field in SNAPSHOT_FIELDS:
+                aggregate[field] = result[field]
+            aggregate['updatedAt'] = datetime.now(pytz.UTC).isoformat()
+            transaction.set(ref, aggregate)
+            aggregates[month] = aggregate
+        return value, aggregates
+
+    return await commit_in_transaction(transaction)
+
+
+async def refresh_employee_month(firebase_db, tenant_id: Optional[str], employee_id: str, month: str,
+                                 now: datetime, timezone) -> Optional[Dict[str, Any]]:
+    """Recompute one employee's aggregate for a month (None if they have no records in it)"""
+    _, aggregates = await commit_with_aggregates(firebase_db, tenant_id, employee_id, [month], now, timezone)
+    return aggregates.get(month)
+
+
+async def rebuild_month(firebase_db, tenant_id: Optional[str], year: int, month: int, now: datetime, timezone) -> int:
+    """
+    Recompute a month's aggregates from raw attendance and shifts, and mark the month built
+
+    Every employee with records in the month (or an existing aggregate) is
+    recomputed in their own transaction, so writes landing during a rebuild
+    are never overwritten with older figures.
+
+    Args:
+        firebase_db: Firestore AsyncClient instance
+        tenant_id: Tenant to rebuild (None = no tenant filter, single-tenant deployments)
+        year: Calendar year
+        month: Calendar month (1-12)
+        now: Current time (no-shows are only counted for past shifts)
+        timezone: pytz timezone shift times are expressed in
+
+    Returns:
+        Number of aggregate documents written
+    """
+    period_start, period_end = month_bounds(year, month)
+    key = period_start.isoformat()[:7]
+    results = await compute_payroll(firebase_db, tenant_id, period_start, period_end, now, timezone)
+    existing = [doc.id async for doc in month_collection(firebase_db, tenant_id, key).stream()]
+
+    semaphore = asyncio.Semaphore(REBUILD_CONCURRENCY)
+
+    async def refresh(employee_id):
+        async with semaphore:
+            return await refresh_employee_month(firebase_db, tenant_id, employee_id, key, now, timezone)
+
+    aggregates = await asyncio.gather(*(refresh(employee_id) for employee_id in dict.fromkeys([*results, *existing])))
+
+    await tenant_ref(firebase_db, tenant_id).set({
+        'tenantId': tenant_id,
+        'builtMonths': ArrayUnion([key]),
+        'updatedAt': now.isoformat()
+    }, merge=True)
+    return sum(1 for aggregate in aggregates if aggregate is not None)
+
+
+async def ensure_month(firebase_db, tenant_id: Optional[str], month: str, now: datetime, timezone):
+    """Rebuild a month from raw data unless it is already marked built"""
+    tenant_doc = await tenant_ref(firebase_db, tenant_id).get()
+    if tenant_doc.exists and month in tenant_doc.to_dict().get('builtMonths', []):
+        return
+
+    key = (tenant_key(tenant_id), month)
+    future = _rebuilding.get(key)
+    if future is None:
+        future = asyncio.ensure_future(
+            rebuild_month(firebase_db, tenant_id, int(month[:4]), int(month[5:7]), now, timezone)
+        )
+        _rebuilding[key] = future
+        future.add_done_callback(lambda done: _rebuilding.pop(key, None))
+    await asyncio.shield(future)
+
+
+async def backfill_current_month(firebase_db, now: datetime, timezone):
+    """Build the current month's aggregates for every tenant (run at startup)"""
+    tenant_ids = [doc.id async for doc in firebase_db.collection('tenants').stream()]
+    for tenant_id in tenant_ids:
+        try:
+            await ensure_month(firebase_db, tenant_id, now.date().isoformat()[:7], now, timezone)
+        except Exception as e:
+            print(f"✗ Payroll aggregate backfill failed for tenant {tenant_id}: {e}")
+
+
+async def load_month(firebase_db, tenant_id: Optional[str], month: str, now: datetime,
+                     timezone) -> Dict[str, Dict[str, Any]]:
+    """All employees' aggregates for a month (employee ID -> aggregate), built on first read"""
+    await ensure_month(firebase_db, tenant_id, month, now, timezone)
+    docs = month_collection(firebase_db, tenant_id, month).stream()
+    return {doc.id: doc.to_dict() async for doc in docs}
+
+
+async def load_employee_month(firebase_db, tenant_id: Optional[str], month: str, employee_id: str,
+                              now: datetime, timezone) -> Dict[str, Any]:
+    """One employee's aggregate for a month, built on first read (zeros if they have no records)"""
+    await ensure_month(firebase_db, tenant_id, month, now, timezone)
+    doc = await month_collection(firebase_db, tenant_id, month).document(employee_id).get()
+    if not doc.exists:
+        return empty_aggregate(employee_id, tenant_id, month)
+    return doc.to_dict()
+
+
+async def today_figures(firebase_db, employee_id: str, month_late_count: int, now: datetime) -> Dict[str, float]:
+    """
+    Today's hours and late penalty hours for one employee
+
+    Today's late arrivals are ranked against the month's late count from the
+    aggregate, so the 3rd+ late rule matches the monthly figures.
+
+    Returns:
+        {'hours': float, 'latePenaltyHours': float}
+    """
+    today = now.date()
+    today_start = datetime.combine(today, datetime.min.time()).isoformat()
+    today_end = datetime.combine(today, datetime.max.time()).isoformat()
+
+    query = firebase_db.collection('attendance').where(
+        'employeeId', '==', employee_id
+    ).where('clockInTime', '>=', today_start).where('clockInTime', '<=', today_end)
+    records = [doc.to_dict() async for doc in query.stream()]
+    records = sorted(
+        (r for r in records if r.get('status') == 'CLOCKED_OUT'),
+        key=lambda r: r.get('clockInTime', '')
+    )
+
+    late_records = [r for r in records if r.get('isLate', False)]
+    shift_loader = ShiftLoader(firebase_db)
+    await shift_loader.prime(r.get('shiftId') for r in late_records)
+
+    late_penalty_hours = 0.0
+    first_rank = month_late_count - len(late_records) + 1
+    for index, record in enumerate(late_records):
+        if first_rank + index > LATE_WARNINGS:
+            shift_data = await shift_loader.load(record.get('shiftId'))
+            if shift_data is not None:
+                late_penalty_hours += shift_hours(shift_data) * LATE_PENALTY_SHIFT_FRACTION
+
+    return {
+        'hours': sum(attendance_hours(r) for r in records),
+        'latePenaltyHours': late_penalty_hours
+    }
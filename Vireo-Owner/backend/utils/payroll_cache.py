@@ -0,0 +1,119 @@
+"""
+Payroll result cache for VireoHR
+Computed payroll views keyed by tenant, period and the tenant's payroll data version
+
+Each tenant has a version counter at payroll_versions/{tenantKey}. Every
+write path that changes payroll figures (clock-out, auto clock-out, no-show
+detection, shift deletion, salary changes, mark-as-paid) bumps it with an
+atomic increment. Views are cached under (view, tenant, period, variant,
+version), so a bump makes every older entry unreachable without tracking
+what it touched, and the same key gives the response's ETag. Concurrent
+requests for the same key share one computation (single flight).
+"""
+from google.cloud.firestore import Increment
+from datetime import datetime
+from typing import Optional, Dict, Any, Iterable, Callable, Awaitable, Tuple
+import asyncio
+import hashlib
+import os
+import pytz
+
+from .tenant import tenant_key
+from .ttl_cache import TTLCache
+
+
+VERSIONS_COLLECTION = 'payroll_versions'
+
+
+def version_ref(firebase_db, tenant_id: Optional[str]):
+    return firebase_db.collection(VERSIONS_COLLECTION).document(tenant_key(tenant_id))
+
+
+async def payroll_version(firebase_db, tenant_id: Optional[str]) -> int:
+    """A tenant's payroll data version (0 until the first bump)"""
+    version_doc = await version_ref(firebase_db, tenant_id).get()
+    return version_doc.to_dict().get('version', 0) if version_doc.exists else 0
+
+
+async def bump_payroll_versions(firebase_db, tenant_ids: Iterable[Optional[str]]):
+    """
+    Invalidate the cached payroll views of some tenants - call after their payroll data changed
+
+    A failed bump is logged, not raised: the write it follows has already
+    landed, and the stale views expire with the cache TTL.
+    """
+    async def bump(tenant_id):
+        try:
+            await version_ref(firebase_db, tenant_id).set({
+                'version': Increment(1),
+                'updatedAt': datetime.now(pytz.UTC).isoformat()
+            }, merge=True)
+        except Exception as e:
+            print(f"✗ Failed to bump payroll version for tenant {tenant_key(tenant_id)}: {e}")
+
+    await asyncio.gather(*(bump(tenant_id) for tenant_id in dict.fromkeys(tenant_ids)))
+
+
+async def bump_payroll_version(firebase_db, tenant_id: Optional[str]):
+    await bump_payroll_versions(firebase_db, [tenant_id])
+
+
+def payroll_etag(key: Tuple) -> str:
+    """Strong ETag for a cache key (changes whenever the tenant's version does)"""
+    return '"' + hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32] + '"'
+
+
+class PayrollResultCache(TTLCache):
+    """
+    Bounded TTL + LRU cache of computed payroll views with single-flight misses
+
+    Cached values are shared between requests and must not be mutated. The
+    TTL is only a backstop for changes that do not bump the version. Misses
+    that joined a computation already in flight are also counted as coalesced.
+    """
+
+    def __init__(self, max_size: int = 256, ttl_seconds: int = 300):
+        super().__init__(max_size, ttl_seconds=ttl_seconds)
+        self._in_flight: Dict[Tuple, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def _finish(self, key: Tuple, future: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.put(key, future.result())
+
+    async def get_or_compute(self, key: Tuple, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Cached value for key, computing it at most once across concurrent callers
+
+        Usage:
+            earnings = await payroll_cache.get_or_compute(key, lambda: build_view(tenant_id))
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(compute())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+
+        # Shielded: a caller that disconnects does not cancel the others' computation
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            'inFlight': len(self._in_flight),
+            'coalesced': self.coalesced
+        }
+
+
+# Shared cache for the payroll list endpoints
+payroll_cache = PayrollResultCache(
+    max_size=int(os.getenv('PAYROLL_CACHE_MAX_SIZE', 256)),
+    ttl_seconds=int(os.getenv('PAYROLL_CACHE_TTL_SECONDS', 300))
+)
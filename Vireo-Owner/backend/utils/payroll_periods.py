@@ -0,0 +1,228 @@
+"""
+Closed payroll periods for VireoHR
+Freezes a settled month into checksummed snapshot documents that later reads are served from
+
+Closing a period stores every employee's figures for the month (hours,
+penalties, earnings at the hourly rate of the day it was closed, and the
+month's payment records) in shard documents under
+payroll_periods/{periodId}/shards, an employee's shard chosen by a hash of
+their ID. The header payroll_periods/{periodId} is written last with a
+SHA-256 checksum per shard, so a period only counts as closed once all of
+its shards exist, and a single employee's figures are read from one shard.
+Reads verify the checksums and fall back to live computation if one does
+not match; reopening marks the header OPEN and deletes the shards.
+"""
+from datetime import datetime
+from typing import Optional, Dict, List, Any, Iterable
+import hashlib
+import json
+import math
+
+from .bulk_writer import BulkWriter
+from .payroll import empty_result, period_earnings, SNAPSHOT_FIELDS
+from .tenant import tenant_key
+
+
+PERIODS_COLLECTION = 'payroll_periods'
+SHARD_SIZE = 200  # Employees per shard document (keeps shards well under the 1 MiB limit)
+
+
+def period_id(tenant_id: Optional[str], year: int, month: int) -> str:
+    return f"{tenant_key(tenant_id)}_{year:04d}-{month:02d}"
+
+
+def period_ref(firebase_db, tenant_id: Optional[str], year: int, month: int):
+    return firebase_db.collection(PERIODS_COLLECTION).document(period_id(tenant_id, year, month))
+
+
+def shard_index(employee_id: str, shard_count: int) -> int:
+    return int(hashlib.sha256(employee_id.encode('utf-8')).hexdigest()[:8], 16) % shard_count
+
+
+def shard_checksum(period: str, index: int, employees: Dict[str, Dict[str, Any]]) -> str:
+    """SHA-256 over a canonical JSON encoding of one shard's employee snapshots"""
+    payload = json.dumps(
+        {'period': period, 'index': index, 'employees': employees},
+        sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def employee_snapshots(
+    user_docs: Iterable[Any],
+    results: Dict[str, Dict[str, Any]],
+    payments: Iterable[Dict[str, Any]]
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Frozen per-employee figures for a period
+
+    Args:
+        user_docs: Employee document snapshots (employees with neither an hourly
+            rate nor a payment are skipped)
+        results: compute_payroll results for the period
+        payments: The period's payment_history records
+
+    Returns:
+        employeeId -> snapshot
+    """
+    payments_by_employee = {}
+    for payment in sorted(payments, key=lambda payment: payment.get('paymentDate') or '', reverse=True):
+        payments_by_employee.setdefault(payment.get('employeeId'), []).append(payment)
+
+    employees = {}
+    for user_doc in user_docs:
+        user_data = user_doc.to_dict()
+        hourly_rate = user_data.get('salary', 0) or 0
+        employee_payments = payments_by_employee.get(user_doc.id, [])
+        if hourly_rate <= 0 and not employee_payments:
+            continue
+
+        result = results.get(user_doc.id) or empty_result(user_doc.id)
+        earnings = period_earnings(result, hourly_rate)
+        snapshot = {field: result[field] for field in SNAPSHOT_FIELDS}
+        snapshot.update({
+            'employeeId': user_doc.id,
+            'employeeName': user_data.get('name', 'Unknown'),
+            'role': user_data.get('role', 'EMPLOYEE'),
+            'hourlyRate': hourly_rate,
+            'grossEarnings': earnings['gross'],
+            'latePenalty': earnings['late_penalty'],
+            'noShowPenalty': earnings['no_show_penalty'],
+            'netEarnings': earnings['net'],
+            'payments': employee_payments
+        })
+        employees[user_doc.id] = snapshot
+    return employees
+
+
+async def load_header(firebase_db, tenant_id: Optional[str], year: int, month: int) -> Optional[Dict[str, Any]]:
+    """Header of a closed period (None if the period is open)"""
+    header_doc = await period_ref(firebase_db, tenant_id, year, month).get()
+    if not header_doc.exists:
+        return None
+    header = header_doc.to_dict()
+    return header if header.get('status') == 'CLOSED' else None
+
+
+async def close_period(
+    firebase_db,
+    tenant_id: Optional[str],
+    year: int,
+    month: int,
+    employees: Dict[str, Dict[str, Any]],
+    closed_by: Dict[str, Any],
+    now: datetime
+) -> Dict[str, Any]:
+    """
+    Write a period's snapshot: shards first, then the header that marks it closed
+
+    Returns:
+        The header document
+    """
+    ref = period_ref(firebase_db, tenant_id, year, month)
+    shards = [{} for _ in range(max(1, math.ceil(len(employees) / SHARD_SIZE)))]
+    for employee_id in sorted(employees):
+        shards[shard_index(employee_id, len(shards))][employee_id] = employees[employee_id]
+
+    writer = BulkWriter(firebase_db)
+    for index, shard in enumerate(shards):
+        writer.set(ref.collection('shards').document(str(index)), {'index': index, 'employees': shard}, tag=index)
+    write_result = await writer.close()
+    if write_result.failed:
+        raise Exception(f"{len(write_result.failed)} snapshot shard writes failed: {write_result.failed[0][1]}")
+
+    checksums = [shard_checksum(ref.id, index, shard) for index, shard in enumerate(shards)]
+    header = {
+        'id': ref.id,
+        'tenantId': tenant_id,
+        'year': year,
+        'month': month,
+        'status': 'CLOSED',
+        'employeeCount': len(employees),
+        'shardCount': len(shards),
+        'totalNetEarnings': round(sum(snapshot['netEarnings'] for snapshot in employees.values()), 2),
+        'shardChecksums': checksums,
+        'checksum': hashlib.sha256(''.join(checksums).encode('ascii')).hexdigest(),  # Whole snapshot
+        'closedAt': now.isoformat(),
+        'closedBy': closed_by.get('uid'),
+        'closedByName': closed_by.get('name', 'Unknown')
+    }
+    await ref.set(header)
+    return header
+
+
+async def load_snapshot(
+    firebase_db,
+    tenant_id: Optional[str],
+    year: int,
+    month: int,
+    employee_id: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Closed period with its employee snapshots, verified against the shard checksums
+
+    Args:
+        employee_id: Only read the shard holding this employee
+
+    Returns:
+        Header fields plus 'employees' (employeeId -> snapshot); None if the
+        period is open or a shard does not match its checksum
+    """
+    header = await load_header(firebase_db, tenant_id, year, month)
+    if header is None:
+        return None
+
+    ref = period_ref(firebase_db, tenant_id, year, month)
+    if employee_id is not None:
+        indexes = [shard_index(employee_id, header['shardCount'])]
+    else:
+        indexes = range(header['shardCount'])
+
+    employees = {}
+    async for shard_doc in firebase_db.get_all([ref.collection('shards').document(str(index)) for index in indexes]):
+        shard = shard_doc.to_dict() if shard_doc.exists else {}
+        index = int(shard_doc.id)
+        if shard_checksum(ref.id, index, shard.get('employees', {})) != header['shardChecksums'][index]:
+            print(f"✗ Payroll period {ref.id} shard {index} failed its checksum, recomputing")
+            return None
+        employees.update(shard['employees'])
+    return {**header, 'employees': employees}
+
+
+async def reopen_period(
+    firebase_db,
+    tenant_id: Optional[str],
+    year: int,
+    month: int,
+    reopened_by: Dict[str, Any],
+    now: datetime
+) -> bool:
+    """
+    Invalidate a period's snapshot so reads are computed live again
+
+    Returns:
+        False if the period was not closed
+    """
+    header = await load_header(firebase_db, tenant_id, year, month)
+    if header is None:
+        return False
+
+    ref = period_ref(firebase_db, tenant_id, year, month)
+    # Header first: from here on readers ignore the shards
+    await ref.update({
+        'status': 'OPEN',
+        'reopenedAt': now.isoformat(),
+        'reopenedBy': reopened_by.get('uid')
+    })
+
+    writer = BulkWriter(firebase_db)
+    for index in range(header['shardCount']):
+        writer.delete(ref.collection('shards').document(str(index)))
+    await writer.close()
+    return True
+
+
+def snapshot_payments(snapshot: Dict[str, Any], employee_id: str) -> List[Dict[str, Any]]:
+    """An employee's payment records in a closed period, newest first"""
+    employee = snapshot['employees'].get(employee_id)
+    return employee['payments'] if employee else []
@@ -0,0 +1,274 @@
+"""
+Nightly payroll run for VireoHR
+Computes a month's payroll for every tenant in a process pool and stores immutable snapshots
+
+A run is one document at payroll_runs/{runId} that tracks progress. Each
+tenant is computed by a worker process: one compute_payroll call (two range
+queries) plus one batched profile read. Its results are then written with
+create():
+- payroll_runs/{runId}/tenants/{tenantKey}/employees/{employeeId}, one
+  document per employee
+- payroll_runs/{runId}/tenants/{tenantKey}, the tenant summary, written last
+
+A tenant summary therefore exists only once all of that tenant's employee
+documents exist. Summaries are never overwritten, and they double as the
+resume checkpoint: resuming a run skips every tenant that already has one.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Dict, List, Any, Callable
+from google.api_core.exceptions import AlreadyExists
+import asyncio
+import json
+import multiprocessing
+import os
+import uuid
+
+from .batch_loader import DocumentLoader
+from .bulk_writer import BulkWriter
+from .payroll import compute_payroll, month_bounds, period_earnings, SNAPSHOT_FIELDS
+from .tenant import tenant_key
+
+
+RUNS_COLLECTION = 'payroll_runs'
+DEFAULT_WORKERS = int(os.getenv('PAYROLL_RUN_WORKERS', min(os.cpu_count() or 1, 4)))
+TIMEZONE_NAME = 'Asia/Amman'
+
+
+def run_ref(firebase_db, run_id: str):
+    return firebase_db.collection(RUNS_COLLECTION).document(run_id)
+
+
+# ==================== WORKER PROCESS ====================
+
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_db = None
+
+
+def _load_credentials():
+    """Service account from FIREBASE_SERVICE_ACCOUNT_KEY, else backend/firebase-service-account.json"""
+    from firebase_admin import credentials
+
+    firebase_creds = os.getenv('FIREBASE_SERVICE_ACCOUNT_KEY')
+    if firebase_creds:
+        return credentials.Certificate(json.loads(firebase_creds))
+    cred_file = Path(__file__).parent.parent / 'firebase-service-account.json'
+    if not cred_file.exists():
+        raise Exception("No Firebase credentials found")
+    return credentials.Certificate(str(cred_file))
+
+
+def _init_worker():
+    """Process pool initializer: one Firebase app and one event loop per worker process"""
+    global _worker_loop, _worker_db
+    import firebase_admin
+    from firebase_admin import firestore_async
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(_load_credentials())
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+    _worker_db = firestore_async.client()
+
+
+async def snapshot_tenant(firebase_db, run_id: str, tenant_id: Optional[str], year: int, month: int,
+                          now: datetime, timezone) -> Dict[str, Any]:
+    """
+    Compute one tenant's month and write its snapshot documents
+
+    Returns:
+        Tenant summary (employees, totals); an existing summary if the tenant was already done
+    """
+    tenant_ref = run_ref(firebase_db, run_id).collection('tenants').document(tenant_key(tenant_id))
+    existing = await tenant_ref.get()
+    if existing.exists:
+        return existing.to_dict()
+
+    period_start, period_end = month_bounds(year, month)
+    results = await compute_payroll(firebase_db, tenant_id, period_start, period_end, now, timezone)
+
+    user_loader = DocumentLoader(firebase_db, 'users')
+    await user_loader.prime(results.keys())
+
+    writer = BulkWriter(firebase_db)
+    totals = {'gross': 0.0, 'latePenalty': 0.0, 'noShowPenalty': 0.0, 'net': 0.0, 'hours': 0.0}
+    for employee_id, result in results.items():
+        if not employee_id:
+            continue
+        user_data = await user_loader.load(employee_id) or {}
+        hourly_rate = user_data.get('salary', 0) or 0
+        earnings = period_earnings(result, hourly_rate)
+
+        snapshot = {field: result[field] for field in SNAPSHOT_FIELDS}
+        snapshot.update({
+            'employeeId': employee_id,
+            'employeeName': user_data.get('name', 'Unknown'),
+            'hourlyRate': hourly_rate,
+            'attendanceCount': len(result['attendanceIds']),
+            'unpaidAttendanceCount': len(result['unpaidAttendanceIds']),
+            'grossEarnings': earnings['gross'],
+            'latePenalty': earnings['late_penalty'],
+            'noShowPenalty': earnings['no_show_penalty'],
+            'netEarnings': earnings['net']
+        })
+        # Re-created on resume: AlreadyExists just means an earlier attempt got this far
+        writer.create(tenant_ref.collection('employees').document(employee_id), snapshot, tag=employee_id)
+
+        totals['gross'] += earnings['gross']
+        totals['latePenalty'] += earnings['late_penalty']
+        totals['noShowPenalty'] += earnings['no_show_penalty']
+        totals['net'] += earnings['net']
+        totals['hours'] += result['hours']
+
+    write_result = await writer.close()
+    errors = [error for _, error in write_result.failed if not isinstance(error, AlreadyExists)]
+    if errors:
+        raise Exception(f"{len(errors)} employee snapshot writes failed: {errors[0]}")
+
+    summary = {
+        'runId': run_id,
+        'tenantId': tenant_id,
+        'year': year,
+        'month': month,
+        'employees': len([employee_id for employee_id in results if employee_id]),
+        'totals': {name: round(value, 2) for name, value in totals.items()},
+        'computedAt': now.isoformat()
+    }
+    try:
+        await tenant_ref.create(summary)
+    except AlreadyExists:
+        return (await tenant_ref.get()).to_dict()
+    return summary
+
+
+def run_tenant_in_worker(run_id: str, tenant_id: Optional[str], year: int, month: int, now_iso: str) -> Dict[str, Any]:
+    """Process pool entry point (module-level so it can be pickled)"""
+    import pytz
+
+    timezone = pytz.timezone(TIMEZONE_NAME)
+    now = datetime.fromisoformat(now_iso).astimezone(timezone)
+    return _worker_loop.run_until_complete(
+        snapshot_tenant(_worker_db, run_id, tenant_id, year, month, now, timezone)
+    )
+
+
+# ==================== DRIVER ====================
+
+async def start_run(firebase_db, year: int, month: int, now: datetime,
+                    started_by: Optional[str] = None, tenant_ids: Optional[List[Optional[str]]] = None) -> str:
+    """
+    Create a run document listing the tenants to compute
+
+    Args:
+        tenant_ids: Tenants to include (None = every tenant plus records without a tenant)
+
+    Returns:
+        The new run ID
+    """
+    if tenant_ids is None:
+        tenant_ids = [doc.id async for doc in firebase_db.collection('tenants').stream()] + [None]
+
+    run_id = f"{year:04d}-{month:02d}_{uuid.uuid4().hex[:12]}"
+    await run_ref(firebase_db, run_id).set({
+        'id': run_id,
+        'year': year,
+        'month': month,
+        'status': 'PENDING',
+        'tenantIds': tenant_ids,
+        'total': len(tenant_ids),
+        'completed': [],
+        'failed': {},
+        'startedBy': started_by,
+        'createdAt': now.isoformat(),
+        'updatedAt': now.isoformat()
+    })
+    return run_id
+
+
+async def execute_run(
+    firebase_db,
+    run_id: str,
+    now: datetime,
+    workers: Optional[int] = None,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    Compute every tenant of a run that has not been completed yet
+
+    Safe to call again on the same run after a crash: completed tenants are
+    skipped, and a tenant interrupted halfway is finished without
+    duplicating its documents. Progress is written to the run document after
+    each tenant and passed to progress().
+
+    Returns:
+        The final run document
+    """
+    ref = run_ref(firebase_db, run_id)
+    run_doc = await ref.get()
+    if not run_doc.exists:
+        raise ValueError(f"Payroll run {run_id} not found")
+    run = run_doc.to_dict()
+
+    completed = set(run.get('completed', []))
+    pending = [tenant_id for tenant_id in run['tenantIds'] if tenant_key(tenant_id) not in completed]
+    failed: Dict[str, str] = {}
+
+    await ref.update({'status': 'RUNNING', 'failed': {}, 'updatedAt': now.isoformat()})
+
+    loop = asyncio.get_running_loop()
+    # spawn, not fork: gRPC channels must not be shared with a forked child
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers or DEFAULT_WORKERS, mp_context=context,
+                             initializer=_init_worker) as pool:
+
+        async def run_tenant(tenant_id):
+            try:
+                # Every tenant (also on resume) is computed as of the run's creation time
+                await loop.run_in_executor(
+                    pool, run_tenant_in_worker, run_id, tenant_id, run['year'], run['month'], run['createdAt']
+                )
+                return tenant_id, None
+            except Exception as e:
+                return tenant_id, e
+
+        for next_done in asyncio.as_completed([run_tenant(tenant_id) for tenant_id in pending]):
+            tenant_id, error = await next_done
+            if error is None:
+                completed.add(tenant_key(tenant_id))
+            else:
+                failed[tenant_key(tenant_id)] = str(error)
+                print(f"✗ Payroll run {run_id} failed for tenant {tenant_key(tenant_id)}: {error}")
+
+            state = {
+                'completed': sorted(completed),
+                'failed': failed,
+                'updatedAt': datetime.now(now.tzinfo).isoformat()
+            }
+            await ref.update(state)
+            if progress is not None:
+                progress({'runId': run_id, 'done': len(completed) + len(failed), 'total': run['total'], **state})
+
+    final = {
+        'status': 'FAILED' if failed else 'COMPLETED',
+        'finishedAt': datetime.now(now.tzinfo).isoformat()
+    }
+    await ref.update(final)
+    return {**run, 'completed': sorted(completed), 'failed': failed, **final}
+
+
+def run_progress(run: Dict[str, Any]) -> Dict[str, Any]:
+    """API view of a run document"""
+    return {
+        'runId': run.get('id'),
+        'year': run.get('year'),
+        'month': run.get('month'),
+        'status': run.get('status'),
+        'total': run.get('total', 0),
+        'completed': len(run.get('completed', [])),
+        'failed': run.get('failed', {}),
+        'startedBy': run.get('startedBy'),
+        'createdAt': run.get('createdAt'),
+        'updatedAt': run.get('updatedAt'),
+        'finishedAt': run.get('finishedAt')
+    }
@@ -0,0 +1,178 @@
+"""
+In-process deadline scheduler for VireoHR
+Min-heap of pending shift deadlines (no-show checks, auto clock-outs) fired by one replica
+
+Endpoints keep the heap current (create/delete shift, clock in/out); the
+leader also re-seeds it from Firestore periodically so that writes made on
+other replicas are picked up. Handlers must re-check Firestore state before
+acting: a deadline only says "look at this shift now".
+
+Only the replica holding the lease document scheduler_leases/{name} fires
+deadlines. Other replicas keep their heap but discard entries as they fall due.
+"""
+from google.cloud.firestore import async_transactional
+from datetime import datetime
+from typing import Optional, Dict, Any, Callable, Awaitable
+import asyncio
+import heapq
+import os
+import time
+import uuid
+
+
+LEASES_COLLECTION = 'scheduler_leases'
+
+
+class DeadlineScheduler:
+    """
+    Deadlines keyed by (kind, target ID); rescheduling or cancelling a key
+    supersedes its earlier heap entry (stale entries are skipped when popped)
+
+    Usage:
+        deadline_scheduler.register('no_show', check_no_show)
+        deadline_scheduler.schedule('no_show', shift_id, shift_start + timedelta(minutes=30))
+        task = asyncio.create_task(deadline_scheduler.run(firebase_db, seed_deadlines))
+    """
+
+    def __init__(self, name: str = 'deadlines', lease_seconds: int = 60, reseed_seconds: int = 600):
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.reseed_seconds = reseed_seconds
+        self.instance_id = uuid.uuid4().hex
+        self.is_leader = False
+        self._heap = []
+        self._entries: Dict[tuple, int] = {}  # (kind, target ID) -> sequence of the live heap entry
+        self._seq = 0
+        self._handlers: Dict[str, Callable[[str], Awaitable[Any]]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lease_checked_at = 0.0
+        self._seeded_at = 0.0
+        self.fired = 0
+
+    def register(self, kind: str, handler: Callable[[str], Awaitable[Any]]):
+        """Set the async handler called with the target ID when a deadline of this kind falls due"""
+        self._handlers[kind] = handler
+
+    def schedule(self, kind: str, target_id: str, due_at: datetime):
+        """Add or move a deadline"""
+        self._seq += 1
+        self._entries[(kind, target_id)] = self._seq
+        heapq.heappush(self._heap, (due_at.timestamp(), self._seq, kind, target_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def cancel(self, kind: str, target_id: str):
+        """Drop a deadline (no-op if none is pending)"""
+        self._entries.pop((kind, target_id), None)
+
+    def _pop_due(self, now_ts: float):
+        """Yield live (kind, target ID) entries whose deadline has passed"""
+        while self._heap and self._heap[0][0] <= now_ts:
+            _, seq, kind, target_id = heapq.heappop(self._heap)
+            if self._entries.get((kind, target_id)) != seq:
+                continue
+            del self._entries[(kind, target_id)]
+            yield kind, target_id
+
+    def _next_due(self) -> Optional[float]:
+        while self._heap and self._entries.get((self._heap[0][2], self._heap[0][3])) != self._heap[0][1]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def _try_acquire_lease(self, firebase_db) -> bool:
+        ref = firebase_db.collection(LEASES_COLLECTION).document(self.name)
+        transaction = firebase_db.transaction()
+
+        @async_transactional
+        async def acquire_in_transaction(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            now_ts = time.time()
+            if snapshot.exists:
+                lease = snapshot.to_dict()
+                if lease.get('holder') != self.instance_id and lease.get('expiresAt', 0) > now_ts:
+                    return False
+            transaction.set(ref, {
+                'holder': self.instance_id,
+                'expiresAt': now_ts + self.lease_seconds,
+                'renewedAt': now_ts
+            })
+            return True
+
+        return await acquire_in_transaction(transaction)
+
+    async def release_lease(self, firebase_db):
+        """Give up the lease on shutdown so another replica can take over at once"""
+        if not self.is_leader:
+            return
+        ref = firebase_db.collection(LEASES_COLLECTION).document(self.name)
+        snapshot = await ref.get()
+        if snapshot.exists and snapshot.to_dict().get('holder') == self.instance_id:
+            await ref.delete()
+        self.is_leader = False
+
+    async def _reseed(self, seed: Callable[[], Awaitable[Any]]):
+        self._heap = []
+        self._entries = {}
+        await seed()
+        self._seeded_at = time.time()
+
+    async def run(self, firebase_db, seed: Callable[[], Awaitable[Any]]):
+        """
+        Main loop: hold/renew the lease, fire due deadlines, sleep until the next one
+
+        Args:
+            firebase_db: Firestore AsyncClient instance (for the lease)
+            seed: Async callable that schedules every pending deadline from Firestore
+        """
+        self._wakeup = asyncio.Event()
+        while True:
+            now_ts = time.time()
+            if now_ts - self._lease_checked_at >= self.lease_seconds / 3:
+                was_leader = self.is_leader
+                try:
+                    self.is_leader = await self._try_acquire_lease(firebase_db)
+                except Exception as e:
+                    print(f"✗ Scheduler lease error: {e}")
+                    self.is_leader = False
+                self._lease_checked_at = now_ts
+
+                if self.is_leader and (not was_leader or now_ts - self._seeded_at >= self.reseed_seconds):
+                    try:
+                        await self._reseed(seed)
+                    except Exception as e:
+                        print(f"✗ Scheduler seed error: {e}")
+
+            for kind, target_id in list(self._pop_due(time.time())):
+                if not self.is_leader:
+                    continue
+                try:
+                    await self._handlers[kind](target_id)
+                    self.fired += 1
+                except Exception as e:
+                    print(f"✗ Scheduler {kind} handler error for {target_id}: {e}")
+
+            next_due = self._next_due()
+            sleep_seconds = self.lease_seconds / 3
+            if next_due is not None:
+                sleep_seconds = min(sleep_seconds, max(next_due - time.time(), 0))
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), sleep_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': len(self._entries),
+            'isLeader': self.is_leader,
+            'fired': self.fired,
+            'instanceId': self.instance_id
+        }
+
+
+# Global scheduler (one per process)
+deadline_scheduler = DeadlineScheduler(
+    lease_seconds=int(os.getenv('SCHEDULER_LEASE_SECONDS', 60)),
+    reseed_seconds=int(os.getenv('SCHEDULER_RESEED_SECONDS', 600))
+)
@@ -7,6 +7,16 @@ from firebase_admin import auth as admin_auth
 from typing import Optional, Dict, Any
 import uuid
 
+from .token_cache import verify_id_token_cached, token_cache
+
+
+DEFAULT_TENANT_KEY = 'default'  # Bucket for records written before multi-tenancy
+
+
+def tenant_key(tenant_id: Optional[str]) -> str:
+    """Document key of a tenant's per-tenant state (DEFAULT_TENANT_KEY for unstamped records)"""
+    return tenant_id or DEFAULT_TENANT_KEY
+
 
 class TenantMiddleware:
     """
@@ -26,7 +36,7 @@ class TenantMiddleware:
         
         token = auth_header.split('Bearer ')[1]
         try:
-            decoded_token = admin_auth.verify_id_token(token)
+            decoded_token = verify_id_token_cached(token)
             return decoded_token.get('tenantId')
         except Exception:
             return None
@@ -54,7 +64,7 @@ async def get_current_tenant(request: Request) -> Dict[str, Any]:
     
     token = auth_header.split('Bearer ')[1]
     try:
-        decoded_token = admin_auth.verify_id_token(token)
+        decoded_token = verify_id_token_cached(token)
         
         # Check for super admin
         is_super_admin = decoded_token.get('role') == 'superadmin'
@@ -85,19 +95,19 @@ def filter_by_tenant(query, tenant_id: Optional[str], field_name: str = 'tenantI
     Usage:
         query = firebase_db.collection('users')
         query = filter_by_tenant(query, tenant_id)
-        users = list(query.stream())
+        users = [doc async for doc in query.stream()]
     """
     if tenant_id is not None:
         return query.where(field_name, '==', tenant_id)
     return query
 
 
-def create_tenant_document(firebase_db, owner_email: str, business_name: str) -> str:
+async def create_tenant_document(firebase_db, owner_email: str, business_name: str) -> str:
     """
     Create a new tenant document in Firestore
     
     Args:
-        firebase_db: Firestore client
+        firebase_db: Firestore AsyncClient
         owner_email: Owner's email address
         business_name: Business/tenant name
     
@@ -119,7 +129,7 @@ def create_tenant_document(firebase_db, owner_email: str, business_name: str) ->
         'updatedAt': datetime.now(pytz.UTC).isoformat()
     }
     
-    firebase_db.collection('tenants').document(tenant_id).set(tenant_doc)
+    await firebase_db.collection('tenants').document(tenant_id).set(tenant_doc)
     
     return tenant_id
 
@@ -144,7 +154,7 @@ def create_custom_token_with_tenant(uid: str, tenant_id: str, role: str = 'OWNER
     return admin_auth.create_custom_token(uid, custom_claims).decode('utf-8')
 
 
-def set_user_custom_claims(uid: str, tenant_id: str, role: str):
+def set_user_custom_claims(uid: str, tenant_id: str, role: str, assigned_store_id: Optional[str] = None):
     """
     Set custom claims on Firebase user
     
@@ -152,8 +162,104 @@ def set_user_custom_claims(uid: str, tenant_id: str, role: str):
         uid: Firebase user ID
         tenant_id: Tenant ID
         role: User role
+        assigned_store_id: Store the user is assigned to (default: None)
     """
     admin_auth.set_custom_user_claims(uid, {
         'tenantId': tenant_id,
-        'role': role
+        'role': role,
+        'assignedStoreId': assigned_store_id
     })
+
+
+def claims_role(role: Optional[str]) -> str:
+    """
+    Role as published in custom claims
+    
+    Tenant roles are uppercase; 'superadmin' stays lowercase, which is what
+    get_user_from_claims, get_current_tenant and require_role(['superadmin']) match.
+    """
+    role = (role or 'EMPLOYEE').upper()
+    return 'superadmin' if role == 'SUPERADMIN' else role
+
+
+def require_claims_tenant(user_data: Dict[str, Any]):
+    """
+    Refuse to publish claims without a tenant (only super admins have none)
+    
+    A tenantless token would authorize its holder with no tenant filter.
+    Check before writing the user document, so it never diverges from the claims.
+    
+    Raises:
+        HTTPException: 400 if user_data has no tenantId and is not a super admin
+    """
+    if not user_data.get('tenantId') and claims_role(user_data.get('role')) != 'superadmin':
+        raise HTTPException(status_code=400, detail="User has no tenant; refusing to publish claims without one")
+
+
+def sync_user_claims(uid: str, user_data: Dict[str, Any], revoke_sessions: bool = False):
+    """
+    Republish role/tenantId/assignedStoreId custom claims from a user document
+    Call after any write that changes a user's role or store assignment
+    
+    Tokens already issued keep their old claims until the client refreshes
+    them, so cached verifications for this uid are dropped as well. Pass
+    revoke_sessions=True when the change narrows or moves the user's access:
+    their refresh tokens are revoked and older ID tokens are rejected.
+    
+    Args:
+        uid: Firebase user ID
+        user_data: Current user document (as written to Firestore)
+        revoke_sessions: Sign the user out of existing sessions
+    
+    Raises:
+        HTTPException: 400 if user_data has no tenantId (see require_claims_tenant)
+    """
+    require_claims_tenant(user_data)
+    set_user_custom_claims(
+        uid,
+        user_data.get('tenantId'),
+        claims_role(user_data.get('role')),
+        user_data.get('assignedStoreId')
+    )
+    if revoke_sessions:
+        token_cache.revoke_uid(uid)
+    else:
+        token_cache.invalidate_uid(uid)
+
+
+def get_user_from_claims(decoded_token: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Build the authorized-user dict straight from token custom claims
+    
+    Returns None for legacy tokens that predate claim sync (no 'role' or
+    'assignedStoreId' claim); callers then fall back to the Firestore profile.
+    'name' and 'email' are the token's; callers overlay the profile's.
+    
+    Returns:
+        {
+            'uid': str,
+            'tenantId': str,
+            'role': str,
+            'assignedStoreId': str,
+            'name': str,
+            'email': str,
+            'isSuperAdmin': bool
+        }
+    """
+    role = decoded_token.get('role')
+    if not role:
+        return None
+    
+    is_super_admin = role == 'superadmin'
+    if not is_super_admin and 'assignedStoreId' not in decoded_token:
+        return None
+    
+    return {
+        'uid': decoded_token['uid'],
+        'tenantId': decoded_token.get('tenantId'),
+        'role': role if is_super_admin else role.upper(),
+        'assignedStoreId': decoded_token.get('assignedStoreId'),
+        'name': decoded_token.get('name', 'Unknown'),
+        'email': decoded_token.get('email'),
+        'isSuperAdmin': is_super_admin
+    }
@@ -0,0 +1,128 @@
+"""
+Verified ID token cache for VireoHR
+Avoids repeating the Firebase RSA signature check for tokens we have already verified
+"""
+from firebase_admin import auth as admin_auth
+from typing import Optional, Dict, Any
+import hashlib
+import os
+import threading
+import time
+
+from .ttl_cache import TTLCache
+
+
+ID_TOKEN_LIFETIME = 3600  # Firebase ID tokens expire an hour after issue
+
+
+class TokenCache(TTLCache):
+    """
+    Bounded in-process LRU cache of decoded Firebase ID tokens
+
+    Entries are keyed by a SHA-256 digest of the raw token (the token itself is
+    never stored) and expire at the token's own 'exp' claim. When
+    revocation_check_interval is set, a cached entry is re-verified with
+    check_revoked=True once it is older than that many seconds.
+
+    revoke_uid() revokes a user's refresh tokens and, for the lifetime of the
+    ID tokens issued before it, verifies that user's tokens with
+    check_revoked=True in this process. Other processes see the revocation
+    through revocation_check_interval.
+    """
+
+    def __init__(self, max_size: int = 10000, revocation_check_interval: Optional[int] = None):
+        # Wall clock: entries expire at the token's 'exp' (a Unix timestamp), and
+        # the revocation check interval bounds how long a verification is trusted
+        super().__init__(max_size, ttl_seconds=revocation_check_interval, clock=time.time)
+        self.revocation_check_interval = revocation_check_interval
+        self._revoked: Dict[str, float] = {}  # uid -> time its tokens were revoked
+        self._revoked_lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        """
+        Return the decoded claims for a token, verifying it only on a cache miss
+
+        Args:
+            token: Raw Firebase ID token from the Authorization header
+
+        Returns:
+            Decoded token claims
+
+        Raises:
+            Any exception raised by admin_auth.verify_id_token (invalid,
+            expired or revoked tokens are never cached)
+        """
+        key = self._digest(token)
+
+        claims = self.get(key)
+        if claims is not None:
+            return claims
+
+        check_revoked = self.revocation_check_interval is not None
+        claims = admin_auth.verify_id_token(token, check_revoked=check_revoked)
+        if not check_revoked and self._recently_revoked(claims.get('uid'), time.time()):
+            claims = admin_auth.verify_id_token(token, check_revoked=True)
+        self.put(key, claims, expires_at=claims.get('exp', 0))
+        return claims
+
+    def _recently_revoked(self, uid: Optional[str], now: float) -> bool:
+        with self._revoked_lock:
+            revoked_at = self._revoked.get(uid)
+            if revoked_at is not None and now - revoked_at >= ID_TOKEN_LIFETIME:
+                del self._revoked[uid]
+                return False
+            return revoked_at is not None
+
+    def invalidate_uid(self, uid: str):
+        """Drop every cached token belonging to a user (e.g. after claims change)"""
+        self.discard_where(lambda key, claims: claims.get('uid') == uid)
+
+    def revoke_uid(self, uid: str):
+        """
+        Revoke a user's sessions (after a role/store change, or before deleting them)
+
+        Their refresh tokens are revoked, so the client must sign in again, and
+        ID tokens issued before now are rejected instead of served from cache.
+        """
+        admin_auth.revoke_refresh_tokens(uid)
+        with self._revoked_lock:
+            self._revoked[uid] = time.time()
+        self.invalidate_uid(uid)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and current size"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self),
+            'maxSize': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': round(self.hits / total, 4) if total else 0.0,
+            'revocationCheckInterval': self.revocation_check_interval
+        }
+
+
+def _revocation_interval_from_env() -> Optional[int]:
+    value = os.getenv('TOKEN_REVOCATION_CHECK_SECONDS')
+    return int(value) if value else None
+
+
+# Shared cache used by verify_token and the tenant dependencies
+token_cache = TokenCache(
+    max_size=int(os.getenv('TOKEN_CACHE_MAX_SIZE', 10000)),
+    revocation_check_interval=_revocation_interval_from_env()
+)
+
+
+def verify_id_token_cached(token: str) -> Dict[str, Any]:
+    """
+    Verify a Firebase ID token through the shared cache
+
+    Usage:
+        decoded_token = verify_id_token_cached(token)
+    """
+    return token_cache.verify(token)
@@ -0,0 +1,98 @@
+"""
+In-process TTL cache for VireoHR
+Bounded TTL + LRU map shared by the token, user profile, idempotency and payroll caches
+
+Entries expire ttl_seconds after they are stored, or at an explicit deadline
+passed to put(); past max_size the least recently used entry is evicted.
+All operations take a lock, so a cache can be shared between the event loop
+and worker threads.
+"""
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Callable, Hashable, Tuple
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Bounded TTL + LRU cache
+
+    Args:
+        max_size: Entries kept before the least recently used is evicted
+        ttl_seconds: Default lifetime of an entry (None = until evicted or its
+            own expires_at)
+        clock: Time source for ttl_seconds and expires_at (time.time when
+            deadlines are wall-clock timestamps, e.g. a token's 'exp')
+
+    Usage:
+        cache = TTLCache(max_size=5000, ttl_seconds=300)
+        cache.put(uid, user_data)
+        user_data = cache.get(uid)  # None once expired or evicted
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Cached value for key (None if missing or expired)"""
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and now >= entry[1]:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, expires_at: Optional[float] = None):
+        """
+        Store a value, expiring at expires_at (clock time) or after ttl_seconds,
+        whichever comes first
+        """
+        now = self.clock()
+        if self.ttl_seconds is not None:
+            expires_at = now + self.ttl_seconds if expires_at is None else min(expires_at, now + self.ttl_seconds)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate: Callable[[Hashable, Any], bool]):
+        """Drop every entry for which predicate(key, value) is true"""
+        with self._lock:
+            stale = [key for key, (value, _) in self._entries.items() if predicate(key, value)]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._entries),
+            'maxSize': self.max_size,
+            'ttlSeconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses
+        }
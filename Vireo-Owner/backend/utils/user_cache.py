@@ -0,0 +1,38 @@
+"""
+User profile cache for VireoHR
+Shared TTL + LRU cache of users/{uid} documents, invalidated by the user write paths
+"""
+from typing import Optional, Dict, Any
+import os
+
+from .ttl_cache import TTLCache
+
+
+class UserProfileCache(TTLCache):
+    """
+    Bounded TTL + LRU cache of user documents keyed by uid
+
+    Only existing documents are cached. Tenant isolation is enforced by the
+    caller (see get_user_document) on every hit, exactly as on a fresh read.
+    """
+
+    def __init__(self, max_size: int = 5000, ttl_seconds: int = 300):
+        super().__init__(max_size, ttl_seconds=ttl_seconds)
+
+    def get(self, uid: str) -> Optional[Dict[str, Any]]:
+        user_data = super().get(uid)
+        return dict(user_data) if user_data is not None else None
+
+    def put(self, uid: str, user_data: Dict[str, Any]):
+        super().put(uid, dict(user_data))
+
+    def invalidate(self, uid: str):
+        """Drop a user's cached profile - call after any write to users/{uid}"""
+        self.pop(uid)
+
+
+# Shared cache used by get_user_document / get_user_profile
+user_cache = UserProfileCache(
+    max_size=int(os.getenv('USER_CACHE_MAX_SIZE', 5000)),
+    ttl_seconds=int(os.getenv('USER_CACHE_TTL_SECONDS', 300))
+)
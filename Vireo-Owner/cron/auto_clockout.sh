@@ -10,6 +10,10 @@
 # It checks the overtime toggle for each date before proceeding.
 # If overtime is enabled for a date, auto clock-out is skipped.
 #
+# The backend's in-process deadline scheduler (SCHEDULER_ENABLED,
+# default true) already clocks sessions out one hour after shift end;
+# this daily run is a fallback for deployments that disable it.
+#
 # Setup:
 # 1. Make executable: chmod +x cron/auto_clockout.sh
 # 2. Add to crontab: crontab -e
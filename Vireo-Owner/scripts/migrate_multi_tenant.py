@@ -7,8 +7,16 @@ This script:
 2. Adds tenantId field to all existing Firestore documents
 3. Sets custom claims with tenantId for all users
 
+Tenant-scoped queries (payroll, no-show detection, the store cap) filter on
+tenantId == <tenant>, so a document without a tenantId (missing or null) is
+invisible to them. Step 2 stamps such documents with their employee's
+tenant, else their store's tenant, else the default tenant. Run it again
+with --backfill-only after deploying to stamp records written by older
+servers; it skips tenant creation and custom claims and can be repeated.
+
 Usage:
     python3 scripts/migrate_multi_tenant.py
+    python3 scripts/migrate_multi_tenant.py --backfill-only [--tenant <tenantId>]
 
 Prerequisites:
     - Firebase Admin SDK credentials must be configured
@@ -18,6 +26,7 @@ Prerequisites:
 
 import sys
 import os
+import argparse
 from pathlib import Path
 
 # Add parent directory to path for imports
@@ -31,6 +40,9 @@ import uuid
 import json
 from dotenv import load_dotenv
 
+from utils.counts import LEGACY_TENANT_FIELD
+from utils.no_shows import unstamped_watermark_ref, BACKFILLED_FIELD
+
 # Load environment variables
 env_path = Path(__file__).parent.parent / 'backend' / '.env'
 load_dotenv(env_path)
@@ -119,33 +131,138 @@ def create_default_tenant(db):
     return tenant_id, owner.id
 
 
-def backfill_tenant_id(db, tenant_id, collection_name):
+BATCH_LIMIT = 500  # Firestore write batch limit
+
+# Backfilled first, so the other collections can take their tenant from them
+OWNER_COLLECTIONS = ['users', 'stores']
+COLLECTIONS = [
+    'users',
+    'stores',
+    'shifts',
+    'attendance',
+    'active_sessions',
+    'ingredients',
+    'ingredient_counts',
+    'leave_requests',
+    'payment_history'
+]
+
+
+def tenant_index(db, collection_name):
+    """Document ID -> tenantId for a collection"""
+    return {doc.id: doc.to_dict().get('tenantId') for doc in db.collection(collection_name).stream()}
+
+
+def backfill_tenant_id(db, tenant_id, collection_name, user_tenants=None, store_tenants=None):
     """
-    Add tenantId field to all documents in a collection
+    Add tenantId to every document of a collection that has none (missing or null)
+    
+    The tenant is the document's employee's, else its store's, else tenant_id.
+    Documents none of these resolve are left alone and counted.
+    
+    Returns:
+        Set of 'yyyy-mm' months of the attendance/shifts documents updated
     """
     print(f"  Processing collection: {collection_name}")
+    user_tenants = user_tenants or {}
+    store_tenants = store_tenants or {}
     
-    docs = list(db.collection(collection_name).stream())
+    updated = 0
+    skipped = 0
+    unresolved = 0
+    months = set()
+    batch = db.batch()
+    pending = 0
     
-    if not docs:
-        print(f"    ℹ No documents found in {collection_name}")
-        return
-    
-    count = 0
-    for doc in docs:
+    for doc in db.collection(collection_name).stream():
         doc_data = doc.to_dict()
         
-        # Skip if tenantId already exists
-        if 'tenantId' in doc_data:
+        # Skip if tenantId already set
+        if doc_data.get('tenantId'):
+            skipped += 1
             continue
         
-        # Add tenantId
-        db.collection(collection_name).document(doc.id).update({
-            'tenantId': tenant_id
-        })
-        count += 1
+        resolved = (
+            user_tenants.get(doc_data.get('employeeId'))
+            or store_tenants.get(doc_data.get('storeId'))
+            or tenant_id
+        )
+        if not resolved:
+            unresolved += 1
+            continue
+        
+        batch.update(doc.reference, {'tenantId': resolved})
+        pending += 1
+        updated += 1
+        month_source = doc_data.get('clockInTime') or doc_data.get('date')
+        if collection_name in ('attendance', 'shifts') and month_source:
+            months.add(month_source[:7])
+        
+        if pending == BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    
+    if pending:
+        batch.commit()
+    
+    print(f"    ✓ Updated {updated} documents (skipped {skipped} existing)")
+    if unresolved:
+        print(f"    ✗ {unresolved} documents have no employee/store tenant; re-run with --tenant <tenantId>")
+    return months
+
+
+def backfill_all(db, tenant_id):
+    """Backfill every tenant-scoped collection; returns the attendance/shift months touched"""
+    months = set()
+    for collection_name in OWNER_COLLECTIONS:
+        months |= backfill_tenant_id(db, tenant_id, collection_name)
     
-    print(f"    ✓ Updated {count} documents (skipped {len(docs) - count} existing)")
+    user_tenants = tenant_index(db, 'users')
+    store_tenants = tenant_index(db, 'stores')
+    for collection_name in COLLECTIONS:
+        if collection_name not in OWNER_COLLECTIONS:
+            months |= backfill_tenant_id(db, tenant_id, collection_name, user_tenants, store_tenants)
+    return months
+
+
+def mark_legacy_tenant(db, tenant_id):
+    """
+    Record which tenant owns the pre-tenancy data
+    
+    Stores without a tenantId count towards this tenant's store cap only.
+    """
+    if tenant_id is None:
+        return
+    db.collection('tenants').document(tenant_id).set({LEGACY_TENANT_FIELD: True}, merge=True)
+
+
+def mark_shifts_backfilled(db):
+    """
+    Stop no-show detection's unstamped-shift pass once every shift has a tenantId
+    
+    That pass reads every tenant's shifts on each run, so it is only kept
+    while unstamped shifts remain.
+    """
+    shifts = db.collection('shifts')
+    total = shifts.count(alias='count').get()[0][0].value
+    stamped = shifts.where('tenantId', '!=', None).count(alias='count').get()[0][0].value
+    if stamped < total:
+        print(f"  ✗ {total - stamped} shifts still have no tenantId; no-show detection keeps scanning for them")
+        return
+    unstamped_watermark_ref(db).set({
+        BACKFILLED_FIELD: datetime.now(pytz.UTC).isoformat()
+    }, merge=True)
+    print("  ✓ Every shift has a tenantId; no-show detection no longer scans for unstamped shifts")
+
+
+def print_rebuild_hint(months):
+    """Payroll aggregates of backfilled months must be rebuilt to include the stamped records"""
+    if not months:
+        return
+    print()
+    print(f"  ℹ Stamped attendance/shifts in {len(months)} month(s); rebuild their payroll aggregates:")
+    print(f"    python3 scripts/rebuild_payroll_aggregates.py {min(months)} {max(months)}")
 
 
 def set_custom_claims(db, tenant_id, owner_uid):
@@ -178,6 +295,24 @@ def set_custom_claims(db, tenant_id, owner_uid):
 
 def main():
     """Main migration function"""
+    parser = argparse.ArgumentParser(description='Migrate VireoHR data to multi-tenancy')
+    parser.add_argument('--backfill-only', action='store_true',
+                        help='Only stamp documents that have no tenantId (safe to repeat)')
+    parser.add_argument('--tenant', help='Tenant for documents without an employee/store tenant')
+    args = parser.parse_args()
+    
+    if args.backfill_only:
+        tenant_id = args.tenant
+        if tenant_id is None:
+            tenants = list(db.collection('tenants').limit(2).stream())
+            tenant_id = tenants[0].id if len(tenants) == 1 else None
+        print("Backfilling tenantId on documents without one...")
+        print("-" * 60)
+        mark_legacy_tenant(db, tenant_id)
+        print_rebuild_hint(backfill_all(db, tenant_id))
+        mark_shifts_backfilled(db)
+        print()
+        return
     
     # Step 1: Create default tenant
     tenant_id, owner_uid = create_default_tenant(db)
@@ -186,19 +321,9 @@ def main():
     print("Step 2: Backfilling tenantId on existing documents...")
     print("-" * 60)
     
-    collections = [
-        'users',
-        'stores',
-        'shifts',
-        'attendance',
-        'ingredients',
-        'ingredient_counts',
-        'leave_requests',
-        'payment_history'
-    ]
-    
-    for collection_name in collections:
-        backfill_tenant_id(db, tenant_id, collection_name)
+    mark_legacy_tenant(db, args.tenant or tenant_id)
+    print_rebuild_hint(backfill_all(db, args.tenant or tenant_id))
+    mark_shifts_backfilled(db)
     
     print()
     
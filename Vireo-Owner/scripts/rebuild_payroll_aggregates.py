@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+VireoHR Payroll Aggregate Rebuild Script
+
+Recomputes payroll_aggregates/{tenant}/{yyyy-mm}/{employeeId} documents from
+raw attendance and shifts, one transaction per employee, and marks each
+month built. The server builds a month on its first read and the current
+month at startup; use this to backfill older months ahead of time or to
+repair drift.
+
+Usage:
+    python3 scripts/rebuild_payroll_aggregates.py 2025-01              # all tenants
+    python3 scripts/rebuild_payroll_aggregates.py 2025-01 2025-03      # month range
+    python3 scripts/rebuild_payroll_aggregates.py 2025-01 --tenant <tenantId>
+
+Prerequisites:
+    - Firebase Admin SDK credentials must be configured
+    - Run from project root directory
+"""
+
+import sys
+import os
+import asyncio
+import argparse
+from pathlib import Path
+
+# Add backend directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+import firebase_admin
+from firebase_admin import credentials, firestore_async
+from datetime import datetime
+import pytz
+import json
+from dotenv import load_dotenv
+
+from utils.payroll_aggregates import rebuild_month
+
+# Load environment variables
+env_path = Path(__file__).parent.parent / 'backend' / '.env'
+load_dotenv(env_path)
+
+TIMEZONE = pytz.timezone('Asia/Amman')
+
+
+def init_firestore():
+    """Initialize Firebase Admin and return an async Firestore client"""
+    firebase_creds = os.getenv('FIREBASE_SERVICE_ACCOUNT_KEY')
+    if firebase_creds:
+        cred = credentials.Certificate(json.loads(firebase_creds))
+    else:
+        cred_file = Path(__file__).parent.parent / 'backend' / 'firebase-service-account.json'
+        if not cred_file.exists():
+            raise Exception("No Firebase credentials found")
+        cred = credentials.Certificate(str(cred_file))
+
+    firebase_admin.initialize_app(cred)
+    return firestore_async.client()
+
+
+def month_range(first: str, last: str):
+    """Yield (year, month) from first to last inclusive ('yyyy-mm' strings)"""
+    year, month = map(int, first.split('-'))
+    end_year, end_month = map(int, last.split('-'))
+    while (year, month) <= (end_year, end_month):
+        yield year, month
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+
+async def main(args):
+    db = init_firestore()
+    now = datetime.now(TIMEZONE)
+
+    if args.tenant:
+        tenant_ids = [args.tenant]
+    else:
+        tenant_ids = [doc.id async for doc in db.collection('tenants').stream()]
+
+    print("=" * 60)
+    print("VireoHR Payroll Aggregate Rebuild")
+    print("=" * 60)
+
+    for tenant_id in tenant_ids:
+        for year, month in month_range(args.first_month, args.last_month or args.first_month):
+            written = await rebuild_month(db, tenant_id, year, month, now, TIMEZONE)
+            print(f"  ✓ {tenant_id} {year:04d}-{month:02d}: {written} employees")
+
+    print()
+    print("Rebuild complete")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild monthly payroll aggregates")
+    parser.add_argument('first_month', help="First month to rebuild (yyyy-mm)")
+    parser.add_argument('last_month', nargs='?', help="Last month to rebuild (yyyy-mm, default: first_month)")
+    parser.add_argument('--tenant', help="Only rebuild this tenant")
+
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        print("\n\n✗ Rebuild cancelled by user")
+        sys.exit(1)
+    except Exception as e:
+        print(f"\n\n✗ Rebuild failed: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+VireoHR Nightly Payroll Run
+
+Computes a month's payroll for every tenant in a process pool and stores
+immutable snapshots under payroll_runs/{runId} (see utils/payroll_run.py).
+Progress is printed as tenants finish and kept on the run document, so an
+interrupted run can be resumed with --resume.
+
+Usage:
+    python3 scripts/run_payroll.py 2025-01                     # all tenants
+    python3 scripts/run_payroll.py 2025-01 --workers 8
+    python3 scripts/run_payroll.py 2025-01 --tenant <tenantId>
+    python3 scripts/run_payroll.py --resume 2025-01_<id>       # continue a crashed run
+
+Prerequisites:
+    - Firebase Admin SDK credentials must be configured
+    - Run from project root directory
+"""
+
+import sys
+import os
+import asyncio
+import argparse
+from pathlib import Path
+
+# Add backend directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+import firebase_admin
+from firebase_admin import credentials, firestore_async
+from datetime import datetime
+import pytz
+import json
+from dotenv import load_dotenv
+
+from utils import payroll_run
+
+# Load environment variables
+env_path = Path(__file__).parent.parent / 'backend' / '.env'
+load_dotenv(env_path)
+
+TIMEZONE = pytz.timezone('Asia/Amman')
+
+
+def init_firestore():
+    """Initialize Firebase Admin and return an async Firestore client"""
+    firebase_creds = os.getenv('FIREBASE_SERVICE_ACCOUNT_KEY')
+    if firebase_creds:
+        cred = credentials.Certificate(json.loads(firebase_creds))
+    else:
+        cred_file = Path(__file__).parent.parent / 'backend' / 'firebase-service-account.json'
+        if not cred_file.exists():
+            raise Exception("No Firebase credentials found")
+        cred = credentials.Certificate(str(cred_file))
+
+    firebase_admin.initialize_app(cred)
+    return firestore_async.client()
+
+
+def print_progress(state):
+    failed = f", {len(state['failed'])} failed" if state['failed'] else ""
+    print(f"  [{state['done']}/{state['total']}] {len(state['completed'])} tenants done{failed}")
+
+
+async def main(args):
+    db = init_firestore()
+    now = datetime.now(TIMEZONE)
+
+    print("=" * 60)
+    print("VireoHR Payroll Run")
+    print("=" * 60)
+
+    if args.resume:
+        run_id = args.resume
+        print(f"Resuming run {run_id}")
+    else:
+        if not args.month:
+            raise Exception("A month (yyyy-mm) or --resume <runId> is required")
+        year, month = map(int, args.month.split('-'))
+        tenant_ids = [args.tenant] if args.tenant else None
+        run_id = await payroll_run.start_run(db, year, month, now, started_by='cli', tenant_ids=tenant_ids)
+        print(f"Started run {run_id}")
+
+    run = await payroll_run.execute_run(db, run_id, now, args.workers, progress=print_progress)
+
+    print()
+    for tenant_key, error in run['failed'].items():
+        print(f"  ✗ {tenant_key}: {error}")
+    print(f"Run {run_id} {run['status'].lower()}")
+    if run['failed']:
+        print(f"Resume with: python3 scripts/run_payroll.py --resume {run_id}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute a month's payroll for every tenant")
+    parser.add_argument('month', nargs='?', help="Month to compute (yyyy-mm)")
+    parser.add_argument('--tenant', help="Only compute this tenant")
+    parser.add_argument('--workers', type=int, help="Worker processes (default: PAYROLL_RUN_WORKERS or up to 4)")
+    parser.add_argument('--resume', metavar='RUN_ID', help="Resume an interrupted run")
+
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        print("\n\n✗ Payroll run interrupted - resume it with --resume")
+        sys.exit(1)
+    except Exception as e:
+        print(f"\n\n✗ Payroll run failed: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,159 @@
+"""
+Property test: the column-oriented payroll path matches the scalar loop
+
+Random periods (timestamp offsets and 'Z' suffixes, paid and late flags,
+missing and out-of-period shifts, no-shows) are run through compute_period
+and compute_period_vectorized, which must return identical results.
+"""
+import random
+import sys
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import pytest
+import pytz
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+from utils.payroll import compute_period, compute_period_vectorized, LATE_WARNINGS  # noqa: E402
+
+
+TIMEZONE = pytz.timezone('Asia/Amman')
+PERIOD_START = date(2025, 3, 1)
+PERIOD_END = date(2025, 3, 31)
+OFFSETS = ['Z', '+00:00', '+03:00', '+02:00', '-05:30', '+05:45']
+
+
+def _timestamp(rng, moment: datetime) -> str:
+    """ISO timestamp with a random UTC offset, fraction and suffix style"""
+    suffix = rng.choice(OFFSETS)
+    if suffix == 'Z':
+        local = moment
+    else:
+        sign = 1 if suffix[0] == '+' else -1
+        local = moment + sign * timedelta(hours=int(suffix[1:3]), minutes=int(suffix[4:6]))
+    text = local.strftime('%Y-%m-%dT%H:%M:%S')
+    if rng.random() < 0.5:
+        text += f".{rng.randrange(1000000):06d}"
+    return text + suffix
+
+
+def _shift(rng, employee_id: str, day: date) -> dict:
+    start_hour = rng.randrange(6, 16)
+    return {
+        'employeeId': employee_id,
+        'date': day.isoformat(),
+        'startTime': f"{start_hour:02d}:{rng.choice(['00', '30'])}",
+        'endTime': f"{start_hour + rng.randrange(2, 9):02d}:00"
+    }
+
+
+def _random_period(seed: int):
+    rng = random.Random(seed)
+    employees = [f"emp{index}" for index in range(rng.randrange(1, 8))]
+    days = (PERIOD_END - PERIOD_START).days + 1
+
+    shifts = {}
+    for index in range(rng.randrange(0, 60)):
+        shifts[f"shift{index}"] = _shift(rng, rng.choice(employees), PERIOD_START + timedelta(days=rng.randrange(days)))
+    # Late arrivals on the 1st can belong to a shift scheduled the day before
+    extra_shifts = {
+        f"prev{index}": _shift(rng, rng.choice(employees), PERIOD_START - timedelta(days=1))
+        for index in range(rng.randrange(0, 4))
+    }
+    # Malformed or unassigned shifts are never no-shows
+    for index in range(rng.randrange(0, 3)):
+        broken = _shift(rng, rng.choice(employees), PERIOD_START + timedelta(days=rng.randrange(days)))
+        broken.pop(rng.choice(['startTime', 'endTime']))
+        shifts[f"broken{index}"] = broken
+    if rng.random() < 0.3:
+        shifts['unassigned'] = {**_shift(rng, '', PERIOD_START), 'employeeId': None}
+
+    shift_ids = [shift_id for shift_id in shifts if not shift_id.startswith(('broken', 'unassigned'))]
+    attendance = []
+    clock_ins = []
+    for index in range(rng.randrange(0, 250)):
+        # A few records just outside the period; some share a clock-in with an earlier one
+        if clock_ins and rng.random() < 0.1:
+            clock_in_text = rng.choice(clock_ins)
+        else:
+            clock_in = datetime.combine(PERIOD_START - timedelta(days=1), datetime.min.time()) + timedelta(
+                minutes=rng.randrange((days + 2) * 24 * 60)
+            )
+            clock_in_text = _timestamp(rng, clock_in)
+        clock_ins.append(clock_in_text)
+        clock_out = datetime.fromisoformat(clock_in_text.replace('Z', '+00:00')) + timedelta(
+            minutes=rng.randrange(0, 12 * 60), seconds=rng.randrange(60)
+        )
+
+        status = rng.choices(['CLOCKED_OUT', 'CLOCKED_IN', 'NO_SHOW'], weights=[85, 8, 7])[0]
+        shift_id = rng.choice(shift_ids + list(extra_shifts) + ['missing', None]) if shift_ids or extra_shifts else None
+        record = {
+            'id': f"att{index}",
+            'employeeId': rng.choice(employees),
+            'shiftId': shift_id,
+            'clockInTime': clock_in_text,
+            'clockOutTime': clock_out.isoformat().replace('+00:00', rng.choice(['Z', '+00:00'])),
+            'status': status,
+            'isLate': rng.random() < 0.4,
+            'paid': rng.random() < 0.3
+        }
+        if status == 'NO_SHOW' and rng.random() < 0.5:
+            record['noShow'] = True
+        if rng.random() < 0.1:
+            record.pop('paid')
+        attendance.append(record)
+
+    now = TIMEZONE.localize(datetime.combine(
+        PERIOD_START + timedelta(days=rng.randrange(days + 5)), datetime.min.time()
+    ) + timedelta(minutes=rng.randrange(24 * 60)))
+    return attendance, shifts, extra_shifts, now
+
+
+def _typed(value):
+    """Value with its type, so 1 and 1.0 (or int and numpy scalars) are told apart"""
+    if isinstance(value, list):
+        return [_typed(item) for item in value]
+    return (type(value), value)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_vectorized_matches_scalar(seed):
+    attendance, shifts, extra_shifts, now = _random_period(seed)
+
+    expected = compute_period(attendance, shifts, PERIOD_START, PERIOD_END, now, TIMEZONE, extra_shifts)
+    actual = compute_period_vectorized(attendance, shifts, PERIOD_START, PERIOD_END, now, TIMEZONE, extra_shifts)
+
+    assert list(actual) == list(expected)
+    for employee_id, result in expected.items():
+        assert list(actual[employee_id]) == list(result)
+        for field, value in result.items():
+            assert _typed(actual[employee_id][field]) == _typed(value), (employee_id, field)
+
+
+def test_late_penalties_start_at_third_late_arrival():
+    """Late rank follows clock-in order, not record order, and the first LATE_WARNINGS are free"""
+    shifts = {
+        f"shift{day}": {'employeeId': 'emp', 'date': f"2025-03-{day:02d}", 'startTime': '09:00', 'endTime': '17:00'}
+        for day in range(1, 6)
+    }
+    attendance = [
+        {
+            'id': f"att{day}",
+            'employeeId': 'emp',
+            'shiftId': f"shift{day}",
+            'clockInTime': f"2025-03-{day:02d}T09:30:00+03:00",
+            'clockOutTime': f"2025-03-{day:02d}T17:00:00+03:00",
+            'status': 'CLOCKED_OUT',
+            'isLate': True
+        }
+        for day in (5, 3, 1, 4, 2)
+    ]
+    now = TIMEZONE.localize(datetime(2025, 3, 31, 12, 0))
+
+    for compute in (compute_period, compute_period_vectorized):
+        result = compute(attendance, shifts, PERIOD_START, PERIOD_END, now, TIMEZONE)['emp']
+        assert result['lateCount'] == 5
+        assert result['latePenaltyHours'] == (5 - LATE_WARNINGS) * 8 * 0.5
+        assert result['attendanceIds'] == ['att1', 'att2', 'att3', 'att4', 'att5']
+        assert result['noShowCount'] == 0